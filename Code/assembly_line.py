@@ -0,0 +1,246 @@
+"""
+assembly_line provides the pipelined codec stage (compression)
+
+large messages are compressed / decompressed by a pool of worker processes, so
+that the codec work of several messages runs on several cores in parallel
+messages are handed over through multiprocessing.shared_memory instead of
+being pickled, one copy each way: the workers read the input in place, and the
+result of the future is a memoryview of the output segment, read in place by its
+consumers (the outbox sends it, the download manager / moving van write it), the
+segment is unlinked once collected and unmapped once no view of it is left
+(reference -> hold)
+
+submit_encode / submit_decode return a concurrent.futures.Future, the outbox
+and the inbox keep the futures in wire order and only send / process the
+first one once it is done, so the wire order is preserved
+
+encoded message:
+without codec: message
+with codec: codec !B + message compressed with codec
+
+encryption is streamed record by record by the inbox / outbox (reference -> encryption_bureau)
+
+the shared memory copies are acquired from the memory budget (reference -> treasury),
+while the budget is exhausted messages are encoded / decoded inline instead
+
+the codec time of each message is measured (reference -> observatory)
+"""
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from threading import Lock
+import compression_station, treasury, observatory
+
+# config
+MIN_SIZE = 262144  # 256KB, messages smaller than this are encoded / decoded inline
+PIPELINE_DEPTH = 4  # maximum number of messages in the codec stage per inbox / outbox
+
+POOL = None
+WORKERS = 0
+
+# the output segments collected, mapped until no view of them is left (reference -> hold)
+OUTPUTS = []
+OUTPUTS_LOCK = Lock()
+
+# metrics (reference -> observatory)
+CODEC_SECONDS = observatory.histogram('codec_seconds', 'time to compress / decompress a message', ('operation',))
+
+
+def encode(message, codec=None):
+    """
+    :param message: the message to encode
+    :param codec: the codec to compress with (reference -> compression_station), None for no codec prefix
+    :return: (encoded message, compressed size, compression time)
+    """
+    compressed_size = len(message)
+    seconds = 0
+    if codec is not None:
+        start_time = time.perf_counter()
+        compressed = compression_station.compress(message, codec)
+        seconds = time.perf_counter() - start_time
+        compressed_size = len(compressed)
+        message = bytes([codec]) + compressed
+    return message, compressed_size, seconds
+
+
+def decode(message, decompression=False):
+    """
+    :param message: the encoded message
+    :param decompression: whether the message has a codec prefix
+    :return: the decoded message
+    :raise compression_station.DecompressionError: the message is corrupt
+    """
+    if decompression is True:
+        if len(message) == 0:
+            raise compression_station.DecompressionError('no codec')
+        message = compression_station.decompress(message[1:], message[0])
+    return message
+
+
+def submit_encode(message, codec=None):
+    """
+    reference -> encode
+    :return: future of (encoded message, compressed size, compression time)
+    """
+    if POOL is None or len(message) < MIN_SIZE or codec in (None, compression_station.CODEC_RAW) or \
+            not treasury.TREASURY.acquire(len(message), treasury.ACCOUNT_SEND, timeout=0):
+        future = Future()
+        result = encode(message, codec)
+        if codec is not None:
+            CODEC_SECONDS.observe(result[2], ('encode',))
+        future.set_result(result)
+        return future
+    return submit(encode_job, message, treasury.ACCOUNT_SEND, 'encode', codec)
+
+
+def submit_decode(message, decompression=False):
+    """
+    reference -> decode
+    :return: future of the decoded message, or of compression_station.DecompressionError if corrupt
+    """
+    if POOL is None or len(message) < MIN_SIZE or not decompression or message[0] == compression_station.CODEC_RAW \
+            or not treasury.TREASURY.acquire(len(message), treasury.ACCOUNT_RECEIVE, timeout=0):
+        future = Future()
+        start_time = time.perf_counter()
+        try:
+            future.set_result(decode(message, decompression))
+        except compression_station.DecompressionError as e:
+            future.set_exception(e)
+        if decompression is True:
+            CODEC_SECONDS.observe(time.perf_counter() - start_time, ('decode',))
+        return future
+    return submit(decode_job, message, treasury.ACCOUNT_RECEIVE, 'decode', decompression)
+
+
+def submit(job, message, account, operation, *args):
+    """
+    copy the message into shared memory and submit the job to the pool
+    the size of the message must be acquired from the memory budget account, it is released once collected
+    :param operation: 'encode' / 'decode', the label of the codec time
+    job result: (output shared memory name, output size, [other results, ...] codec time)
+    :return: future of the output, a memoryview of the output segment, or (output, other results, ...,
+             codec time) if the job has other results
+    """
+    input_memory = shared_memory.SharedMemory(create=True, size=len(message))
+    input_memory.buf[:len(message)] = message
+    future = Future()
+
+    def collect(result):
+        try:
+            output_name, output_size, *rest = result
+            CODEC_SECONDS.observe(rest[-1], (operation,))
+            # read in place: the name is released now, the mapping once the consumers drop their views
+            output_memory = shared_memory.SharedMemory(name=output_name)
+            output_memory.unlink()
+            output = output_memory.buf[:output_size]
+            hold(output_memory)
+            future.set_result(output if len(rest) == 1 else (output, *rest))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            input_memory.close()
+            input_memory.unlink()
+            treasury.TREASURY.release(len(message), account)
+
+    def collect_error(e):
+        input_memory.close()
+        input_memory.unlink()
+        treasury.TREASURY.release(len(message), account)
+        future.set_exception(e)
+
+    POOL.apply_async(job, (input_memory.name, len(message)) + args, callback=collect, error_callback=collect_error)
+    return future
+
+
+def hold(output_memory):
+    """
+    keep an output segment mapped while it is viewed, and close the earlier ones no longer viewed
+    (closing a segment with views left raises BufferError)
+    :return: None
+    """
+    with OUTPUTS_LOCK:
+        viewed = [output_memory]
+        for earlier_memory in OUTPUTS:
+            try:
+                earlier_memory.close()
+            except BufferError:
+                viewed.append(earlier_memory)
+        OUTPUTS[:] = viewed
+
+
+def encode_job(input_name, input_size, codec):
+    """
+    runs in a worker process, compresses the input in place
+    :return: (output shared memory name, output size, compressed size, compression time)
+    """
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    try:
+        with input_memory.buf[:input_size] as message:
+            start_time = time.perf_counter()
+            compressed = compression_station.compress(message, codec)
+            seconds = time.perf_counter() - start_time
+            return write_output(bytes([codec]), compressed) + (len(compressed), seconds)
+    finally:
+        input_memory.close()
+
+
+def decode_job(input_name, input_size, decompression):
+    """
+    runs in a worker process, decompresses the input in place
+    :return: (output shared memory name, output size, decompression time)
+    """
+    input_memory = shared_memory.SharedMemory(name=input_name)
+    error = None
+    try:
+        with input_memory.buf[:input_size] as message:
+            start_time = time.perf_counter()
+            decoded = decode(message, decompression)
+            seconds = time.perf_counter() - start_time
+            return write_output(decoded) + (seconds,)
+    except compression_station.DecompressionError as e:
+        # the traceback holds views of the input: raised again without it, once the input is closed
+        error = str(e)
+    finally:
+        input_memory.close()
+    raise compression_station.DecompressionError(error)
+
+
+def write_output(*parts):
+    """
+    copy the parts of the output into a new segment, unlinked by the main process once collected
+    :return: (output shared memory name, output size)
+    """
+    output_size = sum(len(part) for part in parts)
+    output_memory = shared_memory.SharedMemory(create=True, size=max(output_size, 1))
+    position = 0
+    for part in parts:
+        output_memory.buf[position:position+len(part)] = part
+        position += len(part)
+    output_name = output_memory.name
+    output_memory.close()
+    return output_name, output_size
+
+
+def default_workers(compression):
+    """
+    :return: number of worker processes to use when not configured: one per core if compression is enabled
+    """
+    cpu_count = os.cpu_count() or 1
+    if compression is True and cpu_count > 1:
+        return cpu_count
+    return 0
+
+
+def assembly_line_init(workers):
+    """
+    initialize the assembly line
+    :param workers: number of worker processes, 0 to encode / decode inline
+    :return: None
+    """
+    global POOL, WORKERS
+
+    WORKERS = workers
+    if workers > 0:
+        POOL = multiprocessing.get_context('spawn').Pool(workers)
@@ -0,0 +1,168 @@
+"""
+black_box provides the protocol capture
+
+every framed message sent or received is recorded (reference -> connection_hub),
+after decryption / before encryption: a captured session can be replayed
+without the keys (reference -> Test Environment/replay)
+
+capture file: MAGIC + records
+record:
+time !d (seconds since epoch, when the message was received / sent)
+direction !B (DIRECTION_IN / DIRECTION_OUT)
+peer ip 4 bytes (inet_aton)
+message type !I (reference -> connection_hub)
+message size !Q (bytes on the wire, header excluded)
+payload kind !B (PAYLOAD_NONE / PAYLOAD_FULL / PAYLOAD_DIGEST)
+payload size !Q
+payload: the message (encoded, reference -> assembly_line), or its digest (blake2b, DIGEST_SIZE)
+
+records are written by the capture thread, off the transfer path, the capture
+queue is bounded by the bytes of the copied messages (QUEUE_CAPACITY), on top of the
+memory budget (reference -> treasury): a disk slower than the transfer slows the
+transfer down
+"""
+import hashlib
+import logging
+import socket
+import struct
+import time
+from queue import Queue
+from threading import Thread, Condition
+import switchboard
+
+MAGIC = b'TDCAP\x00\x01\n'
+RECORD_HEADER = '!dB4sIQBQ'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+
+DIRECTION_IN = 0
+DIRECTION_OUT = 1
+DIRECTION_NAMES = {DIRECTION_IN: 'in', DIRECTION_OUT: 'out'}
+
+PAYLOAD_NONE = 0
+PAYLOAD_FULL = 1
+PAYLOAD_DIGEST = 2
+
+# config
+DIGEST_SIZE = 16
+QUEUE_CAPACITY = 67108864  # 64MB, bytes of the messages waiting to be written before the transfer waits
+FLUSH_INTERVAL = 1  # seconds between two flushes of the capture file
+
+BLACK_BOX = None
+# whether the messages are recorded, can be paused at runtime (reference -> switchboard)
+capturing = False
+
+LOGGER = logging.getLogger(__name__)
+
+
+class BlackBox(Thread):
+    """
+    message_queue format: (time, direction, peer_ip, message_type, message_size, message)
+    self.queued_size: bytes of the messages in the message queue or being written
+    """
+
+    def __init__(self, capture_path, payload):
+        Thread.__init__(self, daemon=True)
+        self.message_queue = Queue(0)
+        self.queued_size = 0
+        self.condition = Condition()
+        self.capture_file = open(capture_path, 'wb')
+        self.payload = payload
+        self.prev_time = time.time()
+
+    def send(self, message):
+        # wait for room, a message larger than the capacity is queued alone
+        size = len(message[-1])
+        with self.condition:
+            self.condition.wait_for(lambda: self.queued_size == 0 or self.queued_size + size <= QUEUE_CAPACITY)
+            self.queued_size += size
+        self.message_queue.put(message)
+
+    def run(self):
+        self.capture_file.write(MAGIC)
+        while True:
+            record_time, direction, peer_ip, message_type, message_size, message = self.message_queue.get()
+            self.message_queue.task_done()
+            size = len(message)
+            if self.payload:
+                payload_kind = PAYLOAD_FULL
+            else:
+                payload_kind = PAYLOAD_DIGEST
+                message = hashlib.blake2b(message, digest_size=DIGEST_SIZE).digest()
+            self.capture_file.write(struct.pack(RECORD_HEADER, record_time, direction, socket.inet_aton(peer_ip),
+                                                message_type, message_size, payload_kind, len(message)))
+            self.capture_file.write(message)
+            with self.condition:
+                self.queued_size -= size
+                self.condition.notify_all()
+            if self.message_queue.empty() or time.time() - self.prev_time > FLUSH_INTERVAL:
+                self.prev_time = time.time()
+                self.capture_file.flush()
+
+
+def is_enabled():
+    return capturing
+
+
+def record(direction, peer_ip, message_type, message_size, message):
+    """
+    record a framed message
+    :param direction: DIRECTION_IN / DIRECTION_OUT
+    :param message_size: bytes on the wire, header excluded
+    :param message: the message, decrypted (in) / not encrypted yet (out)
+    :return: None
+    """
+    BLACK_BOX.send((time.time(), direction, peer_ip, message_type, message_size, bytes(message)))
+
+
+def read(capture_path):
+    """
+    read a capture file
+    :return: generator of (time, direction, peer_ip, message_type, message_size, payload_kind, payload)
+    """
+    with open(capture_path, 'rb') as capture_file:
+        if capture_file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('not a capture file: ' + capture_path)
+        while True:
+            header = capture_file.read(RECORD_HEADER_SIZE)
+            if len(header) < RECORD_HEADER_SIZE:  # end of the capture, or cut while writing
+                return None
+            record_time, direction, peer_ip, message_type, message_size, payload_kind, payload_size = \
+                struct.unpack(RECORD_HEADER, header)
+            payload = capture_file.read(payload_size)
+            if len(payload) < payload_size:
+                return None
+            yield record_time, direction, socket.inet_ntoa(peer_ip), message_type, message_size, payload_kind, \
+                payload
+
+
+def capture_command(argument):
+    global capturing
+
+    if BLACK_BOX is None:
+        raise ValueError('capture disabled, start with --capture-file')
+    if argument == 'on':
+        capturing = True
+    elif argument == 'off':
+        capturing = False
+    elif len(argument) > 0:
+        raise ValueError('usage: capture [on | off]')
+    return 'on' if capturing else 'off'
+
+
+def black_box_init(capture_path, payload):
+    """
+    initialize the black box
+    :param capture_path: the capture file, None to disable the capture
+    :param payload: whether to record the messages, or only their digests
+    :return: None
+    """
+    global BLACK_BOX, capturing
+
+    # runtime control (reference -> switchboard)
+    switchboard.register('capture', capture_command, 'capture [on | off]')
+    if capture_path is None:
+        return None
+    BLACK_BOX = BlackBox(capture_path, payload)
+    BLACK_BOX.start()
+    capturing = True
+    LOGGER.info('capturing to %s', capture_path)
@@ -0,0 +1,86 @@
+"""
+card_catalog provides the concurrent dictionary of the downloads (reference -> download_manager.DOWNLOAD_DICT)
+
+the entries are spread over STRIPES dictionaries by the hash of the key, each with its own lock:
+writers of different stripes do not wait for each other, readers of an entry take no lock at all
+
+iterating (keys, values, items) goes lazily through a snapshot: every stripe keeps a copy of its dictionary,
+made again only once the stripe was written to since, so a snapshot of an unchanged index is free and
+a writer waits at most for the copy of one stripe
+a snapshot is consistent per stripe, an entry added or removed during the snapshot may or may not be in it
+
+the values are shared with the snapshot, not copied: values changed in place are seen by the snapshot
+"""
+from threading import Lock
+
+# config
+STRIPES = 64
+
+STRIPE_DICT = 0
+STRIPE_LOCK = 1
+STRIPE_VERSION = 2
+STRIPE_SNAPSHOT = 3
+STRIPE_SNAPSHOT_VERSION = 4
+
+
+class Catalog:
+    """
+    self.stripes format:
+    [[dict, lock, version, snapshot dict, version of the snapshot]]
+    """
+
+    def __init__(self, stripes=STRIPES):
+        self.stripes = [[{}, Lock(), 0, {}, 0] for _ in range(stripes)]
+
+    def get_stripe(self, key):
+        return self.stripes[hash(key) % len(self.stripes)]
+
+    def __getitem__(self, key):
+        return self.get_stripe(key)[STRIPE_DICT][key]
+
+    def __contains__(self, key):
+        return key in self.get_stripe(key)[STRIPE_DICT]
+
+    def get(self, key, default=None):
+        return self.get_stripe(key)[STRIPE_DICT].get(key, default)
+
+    def __setitem__(self, key, value):
+        stripe = self.get_stripe(key)
+        with stripe[STRIPE_LOCK]:
+            stripe[STRIPE_DICT][key] = value
+            stripe[STRIPE_VERSION] += 1
+
+    def pop(self, key, *default):
+        stripe = self.get_stripe(key)
+        with stripe[STRIPE_LOCK]:
+            value = stripe[STRIPE_DICT].pop(key, *default)
+            stripe[STRIPE_VERSION] += 1
+        return value
+
+    def snapshot(self):
+        """
+        :return: [dict] the snapshots of the stripes, not to be changed
+        """
+        snapshots = []
+        for stripe in self.stripes:
+            if stripe[STRIPE_SNAPSHOT_VERSION] != stripe[STRIPE_VERSION]:
+                with stripe[STRIPE_LOCK]:
+                    stripe[STRIPE_SNAPSHOT] = stripe[STRIPE_DICT].copy()
+                    stripe[STRIPE_SNAPSHOT_VERSION] = stripe[STRIPE_VERSION]
+            snapshots.append(stripe[STRIPE_SNAPSHOT])
+        return snapshots
+
+    def keys(self):
+        return (key for snapshot in self.snapshot() for key in snapshot)
+
+    def values(self):
+        return (value for snapshot in self.snapshot() for value in snapshot.values())
+
+    def items(self):
+        return (item for snapshot in self.snapshot() for item in snapshot.items())
+
+    def __iter__(self):
+        return self.keys()
+
+    def __len__(self):
+        return sum(len(stripe[STRIPE_DICT]) for stripe in self.stripes)
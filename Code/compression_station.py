@@ -1,14 +1,264 @@
 """
 compression_station provides the compress/decompress functions
+
+codecs (stdlib only):
+0 - raw (no compression)
+1 - zlib level 1
+2 - zlib level 6
+3 - zlib level 9
+4 - gzip level 1
+5 - gzip level 6
+6 - gzip level 9
+7 - bz2 level 9
+8 - lzma preset 1
+9 - lzma preset 6
+
+codec negotiation (reference -> connection_hub):
+at connection establishment, each host advertises the codec names it accepts,
+the outbox of the other host picks codecs from the intersection only
+
+codec selection (CodecSelector, one per outbox):
+- incompressible data (judged by compressing a small sample) is sent raw
+- otherwise the codec with the shortest estimated time to compress and send is
+  chosen, based on the measured compression speed / ratio of each codec and the
+  measured link bandwidth
+- with parallel compression (reference -> assembly_line), compressing overlaps
+  sending, so the estimated time is the longer of the two instead of the sum
 """
+import bz2
 import gzip
+import lzma
+import time
+import zlib
+
+CODEC_RAW = 0
+CODEC_ZLIB_1 = 1
+CODEC_ZLIB_6 = 2
+CODEC_ZLIB_9 = 3
+CODEC_GZIP_1 = 4
+CODEC_GZIP_6 = 5
+CODEC_GZIP_9 = 6
+CODEC_BZ2_9 = 7
+CODEC_LZMA_1 = 8
+CODEC_LZMA_6 = 9
+
+"""
+codec dictionary
+
+* CODEC_DICT format:
+{codec: (codec_name, compress_function, decompress_function)}
+"""
+CODEC_DICT = {
+    CODEC_RAW: ('raw', lambda data: data, lambda data: data),
+    CODEC_ZLIB_1: ('zlib-1', lambda data: zlib.compress(data, 1), zlib.decompress),
+    CODEC_ZLIB_6: ('zlib-6', lambda data: zlib.compress(data, 6), zlib.decompress),
+    CODEC_ZLIB_9: ('zlib-9', lambda data: zlib.compress(data, 9), zlib.decompress),
+    CODEC_GZIP_1: ('gzip-1', lambda data: gzip.compress(data, compresslevel=1), gzip.decompress),
+    CODEC_GZIP_6: ('gzip-6', lambda data: gzip.compress(data, compresslevel=6), gzip.decompress),
+    CODEC_GZIP_9: ('gzip-9', lambda data: gzip.compress(data, compresslevel=9), gzip.decompress),
+    CODEC_BZ2_9: ('bz2-9', lambda data: bz2.compress(data, 9), bz2.decompress),
+    CODEC_LZMA_1: ('lzma-1', lambda data: lzma.compress(data, preset=1), lzma.decompress),
+    CODEC_LZMA_6: ('lzma-6', lambda data: lzma.compress(data, preset=6), lzma.decompress),
+}
+CODEC_DICT_NAME = 0
+CODEC_DICT_COMPRESS = 1
+CODEC_DICT_DECOMPRESS = 2
+
+# config
+MIN_SIZE = 1024  # data smaller than this is always sent raw
+SAMPLE_NUM = 4  # number of slices taken from the data for sampling
+SAMPLE_SIZE = 16384  # size of each slice
+INCOMPRESSIBLE_RATIO = 0.9  # sample compressed (zlib-1) to more than this ratio: incompressible
+DEFAULT_BANDWIDTH = 12500000  # 100Mbps, assumed link bandwidth before any measurement
+EWMA_WEIGHT = 0.25  # weight of a new measurement in the moving averages
+PROBE_INTERVAL = 32  # re-probe one codec on the sample every PROBE_INTERVAL compressible messages
 
+# compression setting of this host, set by compression_station_init()
+ENABLED = False
+ENABLED_CODECS = []
 
-def compress(data, compress_level=6):
-    compressed = gzip.compress(data=data, compresslevel=compress_level)
+
+def compress(data, codec=CODEC_GZIP_6):
+    compressed = CODEC_DICT[codec][CODEC_DICT_COMPRESS](data)
     return compressed
 
 
-def decompress(data):
-    decompressed = gzip.decompress(data=data)
+class DecompressionError(Exception):
+    """
+    the data is corrupt or compressed with an unknown codec
+    """
+    pass
+
+
+def decompress(data, codec=CODEC_GZIP_6):
+    """
+    :raise DecompressionError: the data is corrupt or the codec unknown
+    """
+    if codec not in CODEC_DICT:
+        raise DecompressionError('unknown codec: ' + str(codec))
+    try:
+        decompressed = CODEC_DICT[codec][CODEC_DICT_DECOMPRESS](data)
+    except (zlib.error, lzma.LZMAError, OSError, EOFError, ValueError) as e:
+        raise DecompressionError(CODEC_DICT[codec][CODEC_DICT_NAME] + ': ' + str(e)) from e
     return decompressed
+
+
+def get_codec(codec_name):
+    """
+    :param codec_name: the name of the codec, e.g. 'zlib-6'
+    :return: the codec, None if no such codec
+    """
+    for codec in CODEC_DICT:
+        if CODEC_DICT[codec][CODEC_DICT_NAME] == codec_name:
+            return codec
+    return None
+
+
+def get_sample(data):
+    """
+    takes SAMPLE_NUM evenly spaced slices of SAMPLE_SIZE from the data
+    :param data: the data to sample
+    :return: the sample
+    """
+    if len(data) <= SAMPLE_NUM * SAMPLE_SIZE:
+        return data
+    step = (len(data) - SAMPLE_SIZE) // (SAMPLE_NUM - 1)
+    return b''.join(data[i * step:i * step + SAMPLE_SIZE] for i in range(SAMPLE_NUM))
+
+
+def is_compressible(sample):
+    """
+    fast entropy check: compress the sample with zlib level 1
+    :param sample: the sample of the data (reference -> get_sample)
+    :return: whether the data is worth compressing
+    """
+    return len(zlib.compress(sample, 1)) < len(sample) * INCOMPRESSIBLE_RATIO
+
+
+def advertise_message():
+    """
+    the codec negotiation message: names of the accepted codecs, comma separated
+    empty if compression is disabled on this host
+    :return: the encoded message
+    """
+    if ENABLED is False:
+        return b''
+    return ','.join(CODEC_DICT[codec][CODEC_DICT_NAME] for codec in ENABLED_CODECS).encode()
+
+
+def negotiate(message):
+    """
+    :param message: the codec negotiation message from the peer (reference -> advertise_message)
+    :return: the codecs accepted by both hosts
+    """
+    if ENABLED is False or len(message) == 0:
+        return []
+    peer_codecs = [get_codec(codec_name) for codec_name in message.decode().split(',')]
+    return [codec for codec in ENABLED_CODECS if codec in peer_codecs]
+
+
+class CodecSelector:
+    """
+    chooses the codec of each message sent to a peer
+
+    self.codecs: negotiated codecs, [] - send everything raw
+    self.stats: {codec: [speed (bytes/s), ratio (compressed / original)]}
+    self.bandwidth: measured link bandwidth (bytes/s)
+    self.parallelism: number of messages compressed in parallel
+    """
+
+    def __init__(self, parallelism=1):
+        self.codecs = []
+        self.stats = {}
+        self.bandwidth = None
+        self.parallelism = parallelism
+        self.count = 0
+
+    def set_codecs(self, codecs):
+        self.codecs = codecs
+
+    def choose(self, data):
+        """
+        :param data: the data to send
+        :return: the codec to compress the data with
+        """
+        codecs = self.codecs
+        if len(codecs) == 0 or len(data) < MIN_SIZE:
+            return CODEC_RAW
+        sample = get_sample(data)
+        if not is_compressible(sample):
+            return CODEC_RAW
+
+        # probe codecs without statistics, and re-probe one codec every PROBE_INTERVAL
+        for codec in codecs:
+            if codec not in self.stats:
+                self.probe(codec, sample)
+        self.count += 1
+        if self.count % PROBE_INTERVAL == 0:
+            self.probe(codecs[(self.count // PROBE_INTERVAL) % len(codecs)], sample)
+
+        # estimated time = compress time + send time, or the longer of the two if in parallel
+        bandwidth = self.bandwidth if self.bandwidth is not None else DEFAULT_BANDWIDTH
+        best_codec = CODEC_RAW
+        best_time = len(data) / bandwidth
+        for codec in codecs:
+            speed, ratio = self.stats[codec]
+            if self.parallelism > 1:
+                estimated_time = max(len(data) / (speed * self.parallelism), len(data) * ratio / bandwidth)
+            else:
+                estimated_time = len(data) / speed + len(data) * ratio / bandwidth
+            if estimated_time < best_time:
+                best_codec = codec
+                best_time = estimated_time
+        return best_codec
+
+    def probe(self, codec, sample):
+        start_time = time.perf_counter()
+        compressed = compress(sample, codec)
+        self.record(codec, len(sample), len(compressed), time.perf_counter() - start_time)
+
+    def record(self, codec, original_size, compressed_size, seconds):
+        """
+        update the statistics of the codec with a measured compression
+        """
+        if codec == CODEC_RAW:
+            return None
+        speed = original_size / max(seconds, 1e-6)
+        ratio = compressed_size / original_size
+        if codec not in self.stats:
+            self.stats[codec] = [speed, ratio]
+        else:
+            self.stats[codec][0] += EWMA_WEIGHT * (speed - self.stats[codec][0])
+            self.stats[codec][1] += EWMA_WEIGHT * (ratio - self.stats[codec][1])
+
+    def record_send(self, size, seconds):
+        """
+        update the link bandwidth with a measured send
+        :param size: bytes sent
+        :param seconds: time spent sending
+        :return: None
+        """
+        # small sends only measure the socket buffer
+        if size < MIN_SIZE * 64:
+            return None
+        bandwidth = size / max(seconds, 1e-6)
+        if self.bandwidth is None:
+            self.bandwidth = bandwidth
+        else:
+            self.bandwidth += EWMA_WEIGHT * (bandwidth - self.bandwidth)
+
+
+def compression_station_init(compression, codec_names):
+    """
+    initialize the compression station
+    :param compression: whether compression is enabled on this host
+    :param codec_names: names of the accepted codecs, [] for all codecs
+    :return: None
+    """
+    global ENABLED, ENABLED_CODECS
+
+    ENABLED = compression
+    if len(codec_names) == 0:
+        ENABLED_CODECS = [codec for codec in CODEC_DICT if codec != CODEC_RAW]
+    else:
+        ENABLED_CODECS = [get_codec(codec_name) for codec_name in codec_names]
@@ -3,6 +3,7 @@ connection_hub provides the message exchange functions between hosts
 
 message sequence:
 message size (!Q) + message type (!I) + message
+with encryption, every message except encryption is encrypted in records (reference -> encryption_bureau)
 
 message types:
 0 - encryption
@@ -11,6 +12,11 @@ message types:
 3 - file added
 4 - block request
 5 - block
+6 - compression
+7 - partial file
+8 - heartbeat
+9 - stream request
+10 - stream
 
 encryption:
 encryption: ENCRYPTION_NO_ENCRYPTION / ENCRYPTION_WITH_ENCRYPTION
@@ -30,26 +36,90 @@ file_info w/ pickle
 
 block request:
 block_num !Q
+offset !Q (bytes of the block already received)
 file_name w/ encode
 
-block:
-block_num !Q
+block: (one segment of the block, reference -> file_center.SEGMENT_SIZE)
+codec !B (reference -> compression_station)
+compressed with codec:
+    block_num !Q
+    offset !Q
+    block_size !Q
+    file_name_size !Q
+    file_name w/ encode
+    block_digest (reference -> quality_control)
+    segment content
+
+compression:
+accepted codec names w/ encode, comma separated (empty: compression disabled)
+
+partial file: (the sender is downloading the file and relays the downloaded blocks)
 file_name_size !Q
 file_name w/ encode
-block_content
+file_info_size !Q
+file_info w/ pickle
+downloaded block bitmap (bit block_num % 8 of byte block_num // 8)
+
+heartbeat: (reference -> lighthouse)
+kind !B: ping / pong
+sent time !d
+
+stream request: (reference -> moving_van)
+stream_id !Q
+file names w/ pickle
 
-outbox message_queue format:
+stream: (records of the files streamed, reference -> moving_van)
+codec !B (reference -> compression_station)
+compressed with codec:
+    stream_id !Q
+    records
+
+connections: the outbox of each peer connects to the inbox scheduler of the peer, and connects again after a
+backoff once the connection failed or was lost; a connection from the peer replaces its inbox
+(reference -> lighthouse)
+messages queued for the outbox before the connection is established are dropped: the file dict covers
+the files added / modified, and both sides reset the requests sent before (reference -> download_manager)
+
+outbox message_queue (control messages) and bulk_queue (block segments and streams) format:
 (message_type, message)
+block: (MESSAGE_BLOCK, (future of the encoded block segment message, segment size, trace))
+(reference -> service_desk)
+stream: (MESSAGE_STREAM, (future of the encoded stream message, message size, None)) (reference -> moving_van)
+trace: reference -> records_office, None if the block is not traced
+the segment size is acquired from the memory budget, the outbox releases it once the segment is sent (reference -> treasury)
+the bulk messages are only taken from bulk_queue as the codec stage has room: the others stay queued, so that the
+service desk sees the peer busy (reference -> service_desk.OUTBOX_BUSY), control messages overtake them
+
+received messages are acquired from the memory budget before they are received,
+and released once processed (block segments and streams: once written, reference -> download_manager, moving_van)
+
+block segments and streams (bulk messages) are rate limited in both directions, control messages are sent
+before the queued bulk messages (reference -> tollbooth)
+
+messages and bytes sent / received are counted per peer and message type (reference -> observatory)
+the stages of the traced block segments are recorded on both sides (reference -> records_office)
+every message sent and received can be captured for replay (reference -> black_box)
 """
 
+from collections import deque
+from concurrent.futures import wait
 from queue import Queue
-from threading import Thread
+from threading import Thread, Lock, Event
+import logging
+import select
 import socket
 import struct
 import pickle
-import file_center, encryption_bureau, compression_station, main, download_manager
+import time
+import file_center, encryption_bureau, compression_station, download_manager, service_desk, assembly_line, \
+    quality_control, treasury, tollbooth, observatory, records_office, black_box, zoning_board, lighthouse, moving_van, \
+    looking_glass
 
 PORT = 23456
+BIND_IP = ''  # local address of the inbox scheduler and the outboxes, '': any (peers identify each other by it)
+LISTEN_PORT = PORT  # port of the inbox scheduler, another one behind a proxy (reference -> Test Environment/wan_proxy)
+PEER_PORT = PORT  # port of the inbox schedulers of the peers, offset by the shard (reference -> zoning_board)
+IDLE_WAIT = 0.2  # seconds an idle inbox or outbox waits before checking its state again
 
 """
 peer dictionary
@@ -69,12 +139,50 @@ MESSAGE_FILE_MODIFIED = 2
 MESSAGE_FILE_ADDED = 3
 MESSAGE_BLOCK_REQUEST = 4
 MESSAGE_BLOCK = 5
+MESSAGE_COMPRESSION = 6
+MESSAGE_PARTIAL_FILE = 7
+MESSAGE_HEARTBEAT = 8
+MESSAGE_STREAM_REQUEST = 9
+MESSAGE_STREAM = 10
+
+# compressed, rate limited and sent after the control messages
+BULK_MESSAGES = (MESSAGE_BLOCK, MESSAGE_STREAM)
+
+MESSAGE_NAMES = {
+    MESSAGE_ENCRYPTION: 'encryption',
+    MESSAGE_FILE_DICT: 'file_dict',
+    MESSAGE_FILE_MODIFIED: 'file_modified',
+    MESSAGE_FILE_ADDED: 'file_added',
+    MESSAGE_BLOCK_REQUEST: 'block_request',
+    MESSAGE_BLOCK: 'block',
+    MESSAGE_COMPRESSION: 'compression',
+    MESSAGE_PARTIAL_FILE: 'partial_file',
+    MESSAGE_HEARTBEAT: 'heartbeat',
+    MESSAGE_STREAM_REQUEST: 'stream_request',
+    MESSAGE_STREAM: 'stream',
+}
 
 ENCRYPTION_NO_ENCRYPTION = 0
 ENCRYPTION_WITH_ENCRYPTION = 1
 # encryption default: no encryption
 ENCRYPTION_SELF = ENCRYPTION_NO_ENCRYPTION
 
+LOGGER = logging.getLogger(__name__)
+
+# metrics (reference -> observatory), labels: (peer_ip, message type name)
+MESSAGES_RECEIVED = observatory.counter('messages_received_total', 'messages received', ('peer', 'type'))
+BYTES_RECEIVED = observatory.counter('bytes_received_total', 'message bytes received, headers excluded',
+                                     ('peer', 'type'))
+MESSAGES_SENT = observatory.counter('messages_sent_total', 'messages sent', ('peer', 'type'))
+BYTES_SENT = observatory.counter('bytes_sent_total', 'message bytes sent, headers excluded', ('peer', 'type'))
+DECOMPRESSION_FAILURES = observatory.counter('decompression_failures_total', 'messages dropped, failed to decompress',
+                                             ('peer',))
+# labels: (message type name,)
+MESSAGE_SIZE_RECEIVED = observatory.histogram('message_size_received_bytes', 'size of the messages received',
+                                              ('type',), buckets=observatory.SIZE_BUCKETS)
+MESSAGE_SIZE_SENT = observatory.histogram('message_size_sent_bytes', 'size of the messages sent', ('type',),
+                                          buckets=observatory.SIZE_BUCKETS)
+
 
 class Inbox(Thread):
     def __init__(self, inbox_socket, peer_ip):
@@ -83,68 +191,235 @@ class Inbox(Thread):
         self.encryption = ENCRYPTION_SELF
         self.inbox_socket = inbox_socket
         self.peer_ip = peer_ip
+        # time of the connection and of the last data received (reference -> lighthouse)
+        self.connected_time = time.monotonic()
+        self.receive_time = self.connected_time
 
     def is_on(self):
         return self.on
 
     def off(self):
+        """
+        stop, e.g. replaced by a new connection of the peer
+        :return: None
+        """
+        self.on = False
+        # wake up recv
+        try:
+            self.inbox_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def lost(self, reason):
+        """
+        the connection is lost or the peer stopped sending: stop, the download manager sends the outstanding
+        requests to the other peers (reference -> lighthouse)
+        :return: None
+        """
+        # replaced by a new connection: not lost
+        if self.on is False:
+            return None
         self.on = False
+        lighthouse.PEERS_LOST.inc(1, (self.peer_ip, reason))
+        download_manager.peer_lost(self.peer_ip)
 
     def run(self):
         """
-        in case of connection lost (except (ConnectionError, socket.error)): stop
+        in case of connection lost (except (ConnectionError, socket.error)) or nothing received
+        for lighthouse.DEAD_PEER_TIMEOUT: stop
         :return: None
         """
-        print('inbox scheduled', self.peer_ip)
-        # initialize message size, message type and receive buffer
+        LOGGER.info('inbox scheduled: %s', self.peer_ip)
+        # initialize message size, message type, header buffer and message buffer
         message_size = None
         message_type = None
-        receive_buffer = ''.encode()
+        header_buffer = bytearray()
+        message_buffer = bytearray()
+        # decryptor of the current message, None if not encrypted
+        decryptor = None
+        # memory acquired for the current message
+        reserved = 0
+        # time the current message started to arrive, and time spent decrypting it
+        receive_time = 0
+        decrypt_seconds = 0
+        # messages in the codec stage: [(message_type, future, reserved, timing)], in arrival order
+        # timing: (receive_time, received time, decrypt_seconds) of the block segments if tracing, None otherwise
+        pending = deque()
         while True:
             try:
                 # stop if self.on is False
                 if self.on is False:
+                    self.discard(pending, reserved)
                     return None
-                receive_stream = self.inbox_socket.recv(524288)
-                receive_buffer += receive_stream
-                while len(receive_buffer) > 0:
-                    if message_size is None and len(receive_buffer) >= 12:
-                        header = receive_buffer[:12]
-                        message_size, message_type = struct.unpack('!QI', header)
-                        receive_buffer = receive_buffer[12:]
-                    elif message_size is not None and len(receive_buffer) >= message_size:
+                # messages in the codec stage: do not block on recv
+                if len(pending) > 0:
+                    readable, _, _ = select.select([self.inbox_socket], [], [], 0.005)
+                    if len(readable) == 0:
+                        self.process(pending)
+                        continue
+                else:
+                    readable, _, _ = select.select([self.inbox_socket], [], [], IDLE_WAIT)
+                    if len(readable) == 0:
+                        # the peer sends a heartbeat every lighthouse.HEARTBEAT_INTERVAL
+                        if time.monotonic() - self.receive_time > lighthouse.DEAD_PEER_TIMEOUT:
+                            LOGGER.warning('inbox timed out: %s', self.peer_ip)
+                            self.inbox_socket.close()
+                            self.discard(pending, reserved)
+                            self.lost(lighthouse.REASON_TIMEOUT)
+                            return None
+                        continue
+                receive_stream = memoryview(self.inbox_socket.recv(524288))
+                if len(receive_stream) == 0:
+                    raise ConnectionResetError('closed by the peer')
+                self.receive_time = time.monotonic()
+                while len(receive_stream) > 0:
+                    if message_size is None:
+                        # header
+                        header_length = min(12 - len(header_buffer), len(receive_stream))
+                        header_buffer += receive_stream[:header_length]
+                        receive_stream = receive_stream[header_length:]
+                        if len(header_buffer) < 12:
+                            break
+                        message_size, message_type = struct.unpack('!QI', header_buffer)
+                        header_buffer = bytearray()
+                        message_buffer = bytearray()
+                        receive_time = time.time()
+                        decrypt_seconds = 0
+                        # acquire the memory of the message, process the pending messages while waiting
+                        while not treasury.TREASURY.acquire(message_size, treasury.ACCOUNT_RECEIVE, timeout=0.005):
+                            self.process(pending)
+                            if self.on is False:
+                                self.discard(pending, 0)
+                                return None
+                        reserved = message_size
+                        # decrypt the message record by record as it arrives
+                        decryptor = None
+                        if self.encryption == ENCRYPTION_WITH_ENCRYPTION and message_type != MESSAGE_ENCRYPTION:
+                            decryptor = encryption_bureau.Decryptor(message_size)
+                    else:
+                        # message
+                        message_length = min(message_size, len(receive_stream))
+                        if decryptor is not None:
+                            decrypt_time = time.perf_counter()
+                            message_buffer += decryptor.feed(receive_stream[:message_length])
+                            decrypt_seconds += time.perf_counter() - decrypt_time
+                        else:
+                            message_buffer += receive_stream[:message_length]
+                        receive_stream = receive_stream[message_length:]
+                        message_size -= message_length
+                        # block segments and streams: rate limited (reference -> tollbooth)
+                        if message_type in BULK_MESSAGES:
+                            tollbooth.throttle(self.peer_ip, tollbooth.DIRECTION_DOWNLOAD, message_length)
+                        if message_size > 0:
+                            break
                         # unpack message
-                        message = receive_buffer[:message_size]
-                        receive_buffer = receive_buffer[message_size:]
+                        message = bytes(message_buffer)
+                        message_buffer = bytearray()
                         message_size = None
-                        print('inbox: message received from:', self.peer_ip, '\tmessage type:',
-                              message_type, '\tmessage size:', len(message))
-
-                        # decrypt
-                        if self.encryption == ENCRYPTION_WITH_ENCRYPTION and message_type != MESSAGE_ENCRYPTION:
-                            message = encryption_bureau.decrypt(message)
+                        labels = (self.peer_ip, MESSAGE_NAMES.get(message_type, str(message_type)))
+                        MESSAGES_RECEIVED.inc(1, labels)
+                        BYTES_RECEIVED.inc(reserved, labels)
+                        MESSAGE_SIZE_RECEIVED.observe(reserved, labels[1:])
+                        LOGGER.debug('message received from: %s\tmessage type: %d\tmessage size: %d',
+                                     self.peer_ip, message_type, len(message))
+                        if black_box.is_enabled():
+                            black_box.record(black_box.DIRECTION_IN, self.peer_ip, message_type, reserved, message)
 
-                        # process message
                         if message_type == MESSAGE_ENCRYPTION:
+                            # the following messages depend on this message
+                            self.process(pending, wait=True)
                             self.encryption_handler(message)
-                        elif message_type == MESSAGE_FILE_DICT:
-                            self.file_dict_handler(message)
-                        elif message_type == MESSAGE_FILE_MODIFIED or message_type == MESSAGE_FILE_ADDED:
-                            self.file_info_handler(message_type, message)
-                        elif message_type == MESSAGE_BLOCK_REQUEST:
-                            self.block_request_handler(message)
-                        elif message_type == MESSAGE_BLOCK:
-                            self.block_handler(message)
-                    else:
-                        break
+                            treasury.TREASURY.release(reserved, treasury.ACCOUNT_RECEIVE)
+                            reserved = 0
+                            continue
+                        # decompress
+                        decompression = message_type in BULK_MESSAGES
+                        future = assembly_line.submit_decode(message, decompression)
+                        timing = None
+                        if message_type == MESSAGE_BLOCK and records_office.is_enabled():
+                            timing = (receive_time, time.time(), decrypt_seconds if decryptor is not None else None)
+                        pending.append((message_type, future, reserved, timing))
+                        reserved = 0
+                self.process(pending)
 
             except struct.error:
                 continue
+            except encryption_bureau.AuthenticationError as e:  # message not authentic: stop
+                LOGGER.warning('decryption failed: %s %s', self.peer_ip, e)
+                self.inbox_socket.close()
+                self.discard(pending, reserved)
+                self.lost(lighthouse.REASON_CONNECTION_LOST)
+                return None
             except (ConnectionError, TimeoutError, socket.error) as e:  # connection lost: stop
-                print('inbox: connection lost', e)
+                LOGGER.info('inbox connection lost: %s %s', self.peer_ip, e)
                 self.inbox_socket.close()
+                self.discard(pending, reserved)
+                self.lost(lighthouse.REASON_CONNECTION_LOST)
                 return None
 
+    def discard(self, pending, reserved):
+        """
+        release the memory of the current message and the pending messages
+        :return: None
+        """
+        while len(pending) > 0:
+            _, _, pending_reserved, _ = pending.popleft()
+            reserved += pending_reserved
+        treasury.TREASURY.release(reserved, treasury.ACCOUNT_RECEIVE)
+
+    def process(self, pending, wait=False):
+        """
+        process the decoded messages in arrival order
+        :param pending: messages in the codec stage: [(message_type, future, reserved, timing)]
+        :param wait: whether to wait for all pending messages
+        :return: None
+        """
+        while len(pending) > 0 and (wait or pending[0][1].done()):
+            message_type, future, reserved, timing = pending.popleft()
+            # the memory of the message is released here unless handed over
+            handed_over = False
+            try:
+                message = future.result()
+                # block segment: the memory is released by the download manager once written
+                if message_type == MESSAGE_BLOCK:
+                    treasury.TREASURY.resize(reserved, len(message), treasury.ACCOUNT_RECEIVE)
+                    reserved = len(message)
+                    self.block_handler(message, timing)
+                    handed_over = True
+                # stream: the memory is released by the moving van once written
+                elif message_type == MESSAGE_STREAM:
+                    treasury.TREASURY.resize(reserved, len(message), treasury.ACCOUNT_RECEIVE)
+                    reserved = len(message)
+                    self.stream_handler(message)
+                    handed_over = True
+                else:
+                    self.dispatch(message_type, message)
+            except compression_station.DecompressionError as e:
+                # corrupt: dropped, a block is requested again once overdue (reference -> download_manager)
+                LOGGER.warning('decompression failed, message dropped: %s %s %s', self.peer_ip,
+                               MESSAGE_NAMES.get(message_type, str(message_type)), e)
+                DECOMPRESSION_FAILURES.inc(1, (self.peer_ip,))
+            finally:
+                if not handed_over:
+                    treasury.TREASURY.release(reserved, treasury.ACCOUNT_RECEIVE)
+
+    def dispatch(self, message_type, message):
+        # process message
+        if message_type == MESSAGE_FILE_DICT:
+            self.file_dict_handler(message)
+        elif message_type == MESSAGE_FILE_MODIFIED or message_type == MESSAGE_FILE_ADDED:
+            self.file_info_handler(message_type, message)
+        elif message_type == MESSAGE_BLOCK_REQUEST:
+            self.block_request_handler(message)
+        elif message_type == MESSAGE_COMPRESSION:
+            self.compression_handler(message)
+        elif message_type == MESSAGE_PARTIAL_FILE:
+            self.partial_file_handler(message)
+        elif message_type == MESSAGE_HEARTBEAT:
+            self.heartbeat_handler(message)
+        elif message_type == MESSAGE_STREAM_REQUEST:
+            self.stream_request_handler(message)
+
     def encryption_handler(self, message):
         encryption = struct.unpack('!I', message)[0]
         if encryption == ENCRYPTION_WITH_ENCRYPTION:
@@ -154,6 +429,11 @@ class Inbox(Thread):
             outbox_thread = PEER_DICT[self.peer_ip][PEER_DICT_OUTBOX]
             outbox_thread.enable_encryption()
 
+    def compression_handler(self, message):
+        # notify outbox of the codecs accepted by both hosts
+        outbox_thread = PEER_DICT[self.peer_ip][PEER_DICT_OUTBOX]
+        outbox_thread.set_codecs(compression_station.negotiate(message))
+
     def file_dict_handler(self, message):
         file_dict = pickle.loads(message)
 
@@ -170,30 +450,87 @@ class Inbox(Thread):
         package = (self.peer_ip, message_type, download_manager_message)
         download_manager.DOWNLOAD_MANAGER.send(package)
 
+    def partial_file_handler(self, message):
+        file_name_size = struct.unpack('!Q', message[:8])[0]
+        file_name = message[8:8+file_name_size].decode()
+        file_info_size = struct.unpack('!Q', message[8+file_name_size:16+file_name_size])[0]
+        file_info = pickle.loads(message[16+file_name_size:16+file_name_size+file_info_size])
+        bitmap = message[16+file_name_size+file_info_size:]
+        available_blocks = set()
+        for block_num in range(min(len(bitmap) * 8, file_info[file_center.FILE_INFO_NUM_BLOCKS])):
+            if bitmap[block_num // 8] & (1 << (block_num % 8)):
+                available_blocks.add(block_num)
+
+        download_manager_message = (file_name, file_info, available_blocks)
+        package = (self.peer_ip, MESSAGE_PARTIAL_FILE, download_manager_message)
+        download_manager.DOWNLOAD_MANAGER.send(package)
+
+    def heartbeat_handler(self, message):
+        kind, sent_time = lighthouse.unpack(message)
+        outbox_thread = PEER_DICT[self.peer_ip][PEER_DICT_OUTBOX]
+        if kind == lighthouse.HEARTBEAT_PING:
+            # answer through the outbox
+            outbox_thread.send((MESSAGE_HEARTBEAT, lighthouse.pong_message(message)))
+        elif kind == lighthouse.HEARTBEAT_PONG:
+            lighthouse.record_rtt(self.peer_ip, sent_time)
+            outbox_thread.pong()
+
+    def stream_request_handler(self, message):
+        # mirror: nothing is served (reference -> looking_glass)
+        if looking_glass.is_mirror():
+            LOGGER.debug('stream request dropped, mirror: %s', self.peer_ip)
+            return None
+        stream_id = struct.unpack('!Q', message[:8])[0]
+        file_names = pickle.loads(message[8:])
+        outbox_thread = PEER_DICT[self.peer_ip][PEER_DICT_OUTBOX]
+        moving_van.load(self.peer_ip, stream_id, file_names, outbox_thread)
+
+    def stream_handler(self, message):
+        # the memory of the message is released by the moving van once written
+        package = (self.peer_ip, MESSAGE_STREAM, (message, len(message)))
+        moving_van.MOVING_VAN.send(package)
+
     def block_request_handler(self, message):
         # unpack message
-        message_header = message[:8]
-        block_num = struct.unpack('!Q', message_header)[0]
-        file_name = message[8:].decode()
+        message_header = message[:16]
+        block_num, offset = struct.unpack('!QQ', message_header)
+        file_name = message[16:].decode()
+
+        # mirror: nothing is served, the peer requests the block from another peer once overdue
+        # (reference -> looking_glass)
+        if looking_glass.is_mirror():
+            LOGGER.debug('block request dropped, mirror: %s %s %d', self.peer_ip, file_name, block_num)
+            return None
 
         # get outbox thread
         outbox_thread = PEER_DICT[self.peer_ip][PEER_DICT_OUTBOX]
 
-        # reader: (block_num, receive_thread)
-        reader_message = (block_num, outbox_thread)
-        reader = file_center.FILE_DICT[file_name][file_center.FILE_DICT_READER]
-        reader.send(reader_message)
+        # service desk: (peer_ip, block_num, offset, file_name, outbox_thread)
+        service_desk_message = (self.peer_ip, block_num, offset, file_name, outbox_thread)
+        service_desk.SERVICE_DESK.send(service_desk_message)
 
-    def block_handler(self, message):
-        # decompress
-        if main.compression is True:
-            message = compression_station.decompress(message)
+    def block_handler(self, message, timing=None):
         # process message
-        block_num, file_name_size = struct.unpack('!QQ', message[:16])
-        file_name = message[16:16+file_name_size].decode()
-        block = message[16+file_name_size:]
-
-        download_manager_message = (block_num, file_name, block)
+        block_num, offset, block_size, file_name_size = struct.unpack('!QQQQ', message[:32])
+        file_name = bytes(message[32:32+file_name_size]).decode()
+        block_digest = bytes(message[32+file_name_size:32+file_name_size+quality_control.DIGEST_SIZE])
+        # decoded by a worker: a view of the output segment (reference -> assembly_line)
+        segment = message[32+file_name_size+quality_control.DIGEST_SIZE:]
+
+        # trace the segment (reference -> records_office)
+        trace = None
+        if timing is not None:
+            trace = records_office.start(records_office.SIDE_RECEIVE, self.peer_ip, file_name, block_num, offset)
+        if trace is not None:
+            receive_time, received_time, decrypt_seconds = timing
+            trace.span('receive', receive_time, received_time, size=len(segment))
+            if decrypt_seconds is not None:
+                trace.span('decrypt', receive_time, receive_time + decrypt_seconds)
+            trace.span('decode', received_time, trace.mark_time)
+
+        # the memory of the message is released by the download manager once the segment is written
+        download_manager_message = (block_num, offset, block_size, file_name, block_digest, segment, len(message),
+                                    trace)
         package = (self.peer_ip, MESSAGE_BLOCK, download_manager_message)
         download_manager.DOWNLOAD_MANAGER.send(package)
 
@@ -204,107 +541,343 @@ class Outbox(Thread):
         self.on = True
         self.encryption = ENCRYPTION_SELF
         self.message_queue = Queue(0)
+        self.bulk_queue = Queue(0)
+        self.ready = Event()  # a message was queued
         self.peer_ip = peer_ip
+        self.codec_selector = compression_station.CodecSelector(parallelism=max(assembly_line.WORKERS, 1))
+        self.lock = Lock()  # the queues are not sent to once off
+        # connection state (reference -> lighthouse)
+        self.outbox_socket = None
+        self.connected = False
+        self.reconnecting = False
+        self.pong_time = 0  # time.monotonic() of the last pong
+        self.wake = Event()  # cuts the backoff short
 
     def is_on(self):
         return self.on
 
+    def is_connected(self):
+        return self.on and self.connected
+
     def off(self):
-        self.on = False
+        with self.lock:
+            self.on = False
+        self.wake.set()
+
+    def reconnect(self):
+        """
+        drop the connection and connect again, e.g. the peer restarted
+        :return: None
+        """
+        self.reconnecting = True
+        outbox_socket = self.outbox_socket
+        if outbox_socket is not None:
+            # wake up sendall
+            try:
+                outbox_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def probe(self):
+        """
+        the peer connected to this host: connect now if not connected (the peer is back),
+        and again if the peer closed the connection (the peer restarted)
+        :return: None
+        """
+        if not self.connected:
+            self.wake.set()
+        elif self.is_closed():
+            LOGGER.info('outbox connection closed by the peer: %s', self.peer_ip)
+            self.reconnect()
+
+    def is_closed(self):
+        """
+        :return: whether the peer closed the connection, the peer never sends on it: readable means closed
+        """
+        outbox_socket = self.outbox_socket
+        if outbox_socket is None:
+            return False
+        try:
+            readable, _, _ = select.select([outbox_socket], [], [], 0)
+        except (ValueError, OSError):  # closed meanwhile
+            return False
+        return len(readable) > 0
+
+    def pong(self):
+        self.pong_time = time.monotonic()
 
     def enable_encryption(self):
         self.encryption = ENCRYPTION_WITH_ENCRYPTION
 
+    def set_codecs(self, codecs):
+        self.codec_selector.set_codecs(codecs)
+
     def send(self, message):
-        self.message_queue.put(message)
+        with self.lock:
+            # if outbox is recycled, drop the message
+            if self.on is False:
+                release(message)
+                return None
+            if message[0] in BULK_MESSAGES:
+                self.bulk_queue.put(message)
+            else:
+                self.message_queue.put(message)
+        self.ready.set()
 
     def queue_size(self):
-        return self.message_queue.qsize()
+        """
+        :return: the number of messages queued, not in the codec stage yet
+        """
+        return self.message_queue.qsize() + self.bulk_queue.qsize()
+
+    def discard(self, pending):
+        """
+        drop the queued and the pending messages, release their memory
+        :param pending: messages in the codec stage: [(message_type, future, reserved, trace)]
+        :return: None
+        """
+        while len(pending) > 0:
+            _, _, reserved, _ = pending.popleft()
+            treasury.TREASURY.release(reserved, treasury.ACCOUNT_SEND)
+        for message_queue in (self.message_queue, self.bulk_queue):
+            while not message_queue.empty():
+                release(message_queue.get())
+                message_queue.task_done()
 
     def run(self):
         """
-        repeatedly try to connect to target peer
-        in case of connection lost (except (ConnectionError, socket.error)): fall back to try connecting
+        repeatedly try to connect to target peer, waiting for a backoff between two attempts (reference -> lighthouse)
+        in case of connection lost (except (ConnectionError, socket.error)) or heartbeat timeout:
+        fall back to try connecting
         :return: None
         """
-        print('outbox scheduled:', self.peer_ip)
-        outbox_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # try to connect
+        LOGGER.info('outbox scheduled: %s', self.peer_ip)
+        backoff = lighthouse.Backoff()
+        established = False
         while True:
+            # wait for the backoff, cut short by off or by a connection from the peer
+            self.wake.wait(backoff.get_delay())
+            self.wake.clear()
             # stop if self.on is False
             if self.on is False:
-                while not self.message_queue.empty():
-                    self.message_queue.get()
-                    self.message_queue.task_done()
-                self.message_queue.join()
+                self.discard(deque())
                 return None
-            try:
-                outbox_socket.connect((self.peer_ip, PORT))
-                break
-            except (ConnectionError, TimeoutError, socket.error) as e:  # failed to connect
-                print('outbox: failed to connect: ', self.peer_ip, e)
+            self.reconnecting = False
+            outbox_socket = self.connect()
+            if outbox_socket is None:
+                backoff.failed()
+                lighthouse.CONNECTS_FAILED.inc(1, (self.peer_ip,))
                 continue
-
+            if established:
+                lighthouse.RECONNECTS.inc(1, (self.peer_ip,))
+            established = True
+            backoff.connected()
+            reason = self.exchange(outbox_socket)
+            backoff.disconnected()
+            if reason is not None:
+                lighthouse.PEERS_LOST.inc(1, (self.peer_ip, reason))
+            # the requests sent to the peer are lost
+            download_manager.peer_lost(self.peer_ip)
+
+    def connect(self):
+        """
+        :return: the connected socket, None if failed to connect
+        """
+        outbox_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if BIND_IP != '':
+                outbox_socket.bind((BIND_IP, 0))
+            outbox_socket.settimeout(lighthouse.CONNECT_TIMEOUT)
+            outbox_socket.connect((self.peer_ip, PEER_PORT))
+            outbox_socket.settimeout(None)
+            lighthouse.set_keepalive(outbox_socket, send_timeout=True)
+        except (ConnectionError, TimeoutError, socket.error) as e:  # failed to connect
+            LOGGER.debug('failed to connect: %s %s', self.peer_ip, e)
+            outbox_socket.close()
+            return None
+        return outbox_socket
+
+    def exchange(self, outbox_socket):
+        """
+        send the messages over the connection until it is lost
+        :return: reason the connection was lost (reference -> lighthouse), None if stopped or reconnecting
+        """
         # at connection establishment: encryption
         encryption = ENCRYPTION_SELF
         outbox_message = struct.pack('!I', encryption)
         encryption_package = (MESSAGE_ENCRYPTION, outbox_message)
 
+        # at connection establishment: compression
+        outbox_message = compression_station.advertise_message()
+        compression_package = (MESSAGE_COMPRESSION, outbox_message)
+
         # at connection establishment: send file_dict
-        outbox_message = file_center.file_dict_outbox_message()
+        outbox_message = file_center.file_dict_outbox_message(self.peer_ip)
         file_dict_package = (MESSAGE_FILE_DICT, outbox_message)
 
+        # at connection establishment: send the downloaded blocks of new downloads
+        partial_file_packages = [(MESSAGE_PARTIAL_FILE, outbox_message)
+                                 for outbox_message in download_manager.partial_file_outbox_messages(self.peer_ip)]
+
         # organize outbox queue:
-        # unwanted messages: file added / file modified
+        # the messages queued before the connection are dropped
         # make sure the encryption message is the first one in the queue
         organized_message_queue = Queue(0)
         organized_message_queue.put(encryption_package)
+        organized_message_queue.put(compression_package)
         organized_message_queue.put(file_dict_package)
-        while not self.message_queue.empty():
-            package = self.message_queue.get()
-            self.message_queue.task_done()
-            message_type, _ = package
-            if message_type == MESSAGE_FILE_ADDED or message_type == MESSAGE_FILE_MODIFIED:
-                continue
-            else:
-                organized_message_queue.put(package)
-        self.message_queue = organized_message_queue
+        for partial_file_package in partial_file_packages:
+            organized_message_queue.put(partial_file_package)
+        with self.lock:
+            self.discard(deque())
+            self.message_queue = organized_message_queue
+            self.outbox_socket = outbox_socket
+            self.connected = True
+        LOGGER.info('outbox connected: %s', self.peer_ip)
+        # the download manager requests from the peer again
+        download_manager.peer_connected(self.peer_ip)
 
         # connected
+        # messages in the codec stage, in wire order: [(message_type, future, reserved, trace)]
+        # control messages are sent before the block segments (reference -> tollbooth)
+        control = deque()
+        bulk = deque()
+        self.pong_time = time.monotonic()
+        ping_time = 0
+        reason = None
         while True:
             # stop if self.on is False
-            if self.on is False:
-                while not self.message_queue.empty():
-                    self.message_queue.get()
-                    self.message_queue.task_done()
-                self.message_queue.join()
-                return None
-            # check message_queue and send
-            if not self.message_queue.empty():
-                # get message from message_queue
-                package = self.message_queue.get()
+            if self.on is False or self.reconnecting:
+                break
+            # heartbeat (reference -> lighthouse)
+            now = time.monotonic()
+            if now - ping_time >= lighthouse.HEARTBEAT_INTERVAL:
+                ping_time = now
+                if self.is_closed():
+                    LOGGER.info('outbox connection closed by the peer: %s', self.peer_ip)
+                    reason = lighthouse.REASON_CONNECTION_LOST
+                    break
+                # the pongs come through the inbox of the peer: expected once it is up
+                # any data received counts, a pong may wait behind a block segment sent at a limited rate
+                inbox_thread = PEER_DICT[self.peer_ip][PEER_DICT_INBOX]
+                if inbox_thread is not None and inbox_thread.is_on() and \
+                        now - max(self.pong_time, inbox_thread.connected_time, inbox_thread.receive_time) > \
+                        lighthouse.DEAD_PEER_TIMEOUT:
+                    LOGGER.warning('outbox timed out: %s', self.peer_ip)
+                    reason = lighthouse.REASON_TIMEOUT
+                    break
+                control.append((MESSAGE_HEARTBEAT, assembly_line.submit_encode(lighthouse.ping_message()), 0, None))
+            # check the queues and submit to the codec stage, the bulk messages that do not fit stay queued
+            while len(control) < assembly_line.PIPELINE_DEPTH and not self.message_queue.empty():
+                self.stage(self.message_queue.get(), control, bulk)
                 self.message_queue.task_done()
-                message_type, message = package
-                # compression
-                if message_type == MESSAGE_BLOCK and main.compression is True:
-                    message = compression_station.compress(message)
-                # encryption
-                if self.encryption == ENCRYPTION_WITH_ENCRYPTION and message_type != MESSAGE_ENCRYPTION:
-                    message = encryption_bureau.encrypt(message)
-                # header
-                header = struct.pack('!QI', len(message), message_type)
-
-                try:
-                    outbox_socket.send(header)
-                    outbox_socket.send(message)
-                    print('outbox: message sent to:', self.peer_ip, '\tmessage type:',
-                          message_type, '\tmessage size:', len(message))
-                except (ConnectionError, TimeoutError, socket.error) as e:  # connection lost
-                    print('outbox: connection lost', e)
-                    # close the current socket
-                    outbox_socket.close()
-                    # stop
-                    return None
+            while len(bulk) < assembly_line.PIPELINE_DEPTH and not self.bulk_queue.empty():
+                self.stage(self.bulk_queue.get(), control, bulk)
+                self.bulk_queue.task_done()
+            if len(control) > 0:
+                pending = control
+            elif len(bulk) > 0:
+                pending = bulk
+            else:
+                # idle: wait for a message until the next heartbeat
+                self.ready.wait(timeout=max(min(ping_time + lighthouse.HEARTBEAT_INTERVAL - now, IDLE_WAIT), 0))
+                self.ready.clear()
+                continue
+            # send the first message once encoded
+            message_type, future, reserved, trace = pending[0]
+            if not future.done():
+                wait([future], timeout=0.005)
+                continue
+            pending.popleft()
+            try:
+                message, _, _ = future.result()
+            except Exception as e:  # failed to encode, the message is lost (requested again on reconnect)
+                LOGGER.warning('failed to encode: %s', e)
+                treasury.TREASURY.release(reserved, treasury.ACCOUNT_SEND)
+                continue
+            # encryption: encrypt the message record by record as it is sent
+            if self.encryption == ENCRYPTION_WITH_ENCRYPTION and message_type != MESSAGE_ENCRYPTION:
+                send_size = encryption_bureau.get_encrypted_size(len(message))
+                send_stream = encryption_bureau.encrypt_stream(message)
+            else:
+                send_size = len(message)
+                send_stream = [message]
+            # header
+            header = struct.pack('!QI', send_size, message_type)
+
+            try:
+                send_time = time.perf_counter()
+                send_start_time = time.time()
+                outbox_socket.sendall(header)
+                # the records are encrypted while iterating over the stream
+                encrypt_seconds = 0
+                encrypt_time = time.perf_counter()
+                for send_piece in send_stream:
+                    encrypt_seconds += time.perf_counter() - encrypt_time
+                    if message_type not in BULK_MESSAGES:
+                        outbox_socket.sendall(send_piece)
+                        continue
+                    # block segments and streams: rate limited (reference -> tollbooth)
+                    send_piece = memoryview(send_piece)
+                    for chunk_start in range(0, len(send_piece), tollbooth.CHUNK_SIZE):
+                        chunk = send_piece[chunk_start:chunk_start+tollbooth.CHUNK_SIZE]
+                        tollbooth.throttle(self.peer_ip, tollbooth.DIRECTION_UPLOAD, len(chunk))
+                        outbox_socket.sendall(chunk)
+                    encrypt_time = time.perf_counter()
+                self.codec_selector.record_send(send_size, time.perf_counter() - send_time)
+                if trace is not None:
+                    trace.span('outbox', trace.mark_time, send_start_time)
+                    if self.encryption == ENCRYPTION_WITH_ENCRYPTION:
+                        trace.span('encrypt', send_start_time, send_start_time + encrypt_seconds)
+                    trace.span('send', send_start_time, time.time(), size=send_size)
+                labels = (self.peer_ip, MESSAGE_NAMES.get(message_type, str(message_type)))
+                MESSAGES_SENT.inc(1, labels)
+                BYTES_SENT.inc(send_size, labels)
+                MESSAGE_SIZE_SENT.observe(send_size, labels[1:])
+                LOGGER.debug('message sent to: %s\tmessage type: %d\tmessage size: %d',
+                             self.peer_ip, message_type, send_size)
+                if black_box.is_enabled():
+                    black_box.record(black_box.DIRECTION_OUT, self.peer_ip, message_type, send_size, message)
+            except (ConnectionError, TimeoutError, socket.error) as e:  # connection lost
+                LOGGER.info('outbox connection lost: %s %s', self.peer_ip, e)
+                if not self.reconnecting:
+                    reason = lighthouse.REASON_CONNECTION_LOST
+                break
+            finally:
+                treasury.TREASURY.release(reserved, treasury.ACCOUNT_SEND)
+
+        # close the current socket, drop the messages not sent
+        with self.lock:
+            self.connected = False
+            self.outbox_socket = None
+        outbox_socket.close()
+        self.discard(control)
+        self.discard(bulk)
+        return reason
+
+    def stage(self, package, control, bulk):
+        """
+        submit a message of the queue to the codec stage
+        :return: None
+        """
+        message_type, message = package
+        if message_type in BULK_MESSAGES:
+            # blocks are compressed by the service desk, streams by the moving van
+            future, reserved, trace = message
+            bulk.append((message_type, future, reserved, trace))
+        else:
+            control.append((message_type, assembly_line.submit_encode(message), 0, None))
+
+
+def release(package):
+    """
+    release the memory of an outbox package (block segments and streams only)
+    :return: None
+    """
+    message_type, message = package
+    if message_type in BULK_MESSAGES:
+        _, reserved, _ = message
+        treasury.TREASURY.release(reserved, treasury.ACCOUNT_SEND)
 
 
 class IOScheduler(Thread):
@@ -320,44 +893,65 @@ class IOScheduler(Thread):
 
         in case of incoming reconnection
         - accept connection socket
-        - schedule a new outbox thread to replace the current outbox thread
         - schedule a new inbox thread to replace the current inbox thread
         - update peer_dict
 
+        the outbox connects without waiting for its backoff, or again if the peer closed its connection
+        (the peer restarted, reference -> Outbox.probe)
+
         :return: None
         """
         scheduler_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         scheduler_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        scheduler_socket.bind(('', PORT))
+        scheduler_socket.bind((BIND_IP, LISTEN_PORT))
         scheduler_socket.listen(1)
-        print('inbox scheduler is up')
+        LOGGER.info('inbox scheduler is up')
 
         while True:
             inbox_socket, addr = scheduler_socket.accept()  # addr: ('IP', port)
             peer_ip = addr[0]
+            if peer_ip not in PEER_DICT:  # not a peer, e.g. a proxy checking the port
+                LOGGER.warning('connection from unknown host refused: %s', peer_ip)
+                inbox_socket.close()
+                continue
+            lighthouse.set_keepalive(inbox_socket)
             inbox_thread = Inbox(inbox_socket, peer_ip)
-            if PEER_DICT[peer_ip][PEER_DICT_INBOX] is None:  # first connection
-                PEER_DICT[peer_ip][PEER_DICT_INBOX] = inbox_thread
-                inbox_thread.start()
-            else:  # reconnection
-                # stop old threads
-                old_inbox_thread = PEER_DICT[peer_ip][PEER_DICT_INBOX]
-                old_outbox_thread = PEER_DICT[peer_ip][PEER_DICT_OUTBOX]
+            old_inbox_thread = PEER_DICT[peer_ip][PEER_DICT_INBOX]
+            if old_inbox_thread is not None:  # reconnection
+                # stop old thread
                 old_inbox_thread.off()
-                old_outbox_thread.off()
                 old_inbox_thread.join()
-                old_outbox_thread.join()
-                # configure new threads
-                outbox_thread = Outbox(peer_ip)
-                PEER_DICT[peer_ip][PEER_DICT_INBOX] = inbox_thread
-                PEER_DICT[peer_ip][PEER_DICT_OUTBOX] = outbox_thread
-                outbox_thread.start()
-                inbox_thread.start()
-
-
-def connection_hub_init(peer_list, encryption):
+            PEER_DICT[peer_ip][PEER_DICT_INBOX] = inbox_thread
+            inbox_thread.start()
+            PEER_DICT[peer_ip][PEER_DICT_OUTBOX].probe()
+
+
+def is_connected(peer_ip):
+    """
+    :return: whether both connections with the peer are up: requests can be sent and answered
+    """
+    try:
+        inbox_thread, outbox_thread = PEER_DICT[peer_ip]
+    except KeyError:
+        return False
+    return outbox_thread.is_connected() and inbox_thread is not None and inbox_thread.is_on()
+
+
+def connection_hub_init(peer_list, encryption, bind_ip='', listen_port=0):
+    """
+    :param peer_list: [peer_ip]
+    :param encryption: whether to encrypt
+    :param bind_ip: local address, '': any
+    :param listen_port: port of the inbox scheduler, 0: PORT
+    :return: None
+    """
+    global ENCRYPTION_SELF, BIND_IP, LISTEN_PORT, PEER_PORT
+
+    BIND_IP = bind_ip
+    # shard i listens and connects on the ports of shard i (reference -> zoning_board)
+    LISTEN_PORT = zoning_board.shard_port(listen_port if listen_port != 0 else PORT)
+    PEER_PORT = zoning_board.shard_port(PORT)
     # encryption configuration
-    global ENCRYPTION_SELF
     if encryption is True:
         ENCRYPTION_SELF = ENCRYPTION_WITH_ENCRYPTION
     elif encryption is False:
@@ -371,6 +965,13 @@ def connection_hub_init(peer_list, encryption):
         PEER_DICT[peer_ip] = peer_threads
         outbox_thread.start()
 
+    # metrics: messages waiting in the outbox queues
+    observatory.gauge('outbox_queue_messages', 'messages waiting in the outbox queue',
+                      lambda: {(peer_ip,): peer_threads[PEER_DICT_OUTBOX].queue_size()
+                               for peer_ip, peer_threads in list(PEER_DICT.items())}, ('peer',))
+    observatory.gauge('peers_connected', 'peers with both connections up',
+                      lambda: sum(1 for peer_ip in list(PEER_DICT) if is_connected(peer_ip)))
+
     # start the I/O scheduler
     io_scheduler = IOScheduler()
     io_scheduler.start()
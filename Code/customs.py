@@ -0,0 +1,225 @@
+"""
+customs provides the ignore rules, in the gitignore format
+
+node rules (--ignore-file) apply to every path: ignored files and directories are not scanned
+(reference -> file_center -> dispatch), not announced and not accepted from the peers
+peer rules (--peer-ignore) apply to the paths exchanged with one peer only: not announced to the peer
+and not accepted from it (reference -> download_manager)
+
+rules, one per line:
+# comment, blank lines are skipped
+pattern - ignore the matching paths, e.g. *.swp, build/, /cache
+!pattern - include the matching paths again, e.g. selective sync: /* then !/docs/
+a pattern with a / other than a trailing one is relative to the share, one without matches at any depth
+a trailing / matches directories only, * and ? do not match /, ** matches any number of directories
+the last matching rule applies; as with git, a path under an ignored directory cannot be included again
+"""
+import logging
+import re
+import observatory, switchboard
+
+"""
+rule list
+
+* RULE_LIST format:
+[(regex, negate, directory_only, line)]
+"""
+RULE_LIST = []
+
+"""
+peer rules
+
+* PEER_RULES format:
+{peer_ip: [(regex, negate, directory_only, line)]}
+"""
+PEER_RULES = {}
+
+# rule files of the node and the peers, read again by the ignore reload command
+IGNORE_PATH = None
+PEER_IGNORE_PATHS = {}
+
+LOGGER = logging.getLogger(__name__)
+
+# metrics (reference -> observatory)
+PATHS_IGNORED = observatory.counter('paths_ignored_total', 'paths ignored by the ignore rules', ('source',))
+
+
+def parse_rule(line):
+    """
+    :param line: a line of a rule file
+    :return: (regex, negate, directory_only, line), None if the line holds no rule
+    """
+    line = line.rstrip('\n').rstrip()
+    if len(line) == 0 or line.startswith('#'):
+        return None
+    pattern = line
+    negate = pattern.startswith('!')
+    if negate:
+        pattern = pattern[1:]
+    elif pattern.startswith('\\'):  # \# and \! match a leading # or !
+        pattern = pattern[1:]
+    directory_only = pattern.endswith('/')
+    pattern = pattern.rstrip('/')
+    if len(pattern) == 0:
+        return None
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+
+    regex = '' if anchored else '(?:.*/)?'
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+        elif pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+        elif pattern[i] == '*':
+            regex += '[^/]*'
+            i += 1
+        elif pattern[i] == '?':
+            regex += '[^/]'
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            character_class = pattern[i + 1:end]
+            if character_class.startswith('!'):
+                character_class = '^' + character_class[1:]
+            regex += '[' + character_class.replace('\\', '\\\\') + ']'
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile(regex + '$'), negate, directory_only, line
+
+
+def parse_rules(lines):
+    """
+    :param lines: lines of a rule file
+    :return: [(regex, negate, directory_only, line)]
+    """
+    rules = []
+    for line in lines:
+        rule = parse_rule(line)
+        if rule is not None:
+            rules.append(rule)
+    return rules
+
+
+def read_rules(path):
+    """
+    :param path: a rule file
+    :return: [(regex, negate, directory_only, line)]
+    """
+    with open(path) as f:
+        return parse_rules(f.readlines())
+
+
+def match(rules, path, is_directory):
+    """
+    :param path: a path relative to the share, without a trailing /
+    :return: whether the last rule matching the path, if any, ignores it
+    """
+    ignored = False
+    for regex, negate, directory_only, _ in rules:
+        if directory_only and not is_directory:
+            continue
+        if regex.match(path):
+            ignored = not negate
+    return ignored
+
+
+def is_excluded(path, is_directory):
+    """
+    checks the path against the node rules only, its directories are not checked: for the scan,
+    which does not walk ignored directories
+    :param path: a path relative to the share, without a trailing /
+    :return: whether the path is ignored
+    """
+    if len(RULE_LIST) == 0:
+        return False
+    if match(RULE_LIST, path, is_directory):
+        PATHS_IGNORED.inc(1, ('scan',))
+        return True
+    return False
+
+
+def is_ignored(file_name, peer_ip=None):
+    """
+    checks the file and each of its directories against the node rules, and the rules of the peer
+    :param file_name: the name of the file
+    :param peer_ip: the peer the file is exchanged with, None: the node rules only
+    :return: whether the file is ignored
+    """
+    rule_lists = [RULE_LIST]
+    if peer_ip in PEER_RULES:
+        rule_lists.append(PEER_RULES[peer_ip])
+    rule_lists = [rules for rules in rule_lists if len(rules) > 0]
+    if len(rule_lists) == 0:
+        return False
+    directories = file_name.split('/')[:-1]
+    for rules in rule_lists:
+        for i in range(len(directories)):
+            if match(rules, '/'.join(directories[:i + 1]), True):
+                return True
+        if match(rules, file_name, False):
+            return True
+    return False
+
+
+def accepts(peer_ip, file_name):
+    """
+    checks a path announced by a peer
+    :return: whether the file is exchanged with the peer
+    """
+    if is_ignored(file_name, peer_ip):
+        PATHS_IGNORED.inc(1, ('peer',))
+        LOGGER.debug('ignored from %s: %s', peer_ip, file_name)
+        return False
+    return True
+
+
+def load():
+    """
+    read the rule files of the node and the peers
+    :return: None
+    """
+    global RULE_LIST
+
+    RULE_LIST = read_rules(IGNORE_PATH) if IGNORE_PATH is not None else []
+    PEER_RULES.clear()
+    for peer_ip, path in PEER_IGNORE_PATHS.items():
+        PEER_RULES[peer_ip] = read_rules(path)
+    LOGGER.info('ignore rules: %d, peers: %s', len(RULE_LIST),
+                {peer_ip: len(rules) for peer_ip, rules in PEER_RULES.items()})
+
+
+def ignore_command(argument):
+    if argument == 'reload':
+        try:
+            load()
+        except OSError as e:
+            raise ValueError('cannot read the rules: ' + str(e))
+    elif len(argument) > 0:
+        raise ValueError('usage: ignore [reload]')
+    lines = [rule[3] for rule in RULE_LIST]
+    for peer_ip, rules in PEER_RULES.items():
+        lines += [peer_ip + ': ' + rule[3] for rule in rules]
+    return '; '.join(lines)
+
+
+def customs_init(ignore_path, peer_ignore_paths):
+    """
+    initialize the customs
+    :param ignore_path: rule file of the node, None: no rules
+    :param peer_ignore_paths: {peer_ip: rule file}
+    :return: None
+    """
+    global IGNORE_PATH, PEER_IGNORE_PATHS
+
+    IGNORE_PATH = ignore_path
+    PEER_IGNORE_PATHS = peer_ignore_paths
+    load()
+
+    # runtime control (reference -> switchboard)
+    switchboard.register('ignore', ignore_command, 'ignore [reload]')
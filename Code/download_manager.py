@@ -1,25 +1,82 @@
 """
 download_manager provides the download management functions
 supports file_center_7
+
+new downloads are requested block by block from the peers that have the block:
+peers that have the complete file, and peers that are downloading the file
+themselves and advertised the blocks they already have (relays)
+a block is requested from a relay that has it if possible, so that in a chain
+A -> B -> C, C receives the blocks from B while B is still receiving them from A
+blocks only the complete peers have are requested in random order, so that the
+peers downloading the same file get different blocks to relay to each other
+each peer has at most MAX_PEER_REQUESTS outstanding block requests, the files
+take the request slots in the order of the scheduling policy (reference -> timetable)
+
+every received block is checked against the digest it carries (reference ->
+quality_control), hashed as its segments are written so it is not read back,
+a block that fails the check is requested again on its own; the blocks kept
+from a previous run are checked again once, before the file is assembled
+
+blocks arrive in segments (reference -> file_center.SEGMENT_SIZE) that are
+appended to the block in temp as they arrive, the size of the block in temp is
+the number of bytes received: after a reconnection or a restart, the block is
+requested from that offset on instead of from the beginning
+
+block latency (request sent to block complete) and the download progress are
+measured (reference -> observatory)
+
+every request has a deadline derived from the block times measured for the peer (reference -> get_request_timeout),
+which include the wait behind the earlier requests of the peer, restarted by every segment received for the
+request: a peer that stopped sending, or that dropped the request, is overdue, and the block is requested
+again, from another peer if possible; the last outstanding blocks of a file (HEDGE_BLOCKS) are hedged to a
+second peer once slower than expected, the segments of both are appended by offset, so whichever arrives first
+completes the block, and the peer that lost the hedge gets the time waited as a block time (reference ->
+check_requests)
+
+a host far behind a peer (reference -> moving_van.is_far_behind) asks the peer for a stream of the missing files
+instead of downloading them block by block, the files expected from a stream are not downloaded meanwhile,
+unless they fall back to the block downloads (reference -> stream_fallback_handler)
+
+a mirror (reference -> looking_glass) downloads as any host, but does not advertise the downloaded blocks
+
+blocks are only requested from the peers with both connections up; once a peer is lost
+(connection lost or timed out, reference -> lighthouse), the requests sent to it are sent to
+the other peers that have the blocks, and once it is connected again it is requested from again
 """
+import heapq
+import itertools
+import logging
 import math
 import pickle
 import os
+import random
 import struct
 import shutil
-from queue import Queue
+import time
+from queue import Queue, Empty
 from threading import Thread
-import connection_hub, file_center, main
+import connection_hub, file_center, main, quality_control, treasury, timetable, observatory, zoning_board, \
+    customs, card_catalog, moving_van, looking_glass
 
 # config
 TEMP_DOWNLOAD_INFO = 'download_info/'
 TEMP_DOWNLOADING = 'downloading/'
+MAX_PEER_REQUESTS = 8  # maximum number of outstanding block requests per peer
+ADVERTISE_INTERVAL = 0.5  # seconds between two advertisements of the downloaded blocks
+REQUEST_CHECK_INTERVAL = 0.5  # seconds between two checks of the outstanding requests
+INITIAL_REQUEST_TIMEOUT = 30  # seconds without progress before a request is overdue, before any block time is measured
+MIN_REQUEST_TIMEOUT = 5
+MAX_REQUEST_TIMEOUT = 300
+HEDGE_BLOCKS = 2  # outstanding blocks of a file with no block left to request that are hedged
+MAX_BLOCK_CORRUPTIONS = 3  # corrupted copies of a block from a peer before the peer is no longer asked for it
+IDLE_WAIT = 0.1  # maximum seconds waiting for a message before the periodic checks
+MESSAGE_BATCH = 256  # messages handled between two checks of the downloads
 
 """
 download dictionary
 
 * download_dict format:
-{file_name: (file_info, block_info)}
+{file_name: (file_info, block_info, block_digests)}, a concurrent dictionary (reference -> card_catalog)
 
 * file_info format: (reference -> file_center)
 [file_type, mtime, last modified, num_blocks]
@@ -28,10 +85,15 @@ file_type: 'f' - file, 'd' - directory
 * block_info format:
 [block_status, block_status, ...]
 block_status: 0 - to download 1 - downloading 2 - downloaded
+
+* block_digests format:
+[block_digest, block_digest, ...]
+block_digest: digest of the received block (reference -> quality_control), None if not received
 """
-DOWNLOAD_DICT = {}
+DOWNLOAD_DICT = card_catalog.Catalog()
 DOWNLOAD_FILE_INFO = 0
 DOWNLOAD_BLOCK_INFO = 1
+DOWNLOAD_BLOCK_DIGESTS = 2
 
 BLOCK_TO_DOWNLOAD = 0
 BLOCK_DOWNLOADING = 1
@@ -39,9 +101,117 @@ BLOCK_DOWNLOADED = 2
 BLOCK_TO_PARTIAL_UPDATE = 3
 BLOCK_PARTIAL_UPDATING = 4
 BLOCK_PARTIAL_UPDATED = 5
+BLOCK_STATUS_NAMES = {
+    BLOCK_TO_DOWNLOAD: 'to_download',
+    BLOCK_DOWNLOADING: 'downloading',
+    BLOCK_DOWNLOADED: 'downloaded',
+    BLOCK_TO_PARTIAL_UPDATE: 'to_partial_update',
+    BLOCK_PARTIAL_UPDATING: 'partial_updating',
+    BLOCK_PARTIAL_UPDATED: 'partial_updated',
+}
+
+"""
+availability dictionary
+
+* AVAILABILITY_DICT format:
+{file_name: {peer_ip: available_blocks}}
+available_blocks: None - the peer has the complete file, {block_num, ...} - the peer is a relay
+
+* REQUEST_DICT format: outstanding block requests of new downloads and partial updates
+{(file_name, block_num): peer_ip}
+"""
+AVAILABILITY_DICT = {}
+REQUEST_DICT = {}
+
+"""
+request queues: a request only visits the files whose blocks or availability changed (reference -> request_blocks)
+
+* WANTED_DICT format: the new downloads with blocks to request
+{file_name: [key, [block_num, ...]]}
+key: the order of the file (reference -> timetable.get_key) + discovery number (reference -> DISCOVERY_DICT)
+[block_num, ...]: the blocks to download not requested yet, in request order
+
+* PEER_QUEUE_DICT format: the wanted files each peer has
+{peer_ip: [(key, file_name)]}, a heap, the entries of an older key of the file are skipped
+"""
+WANTED_DICT = {}
+PEER_QUEUE_DICT = {}
+
+# files whose blocks or availability changed since the last request, visited again by the next one
+CHANGED_SET = set()
+
+# discovery number of each new download, files of equal keys are requested in discovery order: {file_name: number}
+DISCOVERY_DICT = {}
+DISCOVERY = itertools.count()
+
+# downloads with newly downloaded blocks, the only ones that can be complete (reference -> check_download_complete)
+COMPLETE_CHECK_SET = set()
+
+# downloads read from a previous run, their downloaded blocks are checked on disk before assembly
+RESTORED_SET = set()
+
+"""
+digests of the blocks being received (reference -> block_handler)
+
+* HASHER_DICT format:
+{file_name: {block_num: (hashed_size, hasher)}}
+hashed_size: bytes of the block in temp fed to the hasher (reference -> quality_control.block_hasher), a block
+resumed from a previous run is hashed up to the received size once, then fed by the segments appended
+"""
+HASHER_DICT = {}
+
+# time the last request of each block was sent: {(file_name, block_num): time.monotonic()}
+REQUEST_TIME_DICT = {}
+
+# time the last segment of each outstanding block was received from each peer requested:
+# {(file_name, block_num): {peer_ip: time.monotonic()}}
+PROGRESS_TIME_DICT = {}
+
+# second requests of the last blocks of the files: {(file_name, block_num): (peer_ip, time.monotonic())}
+HEDGE_DICT = {}
+
+# peer of an overdue or corrupted request, avoided when the block is requested again: {(file_name, block_num): peer_ip}
+OVERDUE_DICT = {}
+
+"""
+corrupted copies of the blocks (reference -> block_handler)
+
+* CORRUPT_DICT format:
+{(file_name, block_num): {peer_ip: number of corrupted copies}}
+a peer that sent MAX_BLOCK_CORRUPTIONS corrupted copies of a block is no longer asked for it, once no peer with
+the block is left the download is dropped: started again from the next file_info received of the file
+"""
+CORRUPT_DICT = {}
+
+# time from block request to block complete of each peer, smoothed: {peer_ip: [mean, mean deviation]}
+BLOCK_TIME_DICT = {}
+
+# files with newly downloaded blocks to advertise
+ADVERTISE_SET = set()
 
 DOWNLOAD_MANAGER = None
 
+# messages of the connections to the download manager, not sent over the network
+MESSAGE_PEER_LOST = -1
+MESSAGE_PEER_CONNECTED = -2
+MESSAGE_STREAM_FALLBACK = -3
+MESSAGE_SCHEDULE = -4
+
+LOGGER = logging.getLogger(__name__)
+
+# metrics (reference -> observatory)
+BLOCK_LATENCY = observatory.histogram('block_latency_seconds', 'time from block request to block complete')
+SEGMENTS_WRITTEN = observatory.counter('segments_written_total', 'block segments received and written', ('peer',))
+SEGMENT_BYTES_WRITTEN = observatory.counter('segment_bytes_written_total', 'bytes of the block segments written',
+                                            ('peer',))
+BLOCKS_DOWNLOADED = observatory.counter('blocks_downloaded_total', 'blocks received and verified', ('peer',))
+BLOCKS_CORRUPTED = observatory.counter('blocks_corrupted_total', 'blocks that failed the digest check')
+FILES_DOWNLOADED = observatory.counter('files_downloaded_total', 'files downloaded or partial updated')
+REQUESTS_TIMED_OUT = observatory.counter('block_requests_timed_out_total', 'block requests overdue, requested again',
+                                         ('peer',))
+BLOCKS_HEDGED = observatory.counter('blocks_hedged_total', 'blocks requested from a second peer', ('peer',))
+HEDGES_WON = observatory.counter('hedges_won_total', 'hedged blocks completed by the second peer first', ('peer',))
+
 
 class DownloadManager(Thread):
     """
@@ -57,38 +227,90 @@ class DownloadManager(Thread):
     file dict: file_dict - {file_name: [file_info]}
     file modified: (file_name, [file_info])
     file added: (file_name, [file_info])
-    block: (block_num, file_name, block)
+    block: (block_num, offset, block_size, file_name, block_digest, segment, reserved, trace)
+    reserved: memory of the segment acquired from the budget (reference -> treasury), released once written
+    trace: reference -> records_office, None if the block is not traced
+    partial file: (file_name, [file_info], {block_num, ...})
+    peer lost, peer connected: None (reference -> MESSAGE_PEER_LOST, MESSAGE_PEER_CONNECTED)
+    stream fallback: {file_name: [file_info]} (reference -> MESSAGE_STREAM_FALLBACK)
+    schedule: function changing the timetable (reference -> MESSAGE_SCHEDULE, timetable)
     """
 
     def __init__(self):
         Thread.__init__(self)
         self.message_queue = Queue(0)
+        self.prev_time = time.time()
+        self.check_time = time.monotonic()
 
     def send(self, message):
         self.message_queue.put(message)
 
     def run(self):
         while True:
-            if not self.message_queue.empty():
-                package = self.message_queue.get()
+            # wait for a message until the next check, then handle the queued messages in a batch
+            try:
+                package = self.message_queue.get(timeout=IDLE_WAIT)
+            except Empty:
+                package = None
+            handled = 0
+            while package is not None:
                 self.message_queue.task_done()
-                peer_ip, message_type, message = package
-                if message_type == connection_hub.MESSAGE_FILE_DICT:
-                    file_dict = message
-                    file_dict_handler(peer_ip, file_dict)
-                elif message_type == connection_hub.MESSAGE_FILE_ADDED:
-                    file_name, file_info = message
-                    file_added_handler(peer_ip, file_name, file_info)
-                elif message_type == connection_hub.MESSAGE_FILE_MODIFIED:
-                    file_name, file_info = message
-                    file_modified_handler(peer_ip, file_name, file_info)
-                elif message_type == connection_hub.MESSAGE_BLOCK:
-                    block_num, file_name, block = message
-                    block_handler(block_num, file_name, block)
+                self.handle(package)
+                handled += 1
+                if handled >= MESSAGE_BATCH:
+                    break
+                try:
+                    package = self.message_queue.get_nowait()
+                except Empty:
+                    package = None
 
             # check for completed downloads
             check_download_complete()
 
+            # advertise the newly downloaded blocks every ADVERTISE_INTERVAL
+            if len(ADVERTISE_SET) > 0 and time.time() - self.prev_time > ADVERTISE_INTERVAL:
+                self.prev_time = time.time()
+                for file_name in ADVERTISE_SET:
+                    broadcast_partial_file(file_name)
+                ADVERTISE_SET.clear()
+
+            # re-request the overdue blocks, hedge the last blocks every REQUEST_CHECK_INTERVAL
+            if time.monotonic() - self.check_time > REQUEST_CHECK_INTERVAL:
+                self.check_time = time.monotonic()
+                check_requests()
+
+            # append the index records of the delivered files (reference -> looking_glass)
+            looking_glass.flush_due()
+
+    def handle(self, package):
+        peer_ip, message_type, message = package
+        if message_type == connection_hub.MESSAGE_FILE_DICT:
+            file_dict = message
+            file_dict_handler(peer_ip, file_dict)
+        elif message_type == connection_hub.MESSAGE_FILE_ADDED:
+            file_name, file_info = message
+            file_added_handler(peer_ip, file_name, file_info)
+        elif message_type == connection_hub.MESSAGE_FILE_MODIFIED:
+            file_name, file_info = message
+            file_modified_handler(peer_ip, file_name, file_info)
+        elif message_type == connection_hub.MESSAGE_BLOCK:
+            block_num, offset, block_size, file_name, block_digest, segment, reserved, trace = message
+            try:
+                block_handler(peer_ip, block_num, offset, block_size, file_name, block_digest, segment, trace)
+            finally:
+                treasury.TREASURY.release(reserved, treasury.ACCOUNT_RECEIVE)
+        elif message_type == connection_hub.MESSAGE_PARTIAL_FILE:
+            file_name, file_info, available_blocks = message
+            partial_file_handler(peer_ip, file_name, file_info, available_blocks)
+        elif message_type == MESSAGE_PEER_LOST:
+            peer_lost_handler(peer_ip)
+        elif message_type == MESSAGE_PEER_CONNECTED:
+            peer_connected_handler(peer_ip)
+        elif message_type == MESSAGE_STREAM_FALLBACK:
+            stream_fallback_handler(peer_ip, message)
+        elif message_type == MESSAGE_SCHEDULE:
+            schedule_handler(message)
+
 
 def file_dict_handler(peer_ip, file_dict):
     """
@@ -97,34 +319,83 @@ def file_dict_handler(peer_ip, file_dict):
     :param file_dict:
     :return:
     """
+    # a file dict is sent at connection establishment: requests sent before are lost
+    reset_requests(peer_ip)
+    missing_files = {}
     for file_name in file_dict.keys():
-        if file_name not in file_center.FILE_DICT.keys():
-            if file_name not in DOWNLOAD_DICT.keys():
-                # download hasn't started, schedule new download
-                file_info = file_dict[file_name]
-                new_download(peer_ip, file_name, file_info)
+        if not zoning_board.accepts(peer_ip, file_name) or not customs.accepts(peer_ip, file_name):
+            continue
+        set_available(peer_ip, file_name, None)
+        if file_name not in file_center.FILE_DICT:
+            if file_name not in DOWNLOAD_DICT:
+                # download hasn't started, schedule new download, unless expected from a stream
+                if not moving_van.is_expected(file_name):
+                    missing_files[file_name] = file_dict[file_name]
             else:
                 # download started (downloading or reconnect)
-                _, block_info = DOWNLOAD_DICT[file_name]
+                block_info = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO]
                 if BLOCK_TO_PARTIAL_UPDATE in block_info:  # file was being partial updated
                     # continue to partial update
                     continue_partial_update(peer_ip, file_name)
-                elif BLOCK_TO_DOWNLOAD in block_info:  # file was being downloaded
-                    # continue to download
-                    continue_download(peer_ip, file_name)
-                else:  # file is downloading
+                else:  # file was being downloaded or is downloading: requested below
                     continue
+    # far behind the peer: stream the missing files (reference -> moving_van), with the remaining files of the
+    # stream from the peer, as the stream sent before is lost too
+    if moving_van.is_far_behind(len(missing_files)):
+        moving_van.start_stream(peer_ip, missing_files)
+    else:
+        moving_van.restart(peer_ip)
+        for file_name, file_info in missing_files.items():
+            new_download(peer_ip, file_name, file_info, request=False)
+    # send block requests once all files are scheduled, in the order of the scheduling policy
+    request_blocks()
 
 
 def file_added_handler(peer_ip, file_name, file_info):
-    if file_name not in file_center.FILE_DICT.keys():
-        if file_name not in DOWNLOAD_DICT.keys():
+    if not zoning_board.accepts(peer_ip, file_name) or not customs.accepts(peer_ip, file_name):
+        return None
+    set_available(peer_ip, file_name, None)
+    # expected from a stream (reference -> moving_van)
+    if moving_van.is_expected(file_name):
+        return None
+    if file_name not in file_center.FILE_DICT:
+        if file_name not in DOWNLOAD_DICT:
             # download hasn't started, schedule new download
             new_download(peer_ip, file_name, file_info)
+        else:
+            # download started (e.g. the peer was a relay and completed the file)
+            request_blocks()
+
+
+def partial_file_handler(peer_ip, file_name, file_info, available_blocks):
+    """
+    the peer is downloading the file and has the available blocks
+    """
+    if not zoning_board.accepts(peer_ip, file_name) or not customs.accepts(peer_ip, file_name):
+        return None
+    if file_name in file_center.FILE_DICT or moving_van.is_expected(file_name):
+        return None
+    if file_name not in DOWNLOAD_DICT:
+        # download hasn't started, schedule new download
+        set_available(peer_ip, file_name, available_blocks)
+        new_download(peer_ip, file_name, file_info)
+        return None
+    # download started: relay only if the same version is being downloaded as a new download
+    download_file_info, block_info, _ = DOWNLOAD_DICT[file_name]
+    if download_file_info != file_info or BLOCK_PARTIAL_UPDATED in block_info or \
+            BLOCK_TO_PARTIAL_UPDATE in block_info or BLOCK_PARTIAL_UPDATING in block_info:
+        return None
+    if AVAILABILITY_DICT.get(file_name, {}).get(peer_ip, set()) is None:  # the peer has the complete file
+        return None
+    set_available(peer_ip, file_name, available_blocks)
+    request_blocks()
 
 
 def file_modified_handler(peer_ip, file_name, file_info):
-    if file_name in file_center.FILE_DICT.keys():
+    if not zoning_board.accepts(peer_ip, file_name) or not customs.accepts(peer_ip, file_name):
+        return None
+    if file_name in file_center.FILE_DICT:
+        set_available(peer_ip, file_name, None)
         # file exists, initialize partial update
         new_partial_update(peer_ip, file_name, file_info)
     else:
@@ -132,46 +403,163 @@ def file_modified_handler(peer_ip, file_name, file_info):
         file_added_handler(peer_ip, file_name, file_info)
 
 
-def block_handler(block_num, file_name, block):
+def peer_lost_handler(peer_ip):
+    """
+    the connection with the peer is lost or timed out: send the requests to the other peers
+    """
+    reset_requests(peer_ip)
+    moving_van.suspend(peer_ip)
+    mark_peer(peer_ip)
+    request_blocks()
+    request_partial_updates()
+
+
+def peer_connected_handler(peer_ip):
+    """
+    the outbox of the peer is connected: the peer can be requested from again
+    """
+    moving_van.resume(peer_ip)
+    mark_peer(peer_ip)
+    request_blocks()
+    request_partial_updates()
+
+
+def stream_fallback_handler(peer_ip, file_infos):
+    """
+    files expected from a stream from the peer that are not received by stream (reference -> moving_van):
+    download them block by block
+    :param file_infos: {file_name: file_info}
+    """
+    for file_name, file_info in file_infos.items():
+        if file_name in file_center.FILE_DICT or file_name in DOWNLOAD_DICT or moving_van.is_expected(file_name):
+            continue
+        new_download(peer_ip, file_name, file_info, request=False)
+    request_blocks()
+
+
+def schedule_handler(change):
+    """
+    :param change: function changing the timetable
+    :return: None
+    """
+    change()
+    reorder()
+
+
+def block_handler(peer_ip, block_num, offset, block_size, file_name, block_digest, segment, trace=None):
+    if trace is not None:
+        trace.span('dispatch', trace.mark_time, time.time())
+        trace.mark()
     # retrieve block info
     try:
-        block_info = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO]
-    except IndexError as e:
-        print('download manager: block handler: no such downloading file:', file_name, e)
+        _, block_info, block_digests = DOWNLOAD_DICT[file_name]
+    except (KeyError, IndexError) as e:
+        LOGGER.debug('block handler: no such downloading file: %s %s', file_name, e)
+        return None
+    # only the blocks downloading or partial updating are saved
+    if block_info[block_num] != BLOCK_DOWNLOADING and block_info[block_num] != BLOCK_PARTIAL_UPDATING:
+        return None
+    # the request makes progress, even if the segment is not saved (e.g. behind the hedge): restart its deadline
+    request = (file_name, block_num)
+    PROGRESS_TIME_DICT.setdefault(request, {})[peer_ip] = time.monotonic()
+    # the segment must continue the received part of the block (e.g. not from before a reconnection)
+    if offset != get_received_size(file_name, block_num):
+        return None
+    # append the segment to the block in temp, then feed it to the digest of the block
+    hasher = get_block_hasher(file_name, block_num, offset)
+    with open(main.TEMP_DIR + TEMP_DOWNLOADING + file_name + '_block' + str(block_num), 'ab') as f:
+        f.write(segment)
+    hasher.update(segment)
+    HASHER_DICT.setdefault(file_name, {})[block_num] = (offset + len(segment), hasher)
+    if trace is not None:
+        trace.span('write', trace.mark_time, time.time(), size=len(segment))
+        trace.mark()
+    SEGMENTS_WRITTEN.inc(1, (peer_ip,))
+    SEGMENT_BYTES_WRITTEN.inc(len(segment), (peer_ip,))
+    if offset + len(segment) < block_size:
         return None
-    # if the block is downloading or partial updating, save and update download_dict
-    if block_info[block_num] == BLOCK_DOWNLOADING or block_info[block_num] == BLOCK_PARTIAL_UPDATING:
-        # write block to temp
-        f = open(main.TEMP_DIR + TEMP_DOWNLOADING + file_name + '_block' + str(block_num), 'wb')
-        f.write(block)
-        f.close()
-        # update download_dict
+
+    # the block is complete: the request and its hedge are answered
+    request_peer_ip = REQUEST_DICT.pop(request, None)
+    hedge = HEDGE_DICT.pop(request, None)
+    answered = request_peer_ip is not None or hedge is not None
+    request_time = REQUEST_TIME_DICT.pop(request, None)
+    OVERDUE_DICT.pop(request, None)
+    PROGRESS_TIME_DICT.pop(request, None)
+    if hedge is not None and hedge[0] == peer_ip and request_peer_ip != peer_ip:
+        HEDGES_WON.inc(1, (peer_ip,))
+        # the primary peer lost the hedge: its block time is at least the time waited so far
+        if request_peer_ip is not None and request_time is not None:
+            record_block_time(request_peer_ip, time.monotonic() - request_time)
+        request_time = hedge[1]
+    if request_time is not None:
+        BLOCK_LATENCY.observe(time.monotonic() - request_time)
+        record_block_time(peer_ip, time.monotonic() - request_time)
+    # the block is corrupted: request the block again, preferably from another peer
+    forget_hasher(file_name, block_num)
+    intact = block_digest is None or hasher.digest() == block_digest
+    if trace is not None:
+        trace.span('verify', trace.mark_time, time.time(), intact=intact)
+    if not intact:
+        LOGGER.warning('digest mismatch: %s block %d from %s', file_name, block_num, peer_ip)
+        BLOCKS_CORRUPTED.inc()
+        discard_block(file_name, block_num)
+        corruptions = CORRUPT_DICT.setdefault(request, {})
+        corruptions[peer_ip] = corruptions.get(peer_ip, 0) + 1
+        if not has_block_source(file_name, block_num):
+            LOGGER.warning('no peer left for %s block %d: download dropped', file_name, block_num)
+            drop_download(file_name)
+            return None
         if block_info[block_num] == BLOCK_DOWNLOADING:
-            download_info_update(file_name, block_num, block_status=BLOCK_DOWNLOADED)
+            OVERDUE_DICT[request] = peer_ip
+            download_info_update(file_name, block_num, block_status=BLOCK_TO_DOWNLOAD, write=False)
+            request_blocks()
         elif block_info[block_num] == BLOCK_PARTIAL_UPDATING:
-            download_info_update(file_name, block_num, block_status=BLOCK_PARTIAL_UPDATED)
+            download_info_update(file_name, block_num, block_status=BLOCK_TO_PARTIAL_UPDATE, write=False)
+            request_partial_update(file_name)
+        return None
+    CORRUPT_DICT.pop(request, None)
+    if answered:
+        request_blocks()
+    BLOCKS_DOWNLOADED.inc(1, (peer_ip,))
+    # update download_dict
+    block_digests[block_num] = block_digest
+    if block_info[block_num] == BLOCK_DOWNLOADING:
+        download_info_update(file_name, block_num, block_status=BLOCK_DOWNLOADED)
+        ADVERTISE_SET.add(file_name)
+    elif block_info[block_num] == BLOCK_PARTIAL_UPDATING:
+        download_info_update(file_name, block_num, block_status=BLOCK_PARTIAL_UPDATED)
 
 
 def check_download_complete():
-    file_names = list(DOWNLOAD_DICT.keys())
-    for file_name in file_names:
-        file_info, block_info = DOWNLOAD_DICT[file_name]
+    # only the downloads with newly downloaded blocks can be complete
+    while len(COMPLETE_CHECK_SET) > 0:
+        file_name = COMPLETE_CHECK_SET.pop()
+        if file_name not in DOWNLOAD_DICT:
+            continue
+        file_info, block_info, _ = DOWNLOAD_DICT[file_name]
         # check download finished: no to download & downloading & to partial update & partial updating
         if BLOCK_TO_DOWNLOAD in block_info or BLOCK_DOWNLOADING in block_info or \
                 BLOCK_TO_PARTIAL_UPDATE in block_info or BLOCK_PARTIAL_UPDATING in block_info:
             continue
+        # blocks kept from a previous run: check them on disk once, the corrupted blocks are requested again
+        if file_name in RESTORED_SET:
+            RESTORED_SET.discard(file_name)
+            if not check_blocks(file_name):
+                continue
         if BLOCK_PARTIAL_UPDATED not in block_info:  # downloaded: partial updated not in block_info
             # assemble file
             with open(main.TEMP_DIR + TEMP_DOWNLOADING + file_name, 'wb') as f:
                 for block_num in range(len(block_info)):
                     with open(main.TEMP_DIR + TEMP_DOWNLOADING + file_name + '_block' + str(block_num), 'rb') as r:
-                        block = r.read()
-                        f.write(block)
+                        shutil.copyfileobj(r, f, file_center.SEGMENT_SIZE)
             # call file_center.add_file(file_name, file_info)
             file_center.add_file(file_name, file_info)
             # delete blocks
             for block_num in range(len(block_info)):
                 os.remove(main.TEMP_DIR + TEMP_DOWNLOADING + file_name + '_block' + str(block_num))
+            # the peers relayed by this host can request the complete file now
+            file_center.broadcast_file_added(file_name)
         else:  # partial updated: partial updated in block_info
             # call file_center.update_file(file_name, file_info)
             file_center.update_file(file_name, file_info)
@@ -182,54 +570,526 @@ def check_download_complete():
                 else:
                     break
         # delete download_info from download_dict and file
-        DOWNLOAD_DICT.pop(file_name)
-        os.remove(main.TEMP_DIR + TEMP_DOWNLOAD_INFO + file_name)
+        download_dict_remove(file_name)
+        FILES_DOWNLOADED.inc()
+        LOGGER.info('downloaded: %s', file_name)
 
 
-def new_download(peer_ip, file_name, file_info):
-    # create file directory if not exist
+def drop_download(file_name):
+    """
+    drop a download with a block no peer sends intact, e.g. the file changed on the peers:
+    the download starts again from the next file_info received of the file, by a file dict, file added or
+    file modified message
+    :return: None
+    """
+    block_info = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO]
+    for block_num in range(len(block_info)):
+        discard_block(file_name, block_num)
+        request = (file_name, block_num)
+        REQUEST_DICT.pop(request, None)
+        REQUEST_TIME_DICT.pop(request, None)
+        HEDGE_DICT.pop(request, None)
+        OVERDUE_DICT.pop(request, None)
+        PROGRESS_TIME_DICT.pop(request, None)
+    download_dict_remove(file_name)
+
+
+def has_block_source(file_name, block_num):
+    """
+    :return: whether a peer with the block is still asked for it (reference -> CORRUPT_DICT)
+    """
+    block_info = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO]
+    partial_update = block_info[block_num] == BLOCK_PARTIAL_UPDATING or block_info[block_num] == BLOCK_TO_PARTIAL_UPDATE
+    for peer_ip, available_blocks in AVAILABILITY_DICT.get(file_name, {}).items():
+        if available_blocks is not None and (partial_update or block_num not in available_blocks):
+            continue
+        if not is_avoided(file_name, block_num, peer_ip):
+            return True
+    return False
+
+
+def is_avoided(file_name, block_num, peer_ip):
+    """
+    :return: whether the peer is no longer asked for the block, having sent it corrupted too often
+    """
+    return CORRUPT_DICT.get((file_name, block_num), {}).get(peer_ip, 0) >= MAX_BLOCK_CORRUPTIONS
+
+
+def check_blocks(file_name):
+    """
+    check the downloaded blocks of a file against their digests
+    the corrupted blocks are deleted and requested again
+    :return: whether all blocks are intact
+    """
+    _, block_info, block_digests = DOWNLOAD_DICT[file_name]
+    corrupted_blocks = []
+    for block_num in range(len(block_info)):
+        if block_info[block_num] != BLOCK_DOWNLOADED and block_info[block_num] != BLOCK_PARTIAL_UPDATED:
+            continue
+        # blocks of a partial update are written from the first block on (reference -> overwrite)
+        if block_info[block_num] == BLOCK_DOWNLOADED and BLOCK_PARTIAL_UPDATED in block_info:
+            break
+        try:
+            received_size = os.path.getsize(main.TEMP_DIR + TEMP_DOWNLOADING + file_name + '_block' + str(block_num))
+            hasher = get_block_hasher(file_name, block_num, received_size)
+            intact = block_digests[block_num] is None or hasher.digest() == block_digests[block_num]
+        except FileNotFoundError:
+            intact = False
+        if not intact:
+            corrupted_blocks.append(block_num)
+    if len(corrupted_blocks) == 0:
+        return True
+
+    LOGGER.warning('corrupted blocks: %s %s', file_name, corrupted_blocks)
+    BLOCKS_CORRUPTED.inc(len(corrupted_blocks))
+    for block_num in corrupted_blocks:
+        block_digests[block_num] = None
+        discard_block(file_name, block_num)
+        if block_info[block_num] == BLOCK_DOWNLOADED:
+            download_info_update(file_name, block_num, block_status=BLOCK_TO_DOWNLOAD, write=False)
+        else:
+            download_info_update(file_name, block_num, block_status=BLOCK_TO_PARTIAL_UPDATE, write=False)
+    download_info_write(file_name)
+    request_blocks()
+    request_partial_update(file_name)
+    return False
+
+
+def new_download(peer_ip, file_name, file_info, request=True):
+    # create file directory if not exist, the shards share the file directory (reference -> zoning_board)
     file_location = file_name[:len(file_name) - len(file_name.split('/')[-1])]
-    if not os.path.exists(main.FILE_DIR + file_location):
-        os.makedirs(main.FILE_DIR + file_location)
-    if not os.path.exists(main.TEMP_DIR + TEMP_DOWNLOADING + file_location):
-        os.makedirs(main.TEMP_DIR + TEMP_DOWNLOADING + file_location)
-    # set up download entry
+    os.makedirs(main.FILE_DIR + file_location, exist_ok=True)
+    os.makedirs(main.TEMP_DIR + TEMP_DOWNLOADING + file_location, exist_ok=True)
+    # set up download entry, without the blocks in temp of an earlier download
     num_blocks = file_info[file_center.FILE_INFO_NUM_BLOCKS]
-    block_info = [BLOCK_DOWNLOADING for _ in range(num_blocks)]
-    download_dict_add(file_name, file_info, block_info, write=True)
-    # send block request
     for block_num in range(num_blocks):
-        send_block_request(peer_ip, block_num, file_name)
+        discard_block(file_name, block_num)
+    block_info = [BLOCK_TO_DOWNLOAD for _ in range(num_blocks)]
+    block_digests = [None for _ in range(num_blocks)]
+    download_dict_add(file_name, file_info, block_info, block_digests, write=True)
+    # the peer has the complete file unless it is a relay
+    if peer_ip not in AVAILABILITY_DICT.get(file_name, {}):
+        set_available(peer_ip, file_name, None)
+    # advertise the download to the other peers
+    broadcast_partial_file(file_name)
+    # send block requests
+    if request is True:
+        request_blocks()
 
 
 def new_partial_update(peer_ip, file_name, file_info):
+    # create the temp directory if not exist, the file may have been indexed without being downloaded
+    file_location = file_name[:len(file_name) - len(file_name.split('/')[-1])]
+    os.makedirs(main.TEMP_DIR + TEMP_DOWNLOADING + file_location, exist_ok=True)
     num_blocks = file_info[file_center.FILE_INFO_NUM_BLOCKS]
     num_partial_update = math.ceil(num_blocks * 0.002)
     # start new partial update
     block_info = [BLOCK_DOWNLOADED for _ in range(num_blocks)]
-    download_dict_add(file_name, file_info, block_info, write=True)
+    block_digests = [None for _ in range(num_blocks)]
+    download_dict_add(file_name, file_info, block_info, block_digests, write=True)
     for block_num in range(num_partial_update):
-        block_info[block_num] = BLOCK_PARTIAL_UPDATING
-        # send block request
-        send_block_request(peer_ip, block_num, file_name)
+        discard_block(file_name, block_num)
+        block_info[block_num] = BLOCK_TO_PARTIAL_UPDATE
+    continue_partial_update(peer_ip, file_name)
+
+
+def request_blocks():
+    """
+    request the blocks to download of the new downloads from the peers that have them,
+    in the order of the scheduling policy (reference -> timetable): each request goes to the first file in the
+    order among the queues of the peers with a free request slot
+    the files that changed are queued again first, the other files are not visited: a request costs the same
+    whatever the number of downloads
+    :return: None
+    """
+    while len(CHANGED_SET) > 0:
+        queue_wanted(CHANGED_SET.pop())
 
+    # count the outstanding requests of each peer
+    peer_requests = get_peer_requests()
 
-def continue_download(peer_ip, file_name):
-    _, block_info = DOWNLOAD_DICT[file_name]
+    while True:
+        # the first file among the queues of the connected peers with a free request slot
+        first = None
+        for peer_ip, peer_queue in PEER_QUEUE_DICT.items():
+            if peer_requests.get(peer_ip, 0) >= MAX_PEER_REQUESTS or not is_connected(peer_ip):
+                continue
+            while len(peer_queue) > 0 and not is_queued(peer_ip, peer_queue[0]):
+                heapq.heappop(peer_queue)
+            if len(peer_queue) > 0 and (first is None or peer_queue[0] < first[0]):
+                first = (peer_queue[0], peer_ip)
+        # every peer is busy, or has nothing to request
+        if first is None:
+            break
+        (_, file_name), queue_peer_ip = first
+        if not request_block(file_name, peer_requests):
+            # no block of the file can be requested from the free peers (e.g. the relays with the blocks are busy):
+            # the file leaves the queue of the peer until its blocks or availability change
+            heapq.heappop(PEER_QUEUE_DICT[queue_peer_ip])
+
+
+def request_block(file_name, peer_requests):
+    """
+    request the first block of a wanted file that a connected peer with a free request slot has
+    :param peer_requests: {peer_ip: number of outstanding requests}, updated
+    :return: whether a block was requested
+    """
+    wanted = WANTED_DICT[file_name]
+    key, block_nums = wanted
+    file_info, block_info, _ = DOWNLOAD_DICT[file_name]
+    availability = {peer_ip: available_blocks for peer_ip, available_blocks
+                    in AVAILABILITY_DICT.get(file_name, {}).items() if is_connected(peer_ip)}
+    for i in range(len(block_nums)):
+        block_num = block_nums[i]
+        # the relays with the block, or the complete peers if no relay has it
+        candidates = [peer_ip for peer_ip in availability
+                      if availability[peer_ip] is not None and block_num in availability[peer_ip]]
+        if len(candidates) == 0:
+            candidates = [peer_ip for peer_ip in availability if availability[peer_ip] is None]
+        candidates = [peer_ip for peer_ip in candidates if peer_requests.get(peer_ip, 0) < MAX_PEER_REQUESTS
+                      and not is_avoided(file_name, block_num, peer_ip)]
+        if len(candidates) == 0:
+            continue
+        # the least busy peer, the peer of an overdue or corrupted request of the block last
+        overdue_peer_ip = OVERDUE_DICT.get((file_name, block_num))
+        peer_ip = min(candidates, key=lambda candidate: (candidate == overdue_peer_ip,
+                                                         peer_requests.get(candidate, 0)))
+        # send block request, the block stays to download until requested again (reference -> download_dict_read)
+        if send_block_request(peer_ip, block_num, file_name) is False:
+            return False
+        block_info[block_num] = BLOCK_DOWNLOADING
+        OVERDUE_DICT.pop((file_name, block_num), None)
+        peer_requests[peer_ip] = peer_requests.get(peer_ip, 0) + 1
+        del block_nums[i]
+        if len(block_nums) == 0:
+            WANTED_DICT.pop(file_name)
+            return True
+        # the order of the file may change, e.g. one more block in flight (reference -> timetable.get_key)
+        new_key = timetable.get_key(file_name, file_info, block_info) + (DISCOVERY_DICT[file_name],)
+        if new_key != key:
+            wanted[0] = new_key
+            queue_file(file_name, new_key)
+        return True
+    return False
+
+
+def queue_wanted(file_name):
+    """
+    list the blocks to request of a file that changed, and queue the file to the peers that have it
+    :return: None
+    """
+    WANTED_DICT.pop(file_name, None)
+    download = DOWNLOAD_DICT.get(file_name)
+    if download is None:
+        return None
+    file_info, block_info, _ = download
+    availability = AVAILABILITY_DICT.get(file_name, {})
+    relays = [peer_ip for peer_ip in availability if availability[peer_ip] is not None]
+    # blocks relays have first, then the other blocks in random order
+    relayed_blocks = []
+    other_blocks = []
     for block_num in range(len(block_info)):
-        if block_info[block_num] == BLOCK_TO_DOWNLOAD:
-            block_info[block_num] = BLOCK_DOWNLOADING
-            # send block request
-            send_block_request(peer_ip, block_num, file_name)
+        if block_info[block_num] != BLOCK_TO_DOWNLOAD:
+            continue
+        if any(block_num in availability[peer_ip] for peer_ip in relays):
+            relayed_blocks.append(block_num)
+        else:
+            other_blocks.append(block_num)
+    if len(relayed_blocks) + len(other_blocks) == 0:
+        return None
+    random.shuffle(other_blocks)
+    if file_name not in DISCOVERY_DICT:
+        DISCOVERY_DICT[file_name] = next(DISCOVERY)
+    key = timetable.get_key(file_name, file_info, block_info) + (DISCOVERY_DICT[file_name],)
+    WANTED_DICT[file_name] = [key, relayed_blocks + other_blocks]
+    queue_file(file_name, key)
+
+
+def queue_file(file_name, key):
+    """
+    queue a wanted file to the peers that have it, the queues holding mostly outdated entries are cleaned up
+    :return: None
+    """
+    for peer_ip in AVAILABILITY_DICT.get(file_name, {}):
+        peer_queue = PEER_QUEUE_DICT.setdefault(peer_ip, [])
+        heapq.heappush(peer_queue, (key, file_name))
+        if len(peer_queue) > 2 * len(WANTED_DICT) + 64:
+            peer_queue = [entry for entry in set(peer_queue) if is_queued(peer_ip, entry)]
+            heapq.heapify(peer_queue)
+            PEER_QUEUE_DICT[peer_ip] = peer_queue
+
+
+def is_queued(peer_ip, entry):
+    """
+    :param entry: (key, file_name) of the queue of the peer
+    :return: whether the entry is current: the file is wanted with this key and the peer has it
+    """
+    key, file_name = entry
+    wanted = WANTED_DICT.get(file_name)
+    return wanted is not None and wanted[0] == key and peer_ip in AVAILABILITY_DICT.get(file_name, {})
+
+
+def mark_changed(file_name):
+    """
+    the blocks or the availability of the download changed: visited again by the next request
+    :return: None
+    """
+    CHANGED_SET.add(file_name)
+
+
+def reorder():
+    """
+    the scheduling policy, the pins or the promoted files changed: every download is ordered again
+    (reference -> timetable)
+    :return: None
+    """
+    CHANGED_SET.update(DOWNLOAD_DICT.keys())
+
+
+def mark_peer(peer_ip):
+    """
+    the peer was lost or connected: the files it has are ordered again, e.g. the blocks of a lost relay
+    are requested from the complete peers
+    :return: None
+    """
+    for file_name, availability in list(AVAILABILITY_DICT.items()):
+        if peer_ip in availability:
+            CHANGED_SET.add(file_name)
+
+
+def get_peer_requests():
+    """
+    :return: {peer_ip: number of outstanding requests, hedges included}
+    """
+    peer_requests = {}
+    for peer_ip in REQUEST_DICT.values():
+        peer_requests[peer_ip] = peer_requests.get(peer_ip, 0) + 1
+    for peer_ip, _ in HEDGE_DICT.values():
+        peer_requests[peer_ip] = peer_requests.get(peer_ip, 0) + 1
+    return peer_requests
+
+
+def record_block_time(peer_ip, block_time):
+    """
+    smooth the time from block request to block complete of the peer, as the round trip time of TCP:
+    mean += (sample - mean) / 8, mean deviation += (|sample - mean| - mean deviation) / 4
+    :return: None
+    """
+    if peer_ip not in BLOCK_TIME_DICT:
+        BLOCK_TIME_DICT[peer_ip] = [block_time, block_time / 2]
+        return None
+    mean, deviation = BLOCK_TIME_DICT[peer_ip]
+    deviation += (abs(block_time - mean) - deviation) / 4
+    mean += (block_time - mean) / 8
+    BLOCK_TIME_DICT[peer_ip] = [mean, deviation]
+
+
+def get_request_timeout(peer_ip):
+    """
+    :return: seconds without progress before a request sent to the peer is overdue:
+             mean + 4 mean deviations of the block times of the peer
+    """
+    if peer_ip not in BLOCK_TIME_DICT:
+        return INITIAL_REQUEST_TIMEOUT
+    mean, deviation = BLOCK_TIME_DICT[peer_ip]
+    return min(max(mean + 4 * deviation, MIN_REQUEST_TIMEOUT), MAX_REQUEST_TIMEOUT)
+
+
+def get_hedge_delay(peer_ip):
+    """
+    :return: seconds before the last blocks of a file requested from the peer are hedged:
+             mean + 2 mean deviations of the block times of the peer, slower than most blocks,
+             a peer not measured yet is expected to be as fast as the fastest peer measured
+    """
+    if peer_ip in BLOCK_TIME_DICT:
+        block_times = [BLOCK_TIME_DICT[peer_ip]]
+    else:
+        block_times = list(BLOCK_TIME_DICT.values())
+    if len(block_times) == 0:
+        return INITIAL_REQUEST_TIMEOUT / 2
+    return min(mean + 2 * deviation for mean, deviation in block_times)
+
+
+def check_requests():
+    """
+    request the overdue blocks again, drop the overdue hedges, and hedge the last outstanding blocks of the files
+    :return: None
+    """
+    now = time.monotonic()
+    for request, (peer_ip, hedge_time) in list(HEDGE_DICT.items()):
+        if now - max(hedge_time, get_progress_time(request, peer_ip)) > get_request_timeout(peer_ip):
+            REQUESTS_TIMED_OUT.inc(1, (peer_ip,))
+            HEDGE_DICT.pop(request)
+            forget_progress(request, peer_ip)
+    overdue = False
+    for request, peer_ip in list(REQUEST_DICT.items()):
+        start_time = max(REQUEST_TIME_DICT.get(request, now), get_progress_time(request, peer_ip))
+        if now - start_time > get_request_timeout(peer_ip):
+            timeout_request(request, peer_ip)
+            overdue = True
+    if overdue:
+        request_blocks()
+        request_partial_updates()
+    hedge_requests(now)
+
+
+def get_progress_time(request, peer_ip):
+    """
+    :return: time the last segment of the requested block was received from the peer, 0 if none
+    """
+    return PROGRESS_TIME_DICT.get(request, {}).get(peer_ip, 0)
+
+
+def forget_progress(request, peer_ip):
+    """
+    the request of the block sent to the peer is over: drop its progress
+    :return: None
+    """
+    progress_times = PROGRESS_TIME_DICT.get(request)
+    if progress_times is None:
+        return None
+    progress_times.pop(peer_ip, None)
+    if len(progress_times) == 0:
+        PROGRESS_TIME_DICT.pop(request)
+
+
+def timeout_request(request, peer_ip):
+    """
+    the request is overdue: the hedge goes on if any, otherwise the block is to be requested again
+    :return: None
+    """
+    file_name, block_num = request
+    LOGGER.info('request timed out: %s block %d from %s', file_name, block_num, peer_ip)
+    REQUESTS_TIMED_OUT.inc(1, (peer_ip,))
+    REQUEST_DICT.pop(request)
+    REQUEST_TIME_DICT.pop(request, None)
+    forget_progress(request, peer_ip)
+    if request in HEDGE_DICT:
+        REQUEST_DICT[request], REQUEST_TIME_DICT[request] = HEDGE_DICT.pop(request)
+        return None
+    if file_name not in DOWNLOAD_DICT:
+        return None
+    block_status = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO][block_num]
+    if block_status == BLOCK_DOWNLOADING:
+        OVERDUE_DICT[request] = peer_ip
+        download_info_update(file_name, block_num, block_status=BLOCK_TO_DOWNLOAD, write=False)
+    elif block_status == BLOCK_PARTIAL_UPDATING:
+        download_info_update(file_name, block_num, block_status=BLOCK_TO_PARTIAL_UPDATE, write=False)
+
+
+def hedge_requests(now):
+    """
+    request the last outstanding blocks of the new downloads from a second peer once slower than expected
+    :param now: time.monotonic()
+    :return: None
+    """
+    peer_requests = None
+    tails = {}  # {file_name: whether the outstanding blocks of the file are its last ones}
+    for request, peer_ip in list(REQUEST_DICT.items()):
+        if request in HEDGE_DICT or now - REQUEST_TIME_DICT.get(request, now) < get_hedge_delay(peer_ip):
+            continue
+        file_name, block_num = request
+        if file_name not in tails:
+            block_info = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO] if file_name in DOWNLOAD_DICT else []
+            tails[file_name] = BLOCK_TO_DOWNLOAD not in block_info and \
+                0 < block_info.count(BLOCK_DOWNLOADING) <= HEDGE_BLOCKS
+        if not tails[file_name] or DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO][block_num] != BLOCK_DOWNLOADING:
+            continue
+        if peer_requests is None:
+            peer_requests = get_peer_requests()
+        # the other connected peers with the block and a free request slot
+        candidates = [candidate for candidate, available_blocks in AVAILABILITY_DICT.get(file_name, {}).items()
+                      if candidate != peer_ip and (available_blocks is None or block_num in available_blocks)
+                      and peer_requests.get(candidate, 0) < MAX_PEER_REQUESTS and is_connected(candidate)
+                      and not is_avoided(file_name, block_num, candidate)]
+        if len(candidates) == 0:
+            continue
+        hedge_peer_ip = min(candidates, key=lambda candidate: peer_requests.get(candidate, 0))
+        if send_block_request(hedge_peer_ip, block_num, file_name, hedge=True):
+            LOGGER.debug('hedged: %s block %d from %s to %s', file_name, block_num, peer_ip, hedge_peer_ip)
+            BLOCKS_HEDGED.inc(1, (hedge_peer_ip,))
+            peer_requests[hedge_peer_ip] = peer_requests.get(hedge_peer_ip, 0) + 1
+
+
+def reset_requests(peer_ip):
+    """
+    the requests sent to the peer are lost (reconnection, peer lost): download the blocks again
+    :return: None
+    """
+    for request in list(HEDGE_DICT.keys()):
+        if HEDGE_DICT[request][0] == peer_ip:
+            HEDGE_DICT.pop(request)
+            forget_progress(request, peer_ip)
+    for request in list(REQUEST_DICT.keys()):
+        if REQUEST_DICT[request] != peer_ip:
+            continue
+        file_name, block_num = request
+        REQUEST_DICT.pop(request)
+        REQUEST_TIME_DICT.pop(request, None)
+        forget_progress(request, peer_ip)
+        # hedged: the second request goes on
+        if request in HEDGE_DICT:
+            REQUEST_DICT[request], REQUEST_TIME_DICT[request] = HEDGE_DICT.pop(request)
+            continue
+        if file_name not in DOWNLOAD_DICT:
+            continue
+        block_status = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO][block_num]
+        if block_status == BLOCK_DOWNLOADING:
+            download_info_update(file_name, block_num, block_status=BLOCK_TO_DOWNLOAD, write=False)
+        elif block_status == BLOCK_PARTIAL_UPDATING:
+            download_info_update(file_name, block_num, block_status=BLOCK_TO_PARTIAL_UPDATE, write=False)
+
+
+def set_available(peer_ip, file_name, available_blocks):
+    """
+    :param available_blocks: None - the peer has the complete file, {block_num, ...} - the peer is a relay
+    :return: None
+    """
+    if file_name not in AVAILABILITY_DICT:
+        AVAILABILITY_DICT[file_name] = {}
+    AVAILABILITY_DICT[file_name][peer_ip] = available_blocks
+    mark_changed(file_name)
+
+
+def is_connected(peer_ip):
+    return connection_hub.is_connected(peer_ip)
 
 
 def continue_partial_update(peer_ip, file_name):
-    _, block_info = DOWNLOAD_DICT[file_name]
+    block_info = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO]
     for block_num in range(len(block_info)):
         if block_info[block_num] == BLOCK_TO_PARTIAL_UPDATE:
+            # send block request, the block stays to partial update if the peer is not connected
+            if send_block_request(peer_ip, block_num, file_name) is False:
+                return None
             block_info[block_num] = BLOCK_PARTIAL_UPDATING
-            # send block request
-            send_block_request(peer_ip, block_num, file_name)
+
+
+def request_partial_update(file_name):
+    """
+    request the blocks to partial update from a connected peer with the file
+    :return: None
+    """
+    block_info = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO]
+    for peer_ip in AVAILABILITY_DICT.get(file_name, {}):
+        if AVAILABILITY_DICT[file_name][peer_ip] is not None or not is_connected(peer_ip):
+            continue
+        # a peer that sent a block to partial update corrupted too often
+        if any(is_avoided(file_name, block_num, peer_ip) for block_num in range(len(block_info))
+               if block_info[block_num] == BLOCK_TO_PARTIAL_UPDATE):
+            continue
+        continue_partial_update(peer_ip, file_name)
+        break
+
+
+def request_partial_updates():
+    """
+    request the blocks to partial update of every partial update, e.g. after a peer was lost
+    :return: None
+    """
+    for file_name, (_, block_info, _) in DOWNLOAD_DICT.items():
+        if BLOCK_TO_PARTIAL_UPDATE in block_info:
+            request_partial_update(file_name)
 
 
 def deliver(file_name):
@@ -238,7 +1098,7 @@ def deliver(file_name):
 
 
 def overwrite(file_name):
-    file_info, block_info = DOWNLOAD_DICT[file_name]
+    block_info = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO]
     # move the current file to temp
     shutil.move(main.FILE_DIR + file_name, main.TEMP_DIR + TEMP_DOWNLOADING + file_name)
     # overwrite file
@@ -252,18 +1112,244 @@ def overwrite(file_name):
                 break
 
 
-def send_block_request(peer_ip, block_num, file_name):
-    outbox_message = struct.pack('!Q', block_num) + file_name.encode()
+def get_received_size(file_name, block_num):
+    """
+    :return: number of bytes of the block received so far (size of the block in temp)
+    """
+    try:
+        return os.path.getsize(main.TEMP_DIR + TEMP_DOWNLOADING + file_name + '_block' + str(block_num))
+    except FileNotFoundError:
+        return 0
+
+
+def get_block_hasher(file_name, block_num, received_size):
+    """
+    :param received_size: bytes of the block in temp
+    :return: the digest of the block fed up to received_size, the block in temp is only read if not fed from the
+             beginning, e.g. resumed from a previous run
+    """
+    hashed_size, hasher = HASHER_DICT.get(file_name, {}).get(block_num, (0, None))
+    if hasher is not None and hashed_size == received_size:
+        return hasher
+    hasher = quality_control.block_hasher()
+    if received_size > 0:
+        with open(main.TEMP_DIR + TEMP_DOWNLOADING + file_name + '_block' + str(block_num), 'rb') as r:
+            while True:
+                chunk = r.read(file_center.SEGMENT_SIZE)
+                if len(chunk) == 0:
+                    break
+                hasher.update(chunk)
+    return hasher
+
+
+def forget_hasher(file_name, block_num):
+    hashers = HASHER_DICT.get(file_name)
+    if hashers is None:
+        return None
+    hashers.pop(block_num, None)
+    if len(hashers) == 0:
+        HASHER_DICT.pop(file_name)
+
+
+def discard_block(file_name, block_num):
+    """
+    delete the received part of the block, the block is then requested from the beginning
+    :return: None
+    """
+    forget_hasher(file_name, block_num)
+    try:
+        os.remove(main.TEMP_DIR + TEMP_DOWNLOADING + file_name + '_block' + str(block_num))
+    except FileNotFoundError:
+        pass
+
+
+def send_block_request(peer_ip, block_num, file_name, hedge=False):
+    """
+    request the block from the bytes already received on
+    :param hedge: whether the block is requested from a second peer (reference -> HEDGE_DICT)
+    :return: whether the request is sent
+    """
+    offset = get_received_size(file_name, block_num)
+    outbox_message = struct.pack('!QQ', block_num, offset) + file_name.encode()
     package = (connection_hub.MESSAGE_BLOCK_REQUEST, outbox_message)
+    # the peer is not connected: the request would be lost
+    if not is_connected(peer_ip):
+        return False
     outbox_thread = connection_hub.PEER_DICT[peer_ip][connection_hub.PEER_DICT_OUTBOX]
-    # if outbox is recycled, ignore task
-    if not outbox_thread.is_on():
-        return None
     outbox_thread.send(package)
+    if hedge:
+        HEDGE_DICT[(file_name, block_num)] = (peer_ip, time.monotonic())
+        return True
+    REQUEST_DICT[(file_name, block_num)] = peer_ip
+    REQUEST_TIME_DICT[(file_name, block_num)] = time.monotonic()
+    return True
+
+
+def peer_lost(peer_ip):
+    """
+    notify the download manager of a lost peer (reference -> lighthouse)
+    :return: None
+    """
+    DOWNLOAD_MANAGER.send((peer_ip, MESSAGE_PEER_LOST, None))
+
+
+def peer_connected(peer_ip):
+    """
+    notify the download manager of a connected outbox
+    :return: None
+    """
+    DOWNLOAD_MANAGER.send((peer_ip, MESSAGE_PEER_CONNECTED, None))
+
+
+def stream_fallback(peer_ip, file_infos):
+    """
+    notify the download manager of the files of a stream to download block by block (reference -> moving_van)
+    :param file_infos: {file_name: file_info}
+    :return: None
+    """
+    DOWNLOAD_MANAGER.send((peer_ip, MESSAGE_STREAM_FALLBACK, file_infos))
+
+
+def schedule(change):
+    """
+    hand a change of the timetable over to the download manager, the timetable is only read and changed on its
+    thread (reference -> timetable)
+    :param change: function changing the timetable
+    :return: None
+    """
+    DOWNLOAD_MANAGER.send((None, MESSAGE_SCHEDULE, change))
+
+
+def broadcast_partial_file(file_name):
+    """
+    advertise the downloaded blocks of a new download to the peers that do not have the complete file
+    :return: None
+    """
+    # mirror: nothing is relayed (reference -> looking_glass)
+    if file_name not in DOWNLOAD_DICT or looking_glass.is_mirror():
+        return None
+    outbox_message = partial_file_outbox_message(file_name)
+    if outbox_message is None:
+        return None
+    package = (connection_hub.MESSAGE_PARTIAL_FILE, outbox_message)
+    availability = AVAILABILITY_DICT.get(file_name, {})
+    for peer_ip in connection_hub.PEER_DICT.keys():
+        if peer_ip in availability and availability[peer_ip] is None:
+            continue
+        # ignored for the peer (reference -> customs)
+        if customs.is_ignored(file_name, peer_ip):
+            continue
+        peer_outbox_thread = connection_hub.PEER_DICT[peer_ip][connection_hub.PEER_DICT_OUTBOX]
+        # if outbox is not connected, ignore task (the downloaded blocks are sent once connected)
+        if peer_outbox_thread is None or not peer_outbox_thread.is_connected():
+            continue
+        peer_outbox_thread.send(package)
+
 
+def partial_file_outbox_message(file_name):
+    """
+    partial file:
+    file_name_size !Q
+    file_name w/ encode
+    file_info_size !Q
+    file_info w/ pickle
+    downloaded block bitmap (bit block_num % 8 of byte block_num // 8)
+    :return: outbox message, None if the file is not a new download
+    """
+    file_info, block_info, _ = DOWNLOAD_DICT[file_name]
+    if BLOCK_TO_PARTIAL_UPDATE in block_info or BLOCK_PARTIAL_UPDATING in block_info or \
+            BLOCK_PARTIAL_UPDATED in block_info:
+        return None
+    bitmap = bytearray(math.ceil(len(block_info) / 8))
+    for block_num in range(len(block_info)):
+        if block_info[block_num] == BLOCK_DOWNLOADED:
+            bitmap[block_num // 8] |= 1 << (block_num % 8)
+    file_name_encoded = file_name.encode()
+    pickled_file_info = pickle.dumps(file_info)
+    outbox_message = struct.pack('!Q', len(file_name_encoded)) + file_name_encoded + \
+        struct.pack('!Q', len(pickled_file_info)) + pickled_file_info + bytes(bitmap)
+    return outbox_message
+
+
+def partial_file_outbox_messages(peer_ip):
+    """
+    :return: the partial file outbox messages of all new downloads not ignored for the peer
+    """
+    outbox_messages = []
+    # mirror: nothing is relayed (reference -> looking_glass)
+    if looking_glass.is_mirror():
+        return outbox_messages
+    for file_name in list(DOWNLOAD_DICT.keys()):
+        if customs.is_ignored(file_name, peer_ip):
+            continue
+        outbox_message = partial_file_outbox_message(file_name)
+        if outbox_message is not None:
+            outbox_messages.append(outbox_message)
+    return outbox_messages
+
+
+class BlockReader:
+    """
+    reads the downloaded blocks of a new download, for relaying (reference -> service_desk)
+    same interface as file_center.FileReader
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def get_block_status(self):
+        return 0
+
+    def get_version(self):
+        file_info = DOWNLOAD_DICT[self.file_name][DOWNLOAD_FILE_INFO]
+        return file_info[file_center.FILE_INFO_MTIME]
+
+    def read(self, block_num):
+        try:
+            with open(main.TEMP_DIR + TEMP_DOWNLOADING + self.file_name + '_block' + str(block_num), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            # download completed in the meantime
+            with open(main.FILE_DIR + self.file_name, 'rb') as f:
+                f.seek(block_num * file_center.BLOCK_SIZE)
+                return f.read(file_center.BLOCK_SIZE)
+
+    def get_block_size(self, block_num):
+        try:
+            return os.path.getsize(main.TEMP_DIR + TEMP_DOWNLOADING + self.file_name + '_block' + str(block_num))
+        except FileNotFoundError:
+            # download completed in the meantime
+            file_size = os.path.getsize(main.FILE_DIR + self.file_name)
+            return max(min(file_size - block_num * file_center.BLOCK_SIZE, file_center.BLOCK_SIZE), 0)
+
+    def message_pack(self, block_num, offset, block):
+        # the digest received with the block, if still downloading
+        try:
+            block_digest = DOWNLOAD_DICT[self.file_name][DOWNLOAD_BLOCK_DIGESTS][block_num]
+        except KeyError:
+            block_digest = None
+        if block_digest is None:
+            block_digest = quality_control.digest(block)
+        return file_center.block_message_pack(self.file_name, block_num, offset, block, block_digest)
 
-def download_dict_add(file_name, file_info, block_info, write=True):
-    DOWNLOAD_DICT[file_name] = (file_info, block_info)
+
+def get_block_reader(file_name, block_num):
+    """
+    :return: a BlockReader if the block of the new download is downloaded, otherwise None
+    """
+    try:
+        block_info = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO]
+        if block_info[block_num] != BLOCK_DOWNLOADED or BLOCK_PARTIAL_UPDATED in block_info:
+            return None
+    except (KeyError, IndexError):
+        return None
+    return BlockReader(file_name)
+
+
+def download_dict_add(file_name, file_info, block_info, block_digests, write=True):
+    DOWNLOAD_DICT[file_name] = (file_info, block_info, block_digests)
+    mark_changed(file_name)
+    COMPLETE_CHECK_SET.add(file_name)
     if write is True:
         download_info_write(file_name)
 
@@ -276,7 +1362,12 @@ def download_dict_read(file_location=''):
                 # read download_info from file
                 with open(main.TEMP_DIR + TEMP_DOWNLOAD_INFO + file_name, 'rb') as f:
                     download_info = pickle.load(f)
-                file_info, block_info = download_info
+                file_info, block_info, *block_digests = download_info
+                # download_info written without digests: the received blocks are not checked
+                if len(block_digests) == 0:
+                    block_digests = [None for _ in range(len(block_info))]
+                else:
+                    block_digests = block_digests[0]
                 # restart: downloading -> to download, partial updating -> to partial update
                 for i in range(len(block_info)):
                     if block_info[i] == BLOCK_DOWNLOADING:
@@ -284,17 +1375,41 @@ def download_dict_read(file_location=''):
                     if block_info[i] == BLOCK_PARTIAL_UPDATING:
                         block_info[i] = BLOCK_TO_PARTIAL_UPDATE
                 # add entry to download_dict
-                download_dict_add(file_name, file_info, block_info, write=False)
+                download_dict_add(file_name, file_info, block_info, block_digests, write=False)
+                RESTORED_SET.add(file_name)
             else:
                 dir_name = file.name
                 download_dict_read(file_location + dir_name + '/')
 
 
+def download_dict_remove(file_name):
+    """
+    delete the download_info of a complete or dropped download from download_dict and file
+    :return: None
+    """
+    DOWNLOAD_DICT.pop(file_name)
+    os.remove(main.TEMP_DIR + TEMP_DOWNLOAD_INFO + file_name)
+    HASHER_DICT.pop(file_name, None)
+    RESTORED_SET.discard(file_name)
+    AVAILABILITY_DICT.pop(file_name, None)
+    WANTED_DICT.pop(file_name, None)
+    DISCOVERY_DICT.pop(file_name, None)
+    ADVERTISE_SET.discard(file_name)
+    for request in [request for request in CORRUPT_DICT if request[0] == file_name]:
+        CORRUPT_DICT.pop(request)
+    timetable.forget(file_name)
+
+
 def download_info_update(file_name, block_num, block_status, write=True):
     # get block_info
     block_info = DOWNLOAD_DICT[file_name][DOWNLOAD_BLOCK_INFO]
     # update block_info
     block_info[block_num] = block_status
+    # a block to request again, or the order of a wanted file changes (reference -> timetable.get_key)
+    if block_status == BLOCK_TO_DOWNLOAD or file_name in WANTED_DICT:
+        mark_changed(file_name)
+    if block_status == BLOCK_DOWNLOADED or block_status == BLOCK_PARTIAL_UPDATED:
+        COMPLETE_CHECK_SET.add(file_name)
     # write block_info
     if write is True:
         download_info_write(file_name)
@@ -326,3 +1441,27 @@ def download_manager_init():
     # start download_manager
     DOWNLOAD_MANAGER = DownloadManager()
     DOWNLOAD_MANAGER.start()
+
+    # metrics: download progress
+    observatory.gauge('download_queue_messages', 'messages waiting in the download manager queue',
+                      DOWNLOAD_MANAGER.message_queue.qsize)
+    observatory.gauge('downloads_active', 'files being downloaded or partial updated', lambda: len(DOWNLOAD_DICT))
+    observatory.gauge('download_blocks', 'blocks of the active downloads by status', get_block_counts, ('status',))
+    observatory.gauge('block_requests_outstanding', 'block requests not answered yet',
+                      lambda: len(REQUEST_DICT))
+    observatory.gauge('block_requests_hedged', 'second requests of the last blocks not answered yet',
+                      lambda: len(HEDGE_DICT))
+    observatory.gauge('request_timeout_seconds', 'seconds without progress before a request is overdue',
+                      lambda: {(peer_ip,): get_request_timeout(peer_ip) for peer_ip in list(BLOCK_TIME_DICT)},
+                      ('peer',))
+
+
+def get_block_counts():
+    """
+    :return: {(block status name,): number of blocks} of the active downloads
+    """
+    block_counts = {(status_name,): 0 for status_name in BLOCK_STATUS_NAMES.values()}
+    for download in list(DOWNLOAD_DICT.values()):
+        for block_status in download[DOWNLOAD_BLOCK_INFO]:
+            block_counts[(BLOCK_STATUS_NAMES[block_status],)] += 1
+    return block_counts
@@ -1,32 +1,179 @@
 """
 encryption_bureau provides the encrypt/decrypt functions
+
+messages are encrypted with AES-GCM in fixed-size records, so that a message
+can be encrypted / decrypted while it streams through the socket, with a
+bounded amount of memory, and the records of a large message can be
+processed by several threads in parallel (the cipher releases the GIL)
+
+encrypted message:
+salt (SALT_SIZE, random per message)
+record 0: ciphertext (RECORD_SIZE) + tag (TAG_SIZE)
+record 1: ciphertext (RECORD_SIZE) + tag (TAG_SIZE)
+...
+last record: ciphertext (<= RECORD_SIZE, may be empty) + tag (TAG_SIZE)
+
+record nonce: salt + record_num !I
+record associated data: last record flag !B (a truncated message fails authentication)
 """
 import hashlib
+import math
+import os
+import struct
+from multiprocessing.pool import ThreadPool
+from threading import Lock
 from Crypto.Cipher import AES
 
 
-BLOCK_SIZE = AES.block_size
 KEY = hashlib.sha256('TwoDrive'.encode()).digest()
-IV = 16 * b'\x00'
+RECORD_SIZE = 65536  # 64KB
+SALT_SIZE = 8
+TAG_SIZE = 16
+ENCRYPTED_RECORD_SIZE = RECORD_SIZE + TAG_SIZE
+
+# records of a message are encrypted / decrypted PARALLEL_RECORDS at a time by THREADS threads
+THREADS = os.cpu_count() or 1
+PARALLEL_RECORDS = 16
+
+POOL = None
+POOL_LOCK = Lock()
+
+
+class AuthenticationError(Exception):
+    """
+    the message is not authentic: a record failed its tag, or the message is truncated or too long
+    """
+    pass
 
 
 def encrypt(data):
-    data = pad(data)
-    cipher = AES.new(KEY, AES.MODE_CBC, IV)
-    encrypted = IV + cipher.encrypt(data)
-    return encrypted
+    return b''.join(encrypt_stream(data))
 
 
 def decrypt(data):
-    cipher = AES.new(KEY, AES.MODE_CBC, IV)
-    decrypted = cipher.decrypt(data[AES.block_size:])
-    decrypted = unpad(decrypted)
+    """
+    :raise AuthenticationError: the message is not authentic
+    """
+    decryptor = Decryptor(len(data))
+    decrypted = decryptor.feed(data)
+    if not decryptor.is_done():
+        raise AuthenticationError('truncated message')
     return decrypted
 
 
-def pad(data):
-    return data + (BLOCK_SIZE - len(data) % BLOCK_SIZE) * chr(BLOCK_SIZE - len(data) % BLOCK_SIZE).encode()
+def encrypt_stream(data):
+    """
+    encrypt the data record by record
+    :param data: the data to encrypt
+    :return: generator of the encrypted message, in pieces of at most PARALLEL_RECORDS records
+    """
+    salt = os.urandom(SALT_SIZE)
+    yield salt
+    data = memoryview(data)
+    num_records = get_num_records(len(data))
+    for first in range(0, num_records, PARALLEL_RECORDS):
+        jobs = []
+        for record_num in range(first, min(first + PARALLEL_RECORDS, num_records)):
+            record = data[record_num * RECORD_SIZE:(record_num + 1) * RECORD_SIZE]
+            jobs.append((salt, record_num, record_num == num_records - 1, record))
+        yield b''.join(run_jobs(encrypt_record, jobs))
+
+
+class Decryptor:
+    """
+    decrypts an encrypted message as it arrives
+    self.buffer: received data of the records not complete yet
+    self.record_num: the next record to decrypt
+    """
+
+    def __init__(self, encrypted_size):
+        if encrypted_size < SALT_SIZE + TAG_SIZE:
+            raise AuthenticationError('encrypted message too short')
+        body_size = encrypted_size - SALT_SIZE
+        num_records = math.ceil(body_size / ENCRYPTED_RECORD_SIZE)
+        self.salt = None
+        self.buffer = bytearray()
+        self.record_num = 0
+        self.num_records = num_records
+        self.last_record_size = body_size - (num_records - 1) * ENCRYPTED_RECORD_SIZE
+
+    def is_done(self):
+        return self.record_num == self.num_records
+
+    def feed(self, data):
+        """
+        :param data: the next piece of the encrypted message
+        :return: the decrypted data of all records completed by this piece
+        :raise AuthenticationError: a record is not authentic, or the message is longer than expected
+        """
+        self.buffer += data
+        if self.salt is None:
+            if len(self.buffer) < SALT_SIZE:
+                return b''
+            self.salt = bytes(self.buffer[:SALT_SIZE])
+            del self.buffer[:SALT_SIZE]
+
+        # collect the complete records
+        jobs = []
+        position = 0
+        record_num = self.record_num
+        while record_num < self.num_records:
+            last = record_num == self.num_records - 1
+            record_size = self.last_record_size if last else ENCRYPTED_RECORD_SIZE
+            if len(self.buffer) - position < record_size:
+                break
+            jobs.append((self.salt, record_num, last, bytes(self.buffer[position:position + record_size])))
+            position += record_size
+            record_num += 1
+        if len(self.buffer) - position > 0 and record_num == self.num_records:
+            raise AuthenticationError('message longer than expected')
+        del self.buffer[:position]
+        self.record_num = record_num
+        return b''.join(run_jobs(decrypt_record, jobs))
+
+
+def encrypt_record(salt, record_num, last, record):
+    cipher = AES.new(KEY, AES.MODE_GCM, nonce=salt + struct.pack('!I', record_num))
+    cipher.update(struct.pack('!B', last))
+    ciphertext, tag = cipher.encrypt_and_digest(record)
+    return ciphertext + tag
+
+
+def decrypt_record(salt, record_num, last, record):
+    """
+    :return: the decrypted record
+    :raise AuthenticationError: the record is not authentic
+    """
+    cipher = AES.new(KEY, AES.MODE_GCM, nonce=salt + struct.pack('!I', record_num))
+    cipher.update(struct.pack('!B', last))
+    try:
+        return cipher.decrypt_and_verify(record[:-TAG_SIZE], record[-TAG_SIZE:])
+    except ValueError as e:  # the tag does not match
+        raise AuthenticationError('record %d: %s' % (record_num, e)) from e
+
+
+def run_jobs(function, jobs):
+    """
+    run the record jobs, in parallel if there are several
+    :return: the results in order
+    """
+    global POOL
+
+    if THREADS <= 1 or len(jobs) <= 1:
+        return [function(*job) for job in jobs]
+    with POOL_LOCK:
+        if POOL is None:
+            POOL = ThreadPool(THREADS)
+    return POOL.starmap(function, jobs)
+
+
+def get_num_records(size):
+    return max(math.ceil(size / RECORD_SIZE), 1)
 
 
-def unpad(data):
-    return data[:-ord(data[len(data) - 1:].decode())]
+def get_encrypted_size(size):
+    """
+    :param size: the size of the data
+    :return: the size of the encrypted message
+    """
+    return SALT_SIZE + size + get_num_records(size) * TAG_SIZE
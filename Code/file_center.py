@@ -1,14 +1,15 @@
 """
 file_center provides the read and management functions for local files
 """
+import logging
 import math
 import os
 import pickle
 import struct
 import time
-from queue import Queue
 from threading import Thread
-import connection_hub, main, download_manager
+import connection_hub, main, download_manager, warehouse, quality_control, observatory, zoning_board, customs, \
+    filing_cabinet, moving_van, looking_glass
 
 
 # config
@@ -22,80 +23,49 @@ FILE_INFO_NUM_BLOCKS = 2
 
 # size of a file block
 BLOCK_SIZE = 20971520  # 20MB
+# blocks are sent in segments, so that an interrupted block is resumed from the last received segment
+SEGMENT_SIZE = 2097152  # 2MB, BLOCK_SIZE must be a multiple of SEGMENT_SIZE
 
 """
 file dictionary
 
 * file_dict format:
-{file_name: (file_info, file_reader)}
+{file_name: file_info}, with a block status by file, a compact index (reference -> filing_cabinet)
 
 * file_info format:
 [mtime, last modified, num_blocks]
 """
-FILE_DICT = {}
-FILE_DICT_READER = 1  # DO NOT CHANGE - the code in this file does not rely on this
+FILE_DICT = filing_cabinet.FilingCabinet()
 
 # grand central dispatch
 GCD = None
 
+LOGGER = logging.getLogger(__name__)
 
-class FileReader(Thread):
+
+class FileReader:
     """
-    self.message_queue: (block_num, receive_thread)
+    blocks are read on behalf of the service desk (reference -> service_desk)
+    made on demand, the block status is kept in the file dict
     """
 
     def __init__(self, file_name):
-        Thread.__init__(self)
         self.file_name = file_name
-        self.message_queue = Queue(0)
-        self.prev_time = time.time()
-        self.block_status = 0  # 0: run, >0: block
-
-    def send(self, message):
-        """
-        for other threads: send message to this thread
-        :param message: message to send to this thread
-        :return: None
-        """
-        self.message_queue.put(message)
-
-    def block(self):
-        self.block_status += 1
-
-    def unblock(self):
-        self.block_status -= 1
-        if self.block_status < 0:
-            raise Exception
 
     def get_block_status(self):
         """
         block status: 0 - run, >0 - block
         :return: block status
         """
-        return self.block_status
+        return FILE_DICT.get_block_status(self.file_name)
 
-    def run(self):
-        while True:
-            if self.block_status == 0:  # check whether thread is blocked
-                if not self.message_queue.empty():
-                    message = self.message_queue.get()
-                    self.message_queue.task_done()
-                    block_num, receive_thread = message
-                    # if outbox is recycled, ignore task
-                    if not receive_thread.is_on():
-                        continue
-                    # if outbox too busy, put task back to queue
-                    if receive_thread.queue_size() > 5:
-                        self.message_queue.put(message)
-                        continue
-                    # read and send the required block
-                    block = self.read(block_num)
-                    package = self.message_pack(block_num, block)
-                    receive_thread.send(package)
-                elif time.time() - self.prev_time > 1:
-                    # update previous time (checks modify every >1s)
-                    self.prev_time = time.time()
-                    self.check_modify()
+    def get_version(self):
+        """
+        the file_info mtime is in whole seconds, a file rewritten within the second keeps it
+        :return: the version of the file on disk: (size, mtime in ns)
+        """
+        stat = os.stat(main.FILE_DIR + self.file_name)
+        return stat.st_size, stat.st_mtime_ns
 
     def read(self, block_num):
         wait_for_permission(self.file_name)
@@ -105,37 +75,13 @@ class FileReader(Thread):
         f.close()
         return block
 
-    def check_modify(self):
-        try:
-            wait_for_permission(self.file_name)
-            # get the file_info
-            file_info, _ = FILE_DICT[self.file_name]
-            # getmtime() != file_info.mtime: file changed
-            if int(os.path.getmtime(main.FILE_DIR + self.file_name)) != file_info[FILE_INFO_MTIME]:
-                print('inbox: updating ' + self.file_name + '...')
-                # update file_info
-                mtime = int(os.path.getmtime(main.FILE_DIR + self.file_name))
-                last_modified = mtime
-                file_info_update(self.file_name, mtime, last_modified)
-        except FileNotFoundError as e:
-            # file deleted (probably due to modifying)
-            print('inbox: file deleted:', self.file_name, ':', e)
-
-    def message_pack(self, block_num, block):
-        """
-        packs the information to the outbox format
-        block:
-        block_num !Q
-        file_name_size !Q
-        file_name
-        block_content
-        :return: outbox message
-        """
-        file_name = self.file_name.encode()
-        header = struct.pack('!QQ', block_num, len(file_name))
-        outbox_message = header + file_name + block
-        package = (connection_hub.MESSAGE_BLOCK, outbox_message)
-        return package
+    def get_block_size(self, block_num):
+        file_size = os.path.getsize(main.FILE_DIR + self.file_name)
+        return max(min(file_size - block_num * BLOCK_SIZE, BLOCK_SIZE), 0)
+
+    def message_pack(self, block_num, offset, block):
+        block_digest = quality_control.get_digest(self.file_name, self.get_version(), block_num, block)
+        return block_message_pack(self.file_name, block_num, offset, block, block_digest)
 
 
 class GrandCentralDispatch(Thread):
@@ -165,17 +111,32 @@ class GrandCentralDispatch(Thread):
             if self.block_status == 0 and time.time() - self.prev_time > 1:
                 self.prev_time = time.time()
                 self.dispatch()
+            # wait for the next scan instead of spinning
+            time.sleep(0.1)
 
     def dispatch(self, file_location=''):
         with os.scandir(main.FILE_DIR + file_location) as directory:
             for file in directory:
                 if file.is_file():
                     file_name = file_location + file.name
-                    # file_name in FILE_DICT: not a new file, continue
-                    if file_name in FILE_DICT or self.block_status > 0:  # redundant block_status check
+                    # owned by another shard: not looked at (reference -> zoning_board)
+                    if not zoning_board.owns(file_name):
+                        continue
+                    # file_name in FILE_DICT: not a new file, check for modification
+                    file_info = FILE_DICT.get(file_name)
+                    if file_info is not None:
+                        check_modify(file_name, file, file_info)
+                        continue
+                    if self.block_status > 0:  # redundant block_status check
+                        continue
+                    # ignored (reference -> customs)
+                    if customs.is_excluded(file_name, False):
+                        continue
+                    # being received from a peer, indexed once complete (reference -> moving_van)
+                    if moving_van.is_expected(file_name):
                         continue
                     # new file initiate dispatch
-                    print("gcd: adding file: " + file_name + "...")
+                    LOGGER.info('adding file: %s', file_name)
                     wait_for_permission(file_name)
                     # add to file dict, write file_info to disk, broadcast
                     mtime = int(os.path.getmtime(main.FILE_DIR + file_name))
@@ -184,9 +145,46 @@ class GrandCentralDispatch(Thread):
                     file_dict_add(file_name, mtime, last_modified, num_blocks)
                 else:
                     dir_name = file.name
+                    # ignored directories are not walked, every shard walks the others (reference -> zoning_board)
+                    if customs.is_excluded(file_location + dir_name, True):
+                        continue
                     self.dispatch(file_location + dir_name + '/')
 
 
+def check_modify(file_name, file, file_info):
+    """
+    the file changed if its mtime is not the one in the file_info
+    :param file: the os.DirEntry of the file
+    :return: None
+    """
+    if FILE_DICT.get_block_status(file_name) > 0:  # being updated (reference -> update_file)
+        return None
+    try:
+        if int(file.stat().st_mtime) == file_info[FILE_INFO_MTIME]:
+            return None
+        wait_for_permission(file_name)
+        LOGGER.info('updating: %s', file_name)
+        # update file_info
+        mtime = int(os.path.getmtime(main.FILE_DIR + file_name))
+        last_modified = mtime
+        file_info_update(file_name, mtime, last_modified)
+        # evict the cached blocks and digests of the old version
+        warehouse.WAREHOUSE.evict_file(file_name)
+        quality_control.forget(file_name)
+    except FileNotFoundError as e:
+        # file deleted (probably due to modifying)
+        LOGGER.info('file deleted: %s %s', file_name, e)
+
+
+def get_reader(file_name):
+    """
+    :return: the FileReader of a local file, None if not in the file dict
+    """
+    if file_name not in FILE_DICT:
+        return None
+    return FileReader(file_name)
+
+
 def add_file(file_name, file_info):
     # block the gcd
     GCD.block()
@@ -206,11 +204,8 @@ def add_file(file_name, file_info):
 
 
 def update_file(file_name, file_info):
-    # block the reader
-    _, reader = FILE_DICT[file_name]
-    reader.block()
-    while reader.get_block_status == 0:
-        continue
+    # block the reader and the modification check
+    FILE_DICT.block(file_name)
     # move old file to temp and overwrite
     download_manager.overwrite(file_name)
     # move new file to share
@@ -219,8 +214,31 @@ def update_file(file_name, file_info):
     mtime = int(os.path.getmtime(main.FILE_DIR + file_name))
     last_modified = file_info[FILE_INFO_LAST_MODIFIED]
     file_info_update(file_name, mtime, last_modified, write=True, broadcast=False)
-    # unblock the reader
-    reader.unblock()
+    # evict the cached blocks and digests of the old version
+    warehouse.WAREHOUSE.evict_file(file_name)
+    quality_control.forget(file_name)
+    # unblock the reader and the modification check
+    FILE_DICT.unblock(file_name)
+
+
+def block_message_pack(file_name, block_num, offset, block, block_digest):
+    """
+    packs the segment of the block starting at offset to the outbox format
+    block:
+    block_num !Q
+    offset !Q
+    block_size !Q
+    file_name_size !Q
+    file_name
+    block_digest (reference -> quality_control)
+    segment content: block_content[offset:offset + SEGMENT_SIZE]
+    :return: outbox package
+    """
+    file_name = file_name.encode()
+    header = struct.pack('!QQQQ', block_num, offset, len(block), len(file_name))
+    outbox_message = header + file_name + block_digest + block[offset:offset + SEGMENT_SIZE]
+    package = (connection_hub.MESSAGE_BLOCK, outbox_message)
+    return package
 
 
 def wait_for_permission(file_name):
@@ -257,24 +275,22 @@ def file_dict_add(file_name, mtime, last_modified, num_blocks, write=True, broad
     file_info[FILE_INFO_MTIME] = mtime
     file_info[FILE_INFO_LAST_MODIFIED] = last_modified
     file_info[FILE_INFO_NUM_BLOCKS] = num_blocks
-    file_reader = FileReader(file_name)
 
-    FILE_DICT[file_name] = (file_info, file_reader)
+    FILE_DICT[file_name] = file_info
 
     # write file_info
     if write is True:
         file_info_write(file_name)
-    # dispatch reader
-    file_reader.start()
     # broadcast
     if broadcast is True:
         broadcast_file_added(file_name)
 
 
 def file_info_update(file_name, mtime, last_modified, write=True, broadcast=True):
-    file_info, _ = FILE_DICT[file_name]
+    file_info = FILE_DICT[file_name]
     file_info[FILE_INFO_MTIME] = mtime
     file_info[FILE_INFO_LAST_MODIFIED] = last_modified
+    FILE_DICT[file_name] = file_info
 
     # write file_info
     if write is True:
@@ -287,7 +303,6 @@ def file_info_update(file_name, mtime, last_modified, write=True, broadcast=True
 def file_info_read(file_location=''):
     """
     read existing file info from <temp_dir>/file_info/
-    dispatch reader thread for each existing file
     add entry into file_dict
     :return: None
     """
@@ -295,13 +310,22 @@ def file_info_read(file_location=''):
         for file in entries:
             if file.is_file():
                 file_name = file_location + file.name
+                # ignored since it was indexed, or owned by another shard since (reference -> zoning_board):
+                # not in the file dict, the file_info is kept
+                if customs.is_ignored(file_name) or not zoning_board.owns(file_name):
+                    continue
+                # mirror: indexed by the mirror index already, newer than the file_info of an earlier run
+                # (reference -> looking_glass): the file_info is deleted
+                if file_name in FILE_DICT:
+                    os.remove(main.TEMP_DIR + TEMP_FILE_INFO + file_name)
+                    continue
                 # read file_info from file
                 with open(main.TEMP_DIR + TEMP_FILE_INFO + file_name, 'rb') as f:
                     file_info = pickle.load(f)
                 mtime, last_modified, num_blocks = file_info
                 file_dict_add(file_name, mtime, last_modified, num_blocks, write=False, broadcast=False)
 
-                print("file info read: " + file_name + ' | ' + str(file_info))
+                LOGGER.debug('file info read: %s | %s', file_name, file_info)
             else:
                 dir_name = file.name
                 file_info_read(file_location + dir_name + '/')
@@ -314,43 +338,60 @@ def file_info_write(file_name):
     :param file_name: the name of the file
     :return: None
     """
+    # mirror: appended to the mirror index in batches (reference -> looking_glass)
+    if looking_glass.is_mirror():
+        looking_glass.record(file_name, FILE_DICT[file_name])
+        return None
+
     # create file directory if not exist
+    # the gcd and the download manager (reference -> add_file) may create it at the same time
     file_location = file_name[:len(file_name) - len(file_name.split('/')[-1])]
-    if not os.path.exists(main.TEMP_DIR + TEMP_FILE_INFO + file_location):
-        os.makedirs(main.TEMP_DIR + TEMP_FILE_INFO + file_location)
+    os.makedirs(main.TEMP_DIR + TEMP_FILE_INFO + file_location, exist_ok=True)
 
     # write file_info
-    file_info, _ = FILE_DICT[file_name]
+    file_info = FILE_DICT[file_name]
     with open(main.TEMP_DIR + TEMP_FILE_INFO + file_name, 'wb') as f:
         pickle.dump(file_info, f)
 
-    print("file info wrote: " + file_name + ' | ' + str(file_info))
+    LOGGER.debug('file info wrote: %s | %s', file_name, file_info)
 
 
 def broadcast_file_modified(file_name):
+    # mirror: nothing is served (reference -> looking_glass)
+    if looking_glass.is_mirror():
+        return None
     outbox_message = file_info_outbox_message(file_name)
     package = (connection_hub.MESSAGE_FILE_MODIFIED, outbox_message)
     for peer_ip in connection_hub.PEER_DICT.keys():
+        # ignored for the peer (reference -> customs)
+        if customs.is_ignored(file_name, peer_ip):
+            continue
         peer_outbox_thread = connection_hub.PEER_DICT[peer_ip][connection_hub.PEER_DICT_OUTBOX]
-        # if outbox is recycled, ignore task
-        if not peer_outbox_thread.is_on():
+        # if outbox is not connected, ignore task (the file dict is sent once connected)
+        if not peer_outbox_thread.is_connected():
             continue
         peer_outbox_thread.send(package)
 
 
 def broadcast_file_added(file_name):
+    # mirror: nothing is served (reference -> looking_glass)
+    if looking_glass.is_mirror():
+        return None
     outbox_message = file_info_outbox_message(file_name)
     package = (connection_hub.MESSAGE_FILE_ADDED, outbox_message)
     for peer_ip in connection_hub.PEER_DICT.keys():
+        # ignored for the peer (reference -> customs)
+        if customs.is_ignored(file_name, peer_ip):
+            continue
         peer_outbox_thread = connection_hub.PEER_DICT[peer_ip][connection_hub.PEER_DICT_OUTBOX]
-        # if outbox is recycled, ignore task
-        if not peer_outbox_thread.is_on():
+        # if outbox is not connected, ignore task (the file dict is sent once connected)
+        if not peer_outbox_thread.is_connected():
             continue
         peer_outbox_thread.send(package)
 
 
 def file_info_outbox_message(file_name):
-    file_info, _ = FILE_DICT[file_name]
+    file_info = FILE_DICT[file_name]
     file_name_encoded = file_name.encode()
     file_name_length = len(file_name_encoded)
     pickled_file_info = pickle.dumps(file_info)
@@ -359,10 +400,16 @@ def file_info_outbox_message(file_name):
     return outbox_message
 
 
-def file_dict_outbox_message():
+def file_dict_outbox_message(peer_ip):
     file_dict = {}
-    for file_name in FILE_DICT:
-        file_info, _ = FILE_DICT[file_name]
+    # mirror: nothing is served, the peers are sent an empty file dict (reference -> looking_glass)
+    if looking_glass.is_mirror():
+        return pickle.dumps(file_dict)
+    # iterates over a copy, files added meanwhile are announced by broadcast_file_added
+    for file_name, file_info in FILE_DICT.items():
+        # ignored for the peer (reference -> customs)
+        if customs.is_ignored(file_name, peer_ip):
+            continue
         file_dict[file_name] = file_info
     outbox_message = pickle.dumps(file_dict)
     return outbox_message
@@ -385,5 +432,10 @@ def file_center_init():
     file_info_read()
 
     # start the grand central dispatch
+    # mirror: the share is not watched, it only changes by the deliveries (reference -> looking_glass)
     GCD = GrandCentralDispatch()
-    GCD.start()
+    if not looking_glass.is_mirror():
+        GCD.start()
+
+    # metrics: size of the file dict (reference -> observatory)
+    observatory.gauge('files_indexed', 'files in the file dict', lambda: len(FILE_DICT))
@@ -0,0 +1,168 @@
+"""
+lighthouse provides the failure detection and the reconnection of the peer connections (reference -> connection_hub)
+
+reconnection: an outbox whose connection failed or was lost connects again after a backoff, doubled after every
+failure from BACKOFF_BASE up to BACKOFF_MAX, with jitter (a random delay in [backoff / 2, backoff]) so that the
+peers of a restarted host do not all connect at the same time
+the backoff is reset only once a connection stayed up STABLE_TIME: a flapping peer keeps backing off,
+a connection from the peer cuts the backoff short, the peer is back (reference -> connection_hub.IOScheduler)
+
+failure detection:
+- TCP keepalive on every connection, and a send timeout (TCP_USER_TIMEOUT) on the outboxes
+- heartbeats: every outbox sends a ping every HEARTBEAT_INTERVAL, the peer answers with a pong through its outbox,
+  the round trip time of the pongs is measured per peer
+- an inbox that received nothing for DEAD_PEER_TIMEOUT declares the peer dead, an outbox that received no pong and
+  nothing else on the inbox of the peer for DEAD_PEER_TIMEOUT while the inbox is up connects again: the pong
+  of the peer may wait behind a block segment, sent chunk by chunk at a limited rate (reference -> tollbooth),
+  so the timeout has to cover a chunk at the lowest rate limit (reference -> main)
+a lost peer is reported to the download manager, which sends the outstanding requests to the other peers
+(reference -> download_manager.peer_lost_handler)
+
+heartbeat message: (reference -> connection_hub)
+kind !B: HEARTBEAT_PING / HEARTBEAT_PONG
+sent time !d: time.time() of the sender of the ping, returned in the pong
+"""
+import logging
+import random
+import socket
+import struct
+import time
+import connection_hub, observatory, switchboard
+
+# config
+HEARTBEAT_INTERVAL = 2  # seconds between two pings
+DEAD_PEER_TIMEOUT = 10  # seconds without a message before a peer is declared dead
+CONNECT_TIMEOUT = 5  # seconds to establish a connection
+BACKOFF_BASE = 0.5  # seconds before the first reconnection attempt after a failure
+BACKOFF_MAX = 30  # maximum seconds between two reconnection attempts
+STABLE_TIME = 30  # seconds a connection has to stay up to reset the backoff
+KEEPALIVE_COUNT = 3  # unanswered keepalive probes before the connection is dropped
+
+HEARTBEAT_PING = 0
+HEARTBEAT_PONG = 1
+
+REASON_CONNECTION_LOST = 'connection_lost'
+REASON_TIMEOUT = 'timeout'
+
+# last round trip time of each peer: {peer_ip: seconds}
+RTT_DICT = {}
+
+LOGGER = logging.getLogger(__name__)
+
+# metrics (reference -> observatory)
+HEARTBEAT_RTT = observatory.histogram('heartbeat_rtt_seconds', 'round trip time of the heartbeats', ('peer',))
+CONNECTS_FAILED = observatory.counter('connects_failed_total', 'failed connection attempts', ('peer',))
+RECONNECTS = observatory.counter('reconnects_total', 'connections established again after a loss', ('peer',))
+PEERS_LOST = observatory.counter('peers_lost_total', 'connections lost or timed out', ('peer', 'reason'))
+
+
+class Backoff:
+    """
+    reconnection delay of an outbox
+    self.failures: failed attempts and short lived connections since the last stable connection
+    """
+
+    def __init__(self):
+        self.failures = 0
+        self.connected_time = None
+
+    def get_delay(self):
+        """
+        :return: seconds to wait before the next attempt, 0 after a stable connection
+        """
+        if self.failures == 0:
+            return 0
+        backoff = min(BACKOFF_BASE * 2 ** (self.failures - 1), BACKOFF_MAX)
+        return random.uniform(backoff / 2, backoff)
+
+    def failed(self):
+        self.failures = min(self.failures + 1, 32)
+
+    def connected(self):
+        self.connected_time = time.monotonic()
+
+    def disconnected(self):
+        if self.connected_time is not None and time.monotonic() - self.connected_time >= STABLE_TIME:
+            self.failures = 0
+        else:  # flapping
+            self.failed()
+        self.connected_time = None
+
+
+def set_keepalive(connection_socket, send_timeout=False):
+    """
+    enable TCP keepalive, probes start once the connection is idle half of DEAD_PEER_TIMEOUT
+    :param send_timeout: whether to drop the connection once sent data stays unacknowledged DEAD_PEER_TIMEOUT
+    :return: None
+    """
+    connection_socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    idle = max(int(DEAD_PEER_TIMEOUT / 2), 1)
+    interval = max(int(DEAD_PEER_TIMEOUT / 2 / KEEPALIVE_COUNT), 1)
+    # the options are not available on every platform
+    options = [('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', KEEPALIVE_COUNT)]
+    if send_timeout:
+        options.append(('TCP_USER_TIMEOUT', int(DEAD_PEER_TIMEOUT * 1000)))
+    for option, value in options:
+        if hasattr(socket, option):
+            connection_socket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+def ping_message():
+    return struct.pack('!Bd', HEARTBEAT_PING, time.time())
+
+
+def pong_message(ping):
+    """
+    :param ping: the ping message received
+    :return: the pong message, with the time of the ping
+    """
+    _, sent_time = struct.unpack('!Bd', ping)
+    return struct.pack('!Bd', HEARTBEAT_PONG, sent_time)
+
+
+def unpack(message):
+    """
+    :return: (kind, sent time)
+    """
+    return struct.unpack('!Bd', message)
+
+
+def record_rtt(peer_ip, sent_time):
+    """
+    a pong arrived: measure the round trip time
+    :return: None
+    """
+    rtt = max(time.time() - sent_time, 0)
+    RTT_DICT[peer_ip] = rtt
+    HEARTBEAT_RTT.observe(rtt, (peer_ip,))
+
+
+def peers_command(argument):
+    if len(argument) > 0:
+        raise ValueError('usage: peers')
+    peers = []
+    for peer_ip in list(connection_hub.PEER_DICT):
+        state = 'connected' if connection_hub.is_connected(peer_ip) else 'disconnected'
+        rtt = RTT_DICT.get(peer_ip)
+        peers.append(peer_ip + ' ' + state + (' rtt %.1fms' % (rtt * 1000) if rtt is not None else ''))
+    return ', '.join(peers)
+
+
+def lighthouse_init(heartbeat_interval, dead_peer_timeout):
+    """
+    initialize the lighthouse
+    :param heartbeat_interval: seconds between two pings
+    :param dead_peer_timeout: seconds without a message before a peer is declared dead
+    :return: None
+    """
+    global HEARTBEAT_INTERVAL, DEAD_PEER_TIMEOUT
+
+    HEARTBEAT_INTERVAL = heartbeat_interval
+    DEAD_PEER_TIMEOUT = dead_peer_timeout
+
+    # runtime control (reference -> switchboard)
+    switchboard.register('peers', peers_command, 'peers')
+
+    # metrics (reference -> observatory)
+    observatory.gauge('peer_rtt_seconds', 'last round trip time of the heartbeats',
+                      lambda: {(peer_ip,): rtt for peer_ip, rtt in list(RTT_DICT.items())}, ('peer',))
@@ -0,0 +1,205 @@
+"""
+looking_glass provides the mirror mode: a receive-only host, e.g. an archive replica
+
+a mirror only applies the files of its peers:
+- the share is not watched, it only changes by the deliveries (reference -> file_center.file_center_init)
+- nothing is served: the block and stream requests are dropped (reference -> connection_hub.Inbox),
+  the peers are sent an empty file dict and no file added, file modified or partial file message,
+  so they never request from the mirror
+- the file_infos of the delivered files are not written one file each (reference -> file_center.file_info_write)
+  but appended to the mirror index in batches, of BATCH_SIZE records or BATCH_INTERVAL seconds
+  (reference -> flush_due), read back into the file dict at start, before the file_infos written one file each
+  by an earlier run that are older (reference -> file_center.file_info_read), and compacted once mostly
+  overwritten records (reference -> maybe_compact)
+
+a host that is not a mirror deletes the mirror index of an earlier run: the files it indexed are scanned as local
+files instead
+
+a file delivered in a batch not written yet when the host stopped is not indexed: downloaded again
+
+mirror index: <temp_dir>/mirror_index, a sequence of records:
+file_name_size !Q
+mtime !q
+last_modified !q
+num_blocks !Q
+file_name w/ encode
+"""
+import logging
+import os
+import struct
+import time
+from threading import Lock
+import file_center, main, customs, observatory
+
+# config
+TEMP_MIRROR_INDEX = 'mirror_index'
+BATCH_SIZE = 1024  # records appended at once
+BATCH_INTERVAL = 1  # maximum seconds a record waits to be appended
+COMPACT_RATIO = 2  # records per indexed file from which the index is compacted
+
+RECORD_HEADER = '!QqqQ'
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+
+MIRROR = False
+
+# records not appended yet: [(file_name, file_info)]
+PENDING = []
+LOCK = Lock()
+FLUSH_TIME = time.monotonic()
+NUM_RECORDS = 0  # records in the mirror index
+
+LOGGER = logging.getLogger(__name__)
+
+# metrics (reference -> observatory)
+RECORDS_WRITTEN = observatory.counter('mirror_index_records_total', 'records appended to the mirror index')
+BATCHES_WRITTEN = observatory.counter('mirror_index_batches_total', 'batches appended to the mirror index')
+
+
+def is_mirror():
+    return MIRROR
+
+
+def pack_record(file_name, file_info):
+    file_name_encoded = file_name.encode()
+    return struct.pack(RECORD_HEADER, len(file_name_encoded), file_info[file_center.FILE_INFO_MTIME],
+                       file_info[file_center.FILE_INFO_LAST_MODIFIED],
+                       file_info[file_center.FILE_INFO_NUM_BLOCKS]) + file_name_encoded
+
+
+def record(file_name, file_info):
+    """
+    index a delivered file, appended with the next batch
+    :param file_info: the file_info of the file (reference -> file_center)
+    :return: None
+    """
+    with LOCK:
+        PENDING.append(pack_record(file_name, file_info))
+        if len(PENDING) >= BATCH_SIZE:
+            flush()
+
+
+def flush_due():
+    """
+    append the pending records if the oldest waited BATCH_INTERVAL, called periodically
+    (reference -> download_manager.DownloadManager)
+    :return: None
+    """
+    if len(PENDING) == 0 or time.monotonic() - FLUSH_TIME < BATCH_INTERVAL:
+        return None
+    with LOCK:
+        flush()
+
+
+def flush():
+    """
+    append the pending records to the mirror index, only with the lock held
+    :return: None
+    """
+    global FLUSH_TIME, NUM_RECORDS
+
+    FLUSH_TIME = time.monotonic()
+    if len(PENDING) == 0:
+        return None
+    try:
+        with open(main.TEMP_DIR + TEMP_MIRROR_INDEX, 'ab') as f:
+            f.write(b''.join(PENDING))
+    except OSError as e:  # kept for the next batch
+        LOGGER.warning('failed to write the mirror index: %s', e)
+        return None
+    RECORDS_WRITTEN.inc(len(PENDING))
+    BATCHES_WRITTEN.inc()
+    NUM_RECORDS += len(PENDING)
+    PENDING.clear()
+    maybe_compact()
+
+
+def read():
+    """
+    read the mirror index into the file dict, the last record of a file applies
+    a record cut short when the host stopped is dropped
+    :return: the number of records read
+    """
+    index_path = main.TEMP_DIR + TEMP_MIRROR_INDEX
+    if not os.path.exists(index_path):
+        return 0
+    num_records = 0
+    position = 0
+    with open(index_path, 'rb') as f:
+        index = f.read()
+    while position + RECORD_HEADER_SIZE <= len(index):
+        file_name_size, mtime, last_modified, num_blocks = \
+            struct.unpack(RECORD_HEADER, index[position:position+RECORD_HEADER_SIZE])
+        end = position + RECORD_HEADER_SIZE + file_name_size
+        if end > len(index):
+            break
+        file_name = index[position+RECORD_HEADER_SIZE:end].decode()
+        position = end
+        num_records += 1
+        # ignored since it was indexed: not in the file dict (reference -> customs)
+        if customs.is_ignored(file_name):
+            continue
+        file_center.file_dict_add(file_name, mtime, last_modified, num_blocks, write=False, broadcast=False)
+    if position < len(index):
+        LOGGER.warning('dropping the last record of the mirror index, cut short')
+        with open(index_path, 'r+b') as f:
+            f.truncate(position)
+    return num_records
+
+
+def maybe_compact():
+    """
+    compact the mirror index once it holds COMPACT_RATIO records per indexed file, only with the lock held
+    :return: None
+    """
+    if NUM_RECORDS <= BATCH_SIZE or NUM_RECORDS <= COMPACT_RATIO * len(file_center.FILE_DICT):
+        return None
+    try:
+        compact()
+    except OSError as e:  # the index is kept as is
+        LOGGER.warning('failed to compact the mirror index: %s', e)
+        return None
+    LOGGER.info('mirror index compacted: %d records', NUM_RECORDS)
+
+
+def compact():
+    """
+    rewrite the mirror index with one record per file in the file dict
+    the records of the ignored files are dropped, they are downloaded again if no longer ignored
+    :return: None
+    """
+    global NUM_RECORDS
+
+    index_path = main.TEMP_DIR + TEMP_MIRROR_INDEX
+    num_records = 0
+    with open(index_path + '.tmp', 'wb') as f:
+        for file_name, file_info in file_center.FILE_DICT.items():
+            f.write(pack_record(file_name, file_info))
+            num_records += 1
+    os.replace(index_path + '.tmp', index_path)
+    NUM_RECORDS = num_records
+
+
+def looking_glass_init(mirror):
+    """
+    initialize the mirror mode, before the files being received are cleaned up (reference -> moving_van.cleanup)
+    :param mirror: whether the host is a receive-only mirror
+    :return: None
+    """
+    global MIRROR, NUM_RECORDS
+
+    MIRROR = mirror
+    if not MIRROR:
+        # stale: the files indexed by an earlier mirror run are scanned as local files
+        if os.path.exists(main.TEMP_DIR + TEMP_MIRROR_INDEX):
+            os.remove(main.TEMP_DIR + TEMP_MIRROR_INDEX)
+            LOGGER.info('mirror index of an earlier run deleted')
+        return None
+
+    NUM_RECORDS = read()
+    LOGGER.info('mirror index: %d files, %d records', len(file_center.FILE_DICT), NUM_RECORDS)
+    with LOCK:
+        maybe_compact()
+
+    # metrics (reference -> observatory)
+    observatory.gauge('mirror_index_pending', 'records waiting to be appended to the mirror index',
+                      lambda: len(PENDING))
@@ -1,27 +1,155 @@
 import os
 import argparse
-import file_center, download_manager, connection_hub
+import logging
+import math
+import socket
+import file_center, download_manager, connection_hub, service_desk, compression_station, assembly_line, warehouse, \
+    treasury, timetable, switchboard, tollbooth, observatory, records_office, black_box, zoning_board, \
+    customs, lighthouse, moving_van, looking_glass
 
 
 # config
 TEMP_DIR = './temp/'
 FILE_DIR = './share/'
+LOG_LEVELS = ['debug', 'info', 'warning', 'error']
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+LOGGER = logging.getLogger(__name__)
 
 peer_list = []
+peer_weights = {}
 compression = False
+codec_names = []
 encryption = False
+codec_workers = 0
+cache_size = warehouse.CAPACITY
+memory_budget = treasury.CAPACITY
+schedule_policy = timetable.POLICY
+pins = []
+control_port = switchboard.CONTROL_PORT
+limits = tollbooth.DEFAULT_LIMITS
+peer_limits = {}
+limit_schedule = []
+log_level = 'info'
+metrics_port = observatory.METRICS_PORT
+trace_path = None
+trace_format = records_office.FORMAT_JSONL
+trace_sample = records_office.SAMPLE_RATE
+bind_ip = ''
+listen_port = 0
+capture_path = None
+capture_payload = True
+shards = 1
+shard = None
+ignore_path = None
+peer_ignore_paths = {}
+heartbeat_interval = lighthouse.HEARTBEAT_INTERVAL
+dead_peer_timeout = lighthouse.DEAD_PEER_TIMEOUT
+stream_min_files = moving_van.STREAM_MIN_FILES
+mirror = False
 
 
 def get_arguments():
     # initialize argument parser
     parser = argparse.ArgumentParser(description='TwoDrive')
     parser.add_argument('--ip', action='store', default=None, type=str, help='peer ip addresses')
+    parser.add_argument('--bind', action='store', default='', type=str,
+                        help='local ip address to listen and connect from, default: any')
+    parser.add_argument('--listen-port', action='store', default=0, type=int,
+                        help='port to listen on, e.g. behind a proxy, 0: the port peers connect to (23456)')
     parser.add_argument('--encryption', action='store', default='', type=str, help='enable encryption [yes | no]')
+    parser.add_argument('--compression', action='store', default='', type=str, help='enable compression [yes | no]')
+    parser.add_argument('--codecs', action='store', default=None, type=str,
+                        help='accepted compression codecs [zlib-1,zlib-6,...], default: all')
+    parser.add_argument('--codec-workers', action='store', default=None, type=int,
+                        help='number of compression worker processes, 0: inline, default: one per core')
+    parser.add_argument('--cache-size', action='store', default=warehouse.CAPACITY // 1048576, type=int,
+                        help='size of the encoded block cache in MB, 0: disabled')
+    parser.add_argument('--memory-budget', action='store', default=treasury.CAPACITY // 1048576, type=int,
+                        help='size of the block data in flight in MB, 0: no limit')
+    parser.add_argument('--weight', action='store', default=None, type=str,
+                        help='block serving weights of peers [ip:weight,ip:weight,...]')
+    parser.add_argument('--schedule', action='store', default=timetable.POLICY, type=str,
+                        help='download scheduling policy [' + ' | '.join(timetable.POLICIES) + ']')
+    parser.add_argument('--pin', action='store', default=None, type=str,
+                        help='download priorities of paths [pattern:priority,pattern:priority,...]')
+    parser.add_argument('--control-port', action='store', default=switchboard.CONTROL_PORT, type=int,
+                        help='localhost control port, 0: disabled')
+    parser.add_argument('--upload-limit', action='store', default=0, type=int,
+                        help='upload rate limit of block data in KB/s, 0: no limit')
+    parser.add_argument('--download-limit', action='store', default=0, type=int,
+                        help='download rate limit of block data in KB/s, 0: no limit')
+    parser.add_argument('--peer-limit', action='store', default=None, type=str,
+                        help='rate limits of peers in KB/s [ip:upload/download,ip:upload/download,...]')
+    parser.add_argument('--limit-schedule', action='store', default=None, type=str,
+                        help='time-of-day rate limits in KB/s [HH:MM-HH:MM=upload/download,...]')
+    parser.add_argument('--log-level', action='store', default='info', type=str,
+                        help='log level [' + ' | '.join(LOG_LEVELS) + '], debug: every message sent and received')
+    parser.add_argument('--metrics-port', action='store', default=observatory.METRICS_PORT, type=int,
+                        help='localhost port of the Prometheus metrics endpoint, 0: disabled')
+    parser.add_argument('--trace-file', action='store', default=None, type=str,
+                        help='file to write the block transfer traces to, default: tracing disabled')
+    parser.add_argument('--trace-format', action='store', default=records_office.FORMAT_JSONL, type=str,
+                        help='trace file format [' + ' | '.join(records_office.FORMATS) + ']')
+    parser.add_argument('--trace-sample', action='store', default=records_office.SAMPLE_RATE, type=float,
+                        help='share of the blocks traced, 0..1')
+    parser.add_argument('--capture-file', action='store', default=None, type=str,
+                        help='file to capture every message sent and received to, default: capture disabled')
+    parser.add_argument('--capture-payload', action='store', default='yes', type=str,
+                        help='capture the messages, or only their digests [yes | no]')
+    parser.add_argument('--shards', action='store', default=1, type=int,
+                        help='number of shard processes owning a partition of the share each, '
+                             'peers must run the same number, 1: not sharded')
+    parser.add_argument('--shard', action='store', default=None, type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--ignore-file', action='store', default=None, type=str,
+                        help='ignore rules of the paths, in the gitignore format, default: none')
+    parser.add_argument('--peer-ignore', action='store', default=None, type=str,
+                        help='ignore rules of the paths exchanged with peers [ip:file,ip:file,...]')
+    parser.add_argument('--heartbeat-interval', action='store', default=lighthouse.HEARTBEAT_INTERVAL, type=float,
+                        help='seconds between two heartbeats sent to each peer')
+    parser.add_argument('--dead-peer-timeout', action='store', default=lighthouse.DEAD_PEER_TIMEOUT, type=float,
+                        help='seconds without a message before a peer is declared dead and its requests are '
+                             'sent to the other peers')
+    parser.add_argument('--stream-min-files', action='store', default=moving_van.STREAM_MIN_FILES, type=int,
+                        help='missing files from which a peer is asked to stream them instead of sending them '
+                             'block by block (always if this host has no file yet), 0: disabled')
+    parser.add_argument('--mirror', action='store', default='', type=str,
+                        help='receive-only mirror: the share is not watched and nothing is served [yes | no]')
 
     # get arguments from parser
     arguments = parser.parse_args()
     arguments_ip = arguments.ip
+    arguments_bind = arguments.bind
+    arguments_listen_port = arguments.listen_port
     arguments_encryption = arguments.encryption
+    arguments_compression = arguments.compression
+    arguments_codecs = arguments.codecs
+    arguments_codec_workers = arguments.codec_workers
+    arguments_cache_size = arguments.cache_size
+    arguments_memory_budget = arguments.memory_budget
+    arguments_weight = arguments.weight
+    arguments_schedule = arguments.schedule
+    arguments_pin = arguments.pin
+    arguments_control_port = arguments.control_port
+    arguments_upload_limit = arguments.upload_limit
+    arguments_download_limit = arguments.download_limit
+    arguments_peer_limit = arguments.peer_limit
+    arguments_limit_schedule = arguments.limit_schedule
+    arguments_log_level = arguments.log_level
+    arguments_metrics_port = arguments.metrics_port
+    arguments_trace_file = arguments.trace_file
+    arguments_trace_format = arguments.trace_format
+    arguments_trace_sample = arguments.trace_sample
+    arguments_capture_file = arguments.capture_file
+    arguments_capture_payload = arguments.capture_payload
+    arguments_shards = arguments.shards
+    arguments_shard = arguments.shard
+    arguments_ignore_file = arguments.ignore_file
+    arguments_peer_ignore = arguments.peer_ignore
+    arguments_heartbeat_interval = arguments.heartbeat_interval
+    arguments_dead_peer_timeout = arguments.dead_peer_timeout
+    arguments_stream_min_files = arguments.stream_min_files
+    arguments_mirror = arguments.mirror
 
     # process ip
     if arguments_ip is not None:
@@ -42,17 +170,233 @@ def get_arguments():
     else:
         ip_list = []
 
+    # process bind
+    if arguments_bind != '':
+        try:
+            socket.inet_aton(arguments_bind)
+        except OSError as e:
+            print('IP format incorrect in:', arguments_bind, e)
+            exit(0)
+
+    # process listen port
+    if arguments_listen_port < 0 or arguments_listen_port > 65535:
+        print('listen port incorrect:', arguments_listen_port)
+        exit(0)
+
+    # process shards
+    if arguments_shards < 1 or arguments_shards > zoning_board.MAX_SHARDS:
+        print('shards incorrect:', arguments_shards, 'maximum:', zoning_board.MAX_SHARDS)
+        exit(0)
+    if arguments_shard is not None and (arguments_shard < 0 or arguments_shard >= arguments_shards):
+        print('shard incorrect:', arguments_shard)
+        exit(0)
+
+    # process ignore
+    if arguments_ignore_file is not None and not os.path.isfile(arguments_ignore_file):
+        print('ignore file not found:', arguments_ignore_file)
+        exit(0)
+    peer_ignore_files = {}
+    if arguments_peer_ignore is not None:
+        for peer_ignore_entry in arguments_peer_ignore.split(','):
+            try:
+                ip, ignore_file = peer_ignore_entry.split(':', 1)
+            except ValueError as e:
+                print('peer ignore format incorrect in:', peer_ignore_entry, e)
+                exit(0)
+            if not os.path.isfile(ignore_file):
+                print('ignore file not found:', ignore_file)
+                exit(0)
+            peer_ignore_files[ip] = ignore_file
+
+    # process heartbeats: a live peer sends several heartbeats within the timeout
+    if arguments_heartbeat_interval <= 0:
+        print('heartbeat interval incorrect:', arguments_heartbeat_interval)
+        exit(0)
+    if arguments_dead_peer_timeout < 2 * arguments_heartbeat_interval:
+        print('dead peer timeout incorrect:', arguments_dead_peer_timeout, 'minimum:',
+              2 * arguments_heartbeat_interval)
+        exit(0)
+
+    # process stream
+    if arguments_stream_min_files < 0:
+        print('stream min files incorrect:', arguments_stream_min_files)
+        exit(0)
+
+    # process mirror
+    use_mirror = False
+    if arguments_mirror == 'yes':
+        use_mirror = True
+
     # process encryption
     use_encryption = False
     if arguments_encryption == 'yes':
         use_encryption = True
 
-    return ip_list, use_encryption
+    # process compression
+    use_compression = False
+    if arguments_compression == 'yes':
+        use_compression = True
+
+    # process codecs
+    codecs = []
+    if arguments_codecs is not None:
+        codecs = arguments_codecs.split(',')
+        for codec_name in codecs:
+            if compression_station.get_codec(codec_name) in (None, compression_station.CODEC_RAW):
+                print('codec incorrect in:', codec_name)
+                exit(0)
+
+    # process codec workers
+    if arguments_codec_workers is None:
+        # the shards split the cores, each keeps a worker if the host uses workers
+        workers = assembly_line.default_workers(use_compression)
+        if workers > 0:
+            workers = max(workers // arguments_shards, 1)
+    elif arguments_codec_workers >= 0:
+        workers = arguments_codec_workers
+    else:
+        print('codec workers incorrect:', arguments_codec_workers)
+        exit(0)
+
+    # process cache size
+    if arguments_cache_size < 0:
+        print('cache size incorrect:', arguments_cache_size)
+        exit(0)
+    capacity = arguments_cache_size * 1048576
+
+    # process memory budget
+    budget = arguments_memory_budget * 1048576
+    if budget != 0 and budget // arguments_shards < treasury.MIN_CAPACITY:
+        print('memory budget incorrect:', arguments_memory_budget, 'minimum:',
+              treasury.MIN_CAPACITY * arguments_shards // 1048576)
+        exit(0)
+
+    # process weight
+    weights = {}
+    if arguments_weight is not None:
+        for weight_entry in arguments_weight.split(','):
+            try:
+                ip, weight = weight_entry.split(':')
+                weights[ip] = float(weight)
+                if weights[ip] <= 0:
+                    raise ValueError('weight must be positive')
+            except ValueError as e:
+                print('weight format incorrect in:', weight_entry, e)
+                exit(0)
+
+    # process schedule
+    if arguments_schedule not in timetable.POLICIES:
+        print('schedule incorrect:', arguments_schedule)
+        exit(0)
+
+    # process pin
+    pin_list = []
+    if arguments_pin is not None:
+        for pin_entry in arguments_pin.split(','):
+            try:
+                pattern, priority = pin_entry.rsplit(':', 1)
+                pin_list.append((pattern, int(priority)))
+            except ValueError as e:
+                print('pin format incorrect in:', pin_entry, e)
+                exit(0)
+
+    # process control port
+    if arguments_control_port < 0 or arguments_control_port > 65535:
+        print('control port incorrect:', arguments_control_port)
+        exit(0)
+
+    # process limits
+    try:
+        rate_limits = [tollbooth.parse_rate(arguments_upload_limit), tollbooth.parse_rate(arguments_download_limit)]
+    except ValueError as e:
+        print('limit incorrect:', e)
+        exit(0)
+
+    # process peer limit
+    peer_rate_limits = {}
+    if arguments_peer_limit is not None:
+        for peer_limit_entry in arguments_peer_limit.split(','):
+            try:
+                ip, rates = peer_limit_entry.split(':')
+                peer_rate_limits[ip] = [tollbooth.parse_rate(rate) for rate in rates.split('/')]
+                if len(peer_rate_limits[ip]) != 2:
+                    raise ValueError('upload/download expected')
+            except ValueError as e:
+                print('peer limit format incorrect in:', peer_limit_entry, e)
+                exit(0)
+
+    # process limit schedule
+    schedule_list = []
+    if arguments_limit_schedule is not None:
+        try:
+            schedule_list = tollbooth.parse_schedule(arguments_limit_schedule)
+        except ValueError as e:
+            print(e)
+            exit(0)
+
+    # process heartbeats against the limits: a chunk of block data at the lowest rate of a shard
+    # arrives well within the dead peer timeout (reference -> lighthouse)
+    limited_rates = rate_limits + [rate for rates in peer_rate_limits.values() for rate in rates] + \
+        [rate for _, _, upload_rate, download_rate in schedule_list for rate in (upload_rate, download_rate)]
+    limited_rates = [rate / arguments_shards for rate in limited_rates if rate > 0]
+    if len(limited_rates) > 0 and arguments_dead_peer_timeout < 2 * tollbooth.CHUNK_SIZE / min(limited_rates):
+        print('dead peer timeout incorrect:', arguments_dead_peer_timeout, 'minimum at the rate limits:',
+              math.ceil(2 * tollbooth.CHUNK_SIZE / min(limited_rates)))
+        exit(0)
+
+    # process log level
+    if arguments_log_level not in LOG_LEVELS:
+        print('log level incorrect:', arguments_log_level)
+        exit(0)
+
+    # process metrics port
+    if arguments_metrics_port < 0 or arguments_metrics_port > 65535:
+        print('metrics port incorrect:', arguments_metrics_port)
+        exit(0)
+
+    # process trace
+    if arguments_trace_format not in records_office.FORMATS:
+        print('trace format incorrect:', arguments_trace_format)
+        exit(0)
+    if arguments_trace_sample < 0 or arguments_trace_sample > 1:
+        print('trace sample incorrect:', arguments_trace_sample)
+        exit(0)
+
+    # process capture
+    if arguments_capture_payload not in ('yes', 'no'):
+        print('capture payload incorrect:', arguments_capture_payload)
+        exit(0)
+    use_capture_payload = arguments_capture_payload == 'yes'
+
+    return ip_list, use_encryption, use_compression, codecs, workers, capacity, budget, weights, \
+        arguments_schedule, pin_list, arguments_control_port, rate_limits, peer_rate_limits, schedule_list, \
+        arguments_log_level, arguments_metrics_port, arguments_trace_file, arguments_trace_format, \
+        arguments_trace_sample, arguments_bind, arguments_listen_port, arguments_capture_file, use_capture_payload, \
+        arguments_shards, arguments_shard, arguments_ignore_file, peer_ignore_files, arguments_heartbeat_interval, \
+        arguments_dead_peer_timeout, arguments_stream_min_files, use_mirror
 
 
 def main_init():
-    print('peer_list:', peer_list)
-    print('encryption:', encryption)
+    logging.basicConfig(level=log_level.upper(), format=LOG_FORMAT)
+    LOGGER.info('peer_list: %s', peer_list)
+    LOGGER.info('bind: %s %d', bind_ip, listen_port)
+    LOGGER.info('encryption: %s', encryption)
+    LOGGER.info('compression: %s %s', compression, codec_names)
+    LOGGER.info('codec_workers: %d', codec_workers)
+    LOGGER.info('cache_size: %d', cache_size)
+    LOGGER.info('memory_budget: %d', memory_budget)
+    LOGGER.info('peer_weights: %s', peer_weights)
+    LOGGER.info('schedule: %s %s', schedule_policy, pins)
+    LOGGER.info('control_port: %d', control_port)
+    LOGGER.info('limits: %s %s %s', limits, peer_limits, limit_schedule)
+    LOGGER.info('metrics_port: %d', metrics_port)
+    LOGGER.info('trace: %s %s %s', trace_path, trace_format, trace_sample)
+    LOGGER.info('capture: %s %s', capture_path, capture_payload)
+    LOGGER.info('shards: %d %s', shards, shard)
+    LOGGER.info('ignore: %s %s', ignore_path, peer_ignore_paths)
+    LOGGER.info('heartbeat: %s %s', heartbeat_interval, dead_peer_timeout)
+    LOGGER.info('stream_min_files: %d', stream_min_files)
+    LOGGER.info('mirror: %s', mirror)
 
     # initialize the temp directory
     if not os.path.exists(FILE_DIR):
@@ -62,12 +406,64 @@ def main_init():
 
 
 if __name__ == '__main__':
-    peer_list, encryption = get_arguments()
+    peer_list, encryption, compression, codec_names, codec_workers, cache_size, memory_budget, peer_weights, \
+        schedule_policy, pins, control_port, limits, peer_limits, limit_schedule, log_level, metrics_port, \
+        trace_path, trace_format, trace_sample, bind_ip, listen_port, capture_path, capture_payload, shards, \
+        shard, ignore_path, peer_ignore_paths, heartbeat_interval, dead_peer_timeout, stream_min_files, \
+        mirror = get_arguments()
 
     main_init()
 
+    # sharded: the front process only runs the shard processes (reference -> zoning_board)
+    if shards > 1 and shard is None:
+        exit(zoning_board.run_shards(shards))
+
+    zoning_board.zoning_board_init(shard, shards)
+
+    # the shards split the budgets, limits, ports and output files of the host
+    cache_size = zoning_board.share(cache_size)
+    memory_budget = zoning_board.share(memory_budget)
+    limits = [zoning_board.share(rate) for rate in limits]
+    peer_limits = {ip: [zoning_board.share(rate) for rate in rates] for ip, rates in peer_limits.items()}
+    limit_schedule = [(start, end, zoning_board.share(upload_rate), zoning_board.share(download_rate))
+                      for start, end, upload_rate, download_rate in limit_schedule]
+    control_port = zoning_board.shard_port(control_port)
+    metrics_port = zoning_board.shard_port(metrics_port)
+    trace_path = zoning_board.shard_path(trace_path)
+    capture_path = zoning_board.shard_path(capture_path)
+
+    treasury.treasury_init(memory_budget)
+
+    compression_station.compression_station_init(compression, codec_names)
+
+    assembly_line.assembly_line_init(codec_workers)
+
+    warehouse.warehouse_init(cache_size)
+
+    timetable.timetable_init(schedule_policy, pins)
+
+    tollbooth.tollbooth_init(limits, peer_limits, limit_schedule)
+
+    records_office.records_office_init(trace_path, trace_format, trace_sample)
+
+    black_box.black_box_init(capture_path, capture_payload)
+
+    customs.customs_init(ignore_path, peer_ignore_paths)
+
+    looking_glass.looking_glass_init(mirror)
+
+    moving_van.moving_van_init(stream_min_files)
+
     file_center.file_center_init()
 
     download_manager.download_manager_init()
 
-    connection_hub.connection_hub_init(peer_list, encryption)
+    service_desk.service_desk_init(peer_weights)
+
+    lighthouse.lighthouse_init(heartbeat_interval, dead_peer_timeout)
+
+    connection_hub.connection_hub_init(peer_list, encryption, bind_ip, listen_port)
+
+    switchboard.switchboard_init(control_port)
+
+    observatory.observatory_init(metrics_port)
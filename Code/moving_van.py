@@ -0,0 +1,676 @@
+"""
+moving_van provides the seed stream: the bootstrap of an empty or far-behind host
+
+a host that misses files from a peer downloads them block by block (reference -> download_manager), a round trip,
+a temp block, an assembly and a move per block: too slow to seed a whole share
+a host with no file yet, or that misses at least STREAM_MIN_FILES files of the file dict of a peer, asks the peer
+for a stream of the missing files instead: the peer reads the files one after the other, in path order, and sends
+them as one continuous sequence of records, packed into stream messages of STREAM_MESSAGE_SIZE, compressed with the
+codec of the peer (reference -> compression_station) and rate limited as the blocks (reference -> tollbooth)
+each file is written directly to its place in the share, and indexed once its digest is checked
+(reference -> quality_control.file_hasher), while it is written it is not scanned as a local file
+(reference -> file_center.GrandCentralDispatch)
+
+the stream is resumable by file: the files received are indexed, the file being received when the connection is lost
+is deleted, and the remaining files are requested again once connected (a new stream id, the messages of the old
+stream are dropped); on restart, the files being received are deleted (reference -> TEMP_STREAMING) and requested
+again with the next file dict of the peer
+a file the peer cannot send (deleted, modified while read), that fails the digest check, or a stream without progress
+for STREAM_TIMEOUT fall back to the block downloads (reference -> download_manager.stream_fallback_handler)
+
+stream request: (reference -> connection_hub)
+stream_id !Q
+file names w/ pickle: [file_name], in the order to send
+
+stream: (reference -> connection_hub)
+codec !B (reference -> compression_station)
+compressed with codec:
+    stream_id !Q
+    records: kind !B + size !Q + body
+    RECORD_FILE: file_name_size !Q + file_name w/ encode + file_info w/ pickle, the file starts
+    RECORD_DATA: content of the file, in order
+    RECORD_END: digest of the content of the file (reference -> quality_control)
+    RECORD_SKIP: file_name_size !Q + file_name w/ encode + file_info w/ pickle (empty: the peer does not have
+                 the file), the file is not sent, or not completely
+    RECORD_DONE: empty, the stream is complete
+"""
+import logging
+import os
+import pickle
+import random
+import struct
+import time
+from queue import Queue, Empty
+from threading import Thread, Lock
+import connection_hub, file_center, download_manager, main, quality_control, assembly_line, treasury, customs, \
+    observatory, switchboard
+
+# config
+STREAM_MIN_FILES = 100  # missing files from which a peer is asked for a stream, 0: disabled
+STREAM_MESSAGE_SIZE = 2097152  # 2MB, records are packed into messages of this size
+STREAM_CHUNK_SIZE = 1048576  # 1MB, content read and sent per data record
+STREAM_TIMEOUT = 300  # seconds without a stream message before the remaining files fall back to the block downloads
+CHECK_INTERVAL = 1  # seconds between two checks of the stream timeouts
+IDLE_WAIT = 0.2  # seconds a loader waits for the memory budget before checking its state again
+TEMP_STREAMING = 'streaming/'  # a file for each file being received, deleted once the file is indexed
+
+RECORD_FILE = 0
+RECORD_DATA = 1
+RECORD_END = 2
+RECORD_SKIP = 3
+RECORD_DONE = 4
+
+# messages of the download manager to the moving van, not sent over the network
+MESSAGE_DISCARD = -1
+
+"""
+stream dictionaries
+
+* STREAM_DICT format: streams received
+{peer_ip: Stream}
+
+* EXPECTED_DICT format: files expected from a stream, not downloaded block by block
+{file_name: Stream}
+
+* LOADER_DICT format: streams sent
+{peer_ip: Loader}
+"""
+STREAM_DICT = {}
+EXPECTED_DICT = {}
+LOADER_DICT = {}
+LOCK = Lock()  # STREAM_DICT, EXPECTED_DICT and the file_infos of the streams
+
+MOVING_VAN = None
+
+LOGGER = logging.getLogger(__name__)
+
+# metrics (reference -> observatory)
+FILES_RECEIVED = observatory.counter('stream_files_received_total', 'files received by stream and indexed',
+                                     ('peer',))
+BYTES_RECEIVED = observatory.counter('stream_bytes_received_total', 'file content received by stream', ('peer',))
+FILES_SENT = observatory.counter('stream_files_sent_total', 'files sent by stream', ('peer',))
+BYTES_SENT = observatory.counter('stream_bytes_sent_total', 'file content sent by stream', ('peer',))
+FALLBACKS = observatory.counter('stream_fallbacks_total', 'files of a stream downloaded block by block instead',
+                                ('peer',))
+
+
+class Stream:
+    """
+    a stream received from a peer
+    self.stream_id: id of the stream requested, None while not requested (peer not connected)
+    self.file_infos: {file_name: file_info} of the files not received yet
+    self.file_name, self.file, self.hasher: the file being received, None between two files
+    self.progress_time: time.monotonic() of the last message, or of the last request / suspension
+    """
+
+    def __init__(self, peer_ip):
+        self.peer_ip = peer_ip
+        self.stream_id = None
+        self.file_infos = {}
+        self.file_name = None
+        self.file = None
+        self.hasher = None
+        self.progress_time = time.monotonic()
+
+
+class MovingVan(Thread):
+    """
+    writes the received streams
+
+    message_queue format: (peer_ip, message_type, message)
+
+    message_type:
+    connection_hub.MESSAGE_STREAM: (stream message, reserved)
+    reserved: memory of the message acquired from the budget (reference -> treasury), released once written
+    MESSAGE_DISCARD: the Stream, suspended: the file being received is deleted
+    """
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.message_queue = Queue(0)
+        self.check_time = time.monotonic()
+
+    def send(self, message):
+        self.message_queue.put(message)
+
+    def run(self):
+        while True:
+            try:
+                package = self.message_queue.get(timeout=CHECK_INTERVAL)
+            except Empty:
+                package = None
+            if package is not None:
+                self.message_queue.task_done()
+                peer_ip, message_type, message = package
+                if message_type == connection_hub.MESSAGE_STREAM:
+                    stream_message, reserved = message
+                    try:
+                        self.unload(peer_ip, stream_message)
+                    finally:
+                        treasury.TREASURY.release(reserved, treasury.ACCOUNT_RECEIVE)
+                elif message_type == MESSAGE_DISCARD:
+                    discard_file(message)
+
+            # give up the streams without progress every CHECK_INTERVAL
+            if time.monotonic() - self.check_time > CHECK_INTERVAL:
+                self.check_time = time.monotonic()
+                check_streams()
+
+    def unload(self, peer_ip, message):
+        """
+        write the records of a stream message
+        :return: None
+        """
+        stream_id = struct.unpack('!Q', message[:8])[0]
+        stream = STREAM_DICT.get(peer_ip)
+        view = memoryview(message)
+        position = 8
+        while position < len(message):
+            # messages of an old stream (before a reconnection) are dropped
+            if stream is None or stream.stream_id != stream_id:
+                return None
+            stream.progress_time = time.monotonic()
+            kind, size = struct.unpack('!BQ', view[position:position+9])
+            body = view[position+9:position+9+size]
+            position += 9 + size
+            if kind == RECORD_FILE:
+                open_file(stream, body)
+            elif kind == RECORD_DATA:
+                write_file(stream, body)
+            elif kind == RECORD_END:
+                close_file(stream, bytes(body))
+            elif kind == RECORD_SKIP:
+                skip_file(stream, body)
+            elif kind == RECORD_DONE:
+                LOGGER.info('stream from %s complete', peer_ip)
+                finish(stream)
+
+
+class Loader(Thread):
+    """
+    sends a stream to a peer, stops once replaced by another request of the peer or once the connection is lost
+    """
+
+    def __init__(self, peer_ip, stream_id, file_names, outbox_thread):
+        Thread.__init__(self)
+        self.on = True
+        self.peer_ip = peer_ip
+        self.stream_id = stream_id
+        self.file_names = file_names
+        self.outbox_thread = outbox_thread
+        # the connection the stream was requested on, the messages queued on another one are not expected
+        self.outbox_socket = outbox_thread.outbox_socket
+        self.buffer = bytearray()
+        self.sent = 0
+
+    def is_on(self):
+        return self.on and self.outbox_thread.outbox_socket is self.outbox_socket and self.outbox_socket is not None
+
+    def off(self):
+        self.on = False
+
+    def run(self):
+        LOGGER.info('streaming %d files to %s', len(self.file_names), self.peer_ip)
+        self.buffer = bytearray(struct.pack('!Q', self.stream_id))
+        try:
+            for file_name in self.file_names:
+                if not self.is_on():
+                    LOGGER.info('stream to %s stopped: %d of %d files sent', self.peer_ip, self.sent,
+                                len(self.file_names))
+                    return None
+                self.load(file_name)
+            self.add(RECORD_DONE, b'')
+            self.flush()
+            LOGGER.info('stream to %s complete: %d files sent', self.peer_ip, self.sent)
+        finally:
+            with LOCK:
+                if LOADER_DICT.get(self.peer_ip) is self:
+                    LOADER_DICT.pop(self.peer_ip)
+
+    def load(self, file_name):
+        """
+        add the records of a file
+        :return: None
+        """
+        file_info = file_center.FILE_DICT.get(file_name)
+        # not available: deleted, ignored for the peer (reference -> customs), or being updated
+        if file_info is None or customs.is_ignored(file_name, self.peer_ip) or \
+                file_center.FILE_DICT.get_block_status(file_name) > 0:
+            self.skip(file_name)
+            return None
+        hasher = quality_control.file_hasher()
+        try:
+            with open(main.FILE_DIR + file_name, 'rb') as f:
+                self.add(RECORD_FILE, pack_file_info(file_name, file_info))
+                while True:
+                    if not self.is_on():
+                        return None
+                    chunk = f.read(STREAM_CHUNK_SIZE)
+                    if len(chunk) == 0:
+                        break
+                    hasher.update(chunk)
+                    self.add(RECORD_DATA, chunk)
+                    BYTES_SENT.inc(len(chunk), (self.peer_ip,))
+                modified = int(os.fstat(f.fileno()).st_mtime) != file_info[file_center.FILE_INFO_MTIME]
+        except OSError as e:
+            LOGGER.warning('failed to stream: %s %s', file_name, e)
+            self.skip(file_name)
+            return None
+        # modified while read: the content may mix two versions
+        if modified:
+            self.skip(file_name)
+            return None
+        self.add(RECORD_END, hasher.digest())
+        self.sent += 1
+        FILES_SENT.inc(1, (self.peer_ip,))
+
+    def skip(self, file_name):
+        file_info = file_center.FILE_DICT.get(file_name)
+        if customs.is_ignored(file_name, self.peer_ip):
+            file_info = None
+        self.add(RECORD_SKIP, pack_file_info(file_name, file_info))
+
+    def add(self, kind, body):
+        """
+        add a record, send the stream message once full
+        :return: None
+        """
+        self.buffer += struct.pack('!BQ', kind, len(body))
+        self.buffer += body
+        if len(self.buffer) >= STREAM_MESSAGE_SIZE:
+            self.flush()
+
+    def flush(self):
+        """
+        encode the stream message and queue it to the outbox
+        :return: None
+        """
+        message = bytes(self.buffer)
+        self.buffer = bytearray(struct.pack('!Q', self.stream_id))
+        if len(message) <= 8:
+            return None
+        # acquire the memory of the message, the outbox releases it once sent (reference -> treasury)
+        while not treasury.TREASURY.acquire(len(message), treasury.ACCOUNT_SEND, timeout=IDLE_WAIT):
+            if not self.is_on():
+                return None
+        codec_selector = self.outbox_thread.codec_selector
+        codec = codec_selector.choose(message)
+        future = assembly_line.submit_encode(message, codec)
+
+        def record(done_future):
+            # update the codec statistics of the peer once encoded
+            if done_future.exception() is None:
+                _, compressed_size, seconds = done_future.result()
+                codec_selector.record(codec, len(message), compressed_size, seconds)
+
+        future.add_done_callback(record)
+        self.outbox_thread.send((connection_hub.MESSAGE_STREAM, (future, len(message), None)))
+
+
+def pack_file_info(file_name, file_info):
+    """
+    :param file_info: the file_info, None if not available
+    :return: file_name_size !Q + file_name w/ encode + file_info w/ pickle (empty if None)
+    """
+    file_name_encoded = file_name.encode()
+    pickled_file_info = pickle.dumps(file_info) if file_info is not None else b''
+    return struct.pack('!Q', len(file_name_encoded)) + file_name_encoded + pickled_file_info
+
+
+def unpack_file_info(body):
+    """
+    :return: (file_name, file_info), file_info None if not available
+    """
+    file_name_size = struct.unpack('!Q', body[:8])[0]
+    file_name = bytes(body[8:8+file_name_size]).decode()
+    pickled_file_info = body[8+file_name_size:]
+    file_info = pickle.loads(pickled_file_info) if len(pickled_file_info) > 0 else None
+    return file_name, file_info
+
+
+def open_file(stream, body):
+    """
+    a file starts: write it in place, recorded in temp until indexed
+    :return: None
+    """
+    discard_file(stream)
+    file_name, file_info = unpack_file_info(body)
+    with LOCK:
+        expected = file_name in stream.file_infos
+        if expected:
+            stream.file_infos[file_name] = file_info
+    # not expected (e.g. fell back to the block downloads), or added locally meanwhile: not overwritten
+    if not expected or file_name in file_center.FILE_DICT:
+        if expected:
+            done(stream, file_name)
+        return None
+    file_location = file_name[:len(file_name) - len(file_name.split('/')[-1])]
+    try:
+        os.makedirs(main.TEMP_DIR + TEMP_STREAMING + file_location, exist_ok=True)
+        open(main.TEMP_DIR + TEMP_STREAMING + file_name, 'wb').close()
+        os.makedirs(main.FILE_DIR + file_location, exist_ok=True)
+        stream.file = open(main.FILE_DIR + file_name, 'wb')
+    except OSError as e:
+        LOGGER.warning('failed to receive: %s %s', file_name, e)
+        fall_back(stream, [file_name])
+        return None
+    stream.file_name = file_name
+    stream.hasher = quality_control.file_hasher()
+
+
+def write_file(stream, body):
+    if stream.file is None:
+        return None
+    try:
+        stream.file.write(body)
+    except OSError as e:
+        LOGGER.warning('failed to receive: %s %s', stream.file_name, e)
+        file_name = stream.file_name
+        discard_file(stream)
+        fall_back(stream, [file_name])
+        return None
+    stream.hasher.update(body)
+    BYTES_RECEIVED.inc(len(body), (stream.peer_ip,))
+
+
+def close_file(stream, file_digest):
+    """
+    the file is complete: index it if intact, otherwise download it block by block
+    :return: None
+    """
+    if stream.file is None:
+        return None
+    file_name = stream.file_name
+    try:
+        stream.file.close()
+    except OSError as e:
+        LOGGER.warning('failed to receive: %s %s', file_name, e)
+        discard_file(stream)
+        fall_back(stream, [file_name])
+        return None
+    stream.file = None
+    stream.file_name = None
+    if stream.hasher.digest() != file_digest:
+        LOGGER.warning('digest mismatch: %s from %s', file_name, stream.peer_ip)
+        remove(main.FILE_DIR + file_name)
+        remove(main.TEMP_DIR + TEMP_STREAMING + file_name)
+        fall_back(stream, [file_name])
+        return None
+    file_info = stream.file_infos[file_name]
+    mtime = int(os.path.getmtime(main.FILE_DIR + file_name))
+    file_center.file_dict_add(file_name, mtime, file_info[file_center.FILE_INFO_LAST_MODIFIED],
+                              file_info[file_center.FILE_INFO_NUM_BLOCKS], write=True, broadcast=False)
+    remove(main.TEMP_DIR + TEMP_STREAMING + file_name)
+    done(stream, file_name)
+    FILES_RECEIVED.inc(1, (stream.peer_ip,))
+    LOGGER.debug('streamed: %s', file_name)
+    # the other peers can request the file now
+    file_center.broadcast_file_added(file_name)
+
+
+def skip_file(stream, body):
+    """
+    the peer does not send the file: download it block by block, if the peer still has it
+    :return: None
+    """
+    file_name, file_info = unpack_file_info(body)
+    if stream.file_name == file_name:
+        discard_file(stream)
+    with LOCK:
+        if file_name not in stream.file_infos:
+            return None
+        if file_info is not None:
+            stream.file_infos[file_name] = file_info
+    if file_info is None:
+        done(stream, file_name)
+        return None
+    fall_back(stream, [file_name])
+
+
+def discard_file(stream):
+    """
+    delete the file being received, it is requested again with the remaining files
+    :return: None
+    """
+    if stream.file is None:
+        return None
+    try:
+        stream.file.close()
+    except OSError:
+        pass
+    remove(main.FILE_DIR + stream.file_name)
+    remove(main.TEMP_DIR + TEMP_STREAMING + stream.file_name)
+    stream.file = None
+    stream.file_name = None
+
+
+def finish(stream):
+    """
+    the stream is complete or given up: the files not received fall back to the block downloads
+    :return: None
+    """
+    discard_file(stream)
+    with LOCK:
+        if STREAM_DICT.get(stream.peer_ip) is stream:
+            STREAM_DICT.pop(stream.peer_ip)
+        remaining = list(stream.file_infos)
+    fall_back(stream, remaining)
+
+
+def done(stream, file_name):
+    """
+    the file is not expected from the stream anymore
+    :return: file_info of the file
+    """
+    with LOCK:
+        if EXPECTED_DICT.get(file_name) is stream:
+            EXPECTED_DICT.pop(file_name)
+        return stream.file_infos.pop(file_name, None)
+
+
+def fall_back(stream, file_names):
+    """
+    download the files block by block (reference -> download_manager)
+    :return: None
+    """
+    file_infos = {}
+    for file_name in file_names:
+        file_info = done(stream, file_name)
+        if file_info is not None:
+            file_infos[file_name] = file_info
+    if len(file_infos) == 0:
+        return None
+    FALLBACKS.inc(len(file_infos), (stream.peer_ip,))
+    download_manager.stream_fallback(stream.peer_ip, file_infos)
+
+
+def check_streams():
+    """
+    give up the streams without progress for STREAM_TIMEOUT: the remaining files fall back to the block downloads
+    :return: None
+    """
+    now = time.monotonic()
+    for peer_ip, stream in list(STREAM_DICT.items()):
+        if now - stream.progress_time <= STREAM_TIMEOUT:
+            continue
+        LOGGER.warning('stream from %s timed out: %d files left', peer_ip, len(stream.file_infos))
+        with LOCK:
+            stream.stream_id = None
+        finish(stream)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def is_expected(file_name):
+    """
+    :return: whether the file is expected from a stream, it is not downloaded block by block meanwhile
+    """
+    return file_name in EXPECTED_DICT
+
+
+def is_far_behind(num_missing):
+    """
+    :param num_missing: number of files of the file dict of a peer this host does not have
+    :return: whether to ask the peer for a stream: this host has no file yet, or misses at least STREAM_MIN_FILES
+    """
+    if STREAM_MIN_FILES == 0 or num_missing == 0:
+        return False
+    if len(file_center.FILE_DICT) == 0 and len(download_manager.DOWNLOAD_DICT) == 0 and len(EXPECTED_DICT) == 0:
+        return True
+    return num_missing >= STREAM_MIN_FILES
+
+
+def start_stream(peer_ip, file_infos):
+    """
+    ask the peer for a stream of the files, added to the stream from the peer if any
+    for the download manager
+    :param file_infos: {file_name: file_info}
+    :return: None
+    """
+    with LOCK:
+        stream = STREAM_DICT.get(peer_ip)
+        if stream is None:
+            stream = Stream(peer_ip)
+            STREAM_DICT[peer_ip] = stream
+        stream.file_infos.update(file_infos)
+        for file_name in file_infos:
+            EXPECTED_DICT[file_name] = stream
+    LOGGER.info('stream of %d files from %s', len(file_infos), peer_ip)
+    restart(peer_ip)
+
+
+def suspend(peer_ip):
+    """
+    the connection with the peer is lost: the file being received is deleted, the remaining files are requested
+    again once connected, or fall back to the block downloads after STREAM_TIMEOUT
+    for the download manager
+    :return: None
+    """
+    with LOCK:
+        stream = STREAM_DICT.get(peer_ip)
+        if stream is None or stream.stream_id is None:
+            return None
+        stream.stream_id = None
+        stream.progress_time = time.monotonic()
+    MOVING_VAN.send((peer_ip, MESSAGE_DISCARD, stream))
+
+
+def resume(peer_ip):
+    """
+    the peer is connected: request the remaining files of a suspended stream
+    for the download manager
+    :return: None
+    """
+    stream = STREAM_DICT.get(peer_ip)
+    if stream is not None and stream.stream_id is None:
+        request(stream)
+
+
+def restart(peer_ip):
+    """
+    request the remaining files again, as a new stream (e.g. the peer connected again)
+    for the download manager
+    :return: None
+    """
+    stream = STREAM_DICT.get(peer_ip)
+    if stream is None:
+        return None
+    suspend(peer_ip)
+    request(stream)
+
+
+def request(stream):
+    """
+    send the stream request of the remaining files, in path order
+    :return: None
+    """
+    if not connection_hub.is_connected(stream.peer_ip):
+        return None
+    with LOCK:
+        stream.stream_id = random.getrandbits(63)
+        stream.progress_time = time.monotonic()
+        file_names = sorted(stream.file_infos)
+        outbox_message = struct.pack('!Q', stream.stream_id) + pickle.dumps(file_names)
+    outbox_thread = connection_hub.PEER_DICT[stream.peer_ip][connection_hub.PEER_DICT_OUTBOX]
+    outbox_thread.send((connection_hub.MESSAGE_STREAM_REQUEST, outbox_message))
+
+
+def load(peer_ip, stream_id, file_names, outbox_thread):
+    """
+    a peer asked for a stream: send it, instead of the stream sent to the peer before if any
+    :return: None
+    """
+    # the request arrived on a connection being replaced: the peer requests again
+    if not outbox_thread.is_connected():
+        return None
+    loader = Loader(peer_ip, stream_id, file_names, outbox_thread)
+    with LOCK:
+        old_loader = LOADER_DICT.get(peer_ip)
+        LOADER_DICT[peer_ip] = loader
+    if old_loader is not None:
+        old_loader.off()
+    loader.start()
+
+
+def streams_command(argument):
+    if len(argument) > 0:
+        raise ValueError('usage: streams')
+    streams = []
+    for peer_ip, stream in list(STREAM_DICT.items()):
+        state = 'receiving' if stream.stream_id is not None else 'suspended'
+        streams.append('from ' + peer_ip + ' ' + state + ' ' + str(len(stream.file_infos)) + ' files left')
+    for peer_ip, loader in list(LOADER_DICT.items()):
+        streams.append('to ' + peer_ip + ' ' + str(loader.sent) + '/' + str(len(loader.file_names)) + ' files sent')
+    if len(streams) == 0:
+        return 'no stream'
+    return ', '.join(streams)
+
+
+def cleanup(file_location=''):
+    """
+    delete the files being received when the host stopped, they are requested again
+    the files indexed before the host stopped are kept
+    :return: None
+    """
+    with os.scandir(main.TEMP_DIR + TEMP_STREAMING + file_location) as entries:
+        for entry in entries:
+            if entry.is_file():
+                file_name = file_location + entry.name
+                # indexed: file_info written, or in the mirror index already read (reference -> looking_glass)
+                if not os.path.exists(main.TEMP_DIR + file_center.TEMP_FILE_INFO + file_name) and \
+                        file_name not in file_center.FILE_DICT:
+                    LOGGER.info('deleting the partially received file: %s', file_name)
+                    remove(main.FILE_DIR + file_name)
+                os.remove(entry.path)
+            else:
+                cleanup(file_location + entry.name + '/')
+
+
+def moving_van_init(stream_min_files):
+    """
+    initialize the moving van, before the file center scans the share
+    :param stream_min_files: missing files from which a peer is asked for a stream, 0: disabled
+    :return: None
+    """
+    global STREAM_MIN_FILES, MOVING_VAN
+
+    STREAM_MIN_FILES = stream_min_files
+
+    # the files being received when the host stopped
+    os.makedirs(main.TEMP_DIR + TEMP_STREAMING, exist_ok=True)
+    cleanup()
+
+    # start the moving van
+    MOVING_VAN = MovingVan()
+    MOVING_VAN.start()
+
+    # runtime control (reference -> switchboard)
+    switchboard.register('streams', streams_command, 'streams')
+
+    # metrics (reference -> observatory)
+    observatory.gauge('stream_files_expected', 'files expected from the streams', lambda: len(EXPECTED_DICT))
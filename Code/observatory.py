@@ -0,0 +1,214 @@
+"""
+observatory provides the metrics
+
+the modules register their metrics at import (counters, histograms) or at
+initialization (gauges, computed from the module state when collected), and
+update them on the hot path without formatting or printing anything
+
+metrics are served in the Prometheus text format on a localhost HTTP port,
+e.g. curl http://127.0.0.1:23458/metrics
+
+logging: each module logs to its own logger (logging.getLogger(module name)),
+the per-message logs are at DEBUG level, silent by default (reference -> main)
+"""
+import logging
+import math
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+# config
+METRICS_PORT = 0  # localhost port of the metrics endpoint, 0: disabled, e.g. 23458
+PREFIX = 'twodrive_'
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+SIZE_BUCKETS = (1024, 16384, 65536, 262144, 1048576, 2097152, 4194304, 8388608)
+
+"""
+metric dictionary
+
+* METRIC_DICT format:
+{metric_name: metric}, in registration order
+metric: Counter / Histogram / Gauge
+"""
+METRIC_DICT = {}
+METRIC_DICT_LOCK = Lock()
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Counter:
+    """
+    self.values: {label values: value}
+    """
+    type_name = 'counter'
+
+    def __init__(self, name, description, label_names):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.values = {}
+        self.lock = Lock()
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def collect(self):
+        """
+        :return: [(sample name suffix, label values, extra labels, value)]
+        """
+        with self.lock:
+            return [('', labels, (), value) for labels, value in self.values.items()]
+
+
+class Histogram:
+    """
+    self.values: {label values: [bucket counts, sum, count]}
+    """
+    type_name = 'histogram'
+
+    def __init__(self, name, description, label_names, buckets):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        self.values = {}
+        self.lock = Lock()
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            if labels not in self.values:
+                self.values[labels] = [[0 for _ in self.buckets], 0, 0]
+            bucket_counts, _, _ = self.values[labels]
+            for bucket_num in range(len(self.buckets)):
+                if value <= self.buckets[bucket_num]:
+                    bucket_counts[bucket_num] += 1
+            self.values[labels][1] += value
+            self.values[labels][2] += 1
+
+    def collect(self):
+        samples = []
+        with self.lock:
+            for labels, (bucket_counts, total, count) in self.values.items():
+                for bucket_num in range(len(self.buckets)):
+                    samples.append(('_bucket', labels, (('le', format_value(self.buckets[bucket_num])),),
+                                    bucket_counts[bucket_num]))
+                samples.append(('_bucket', labels, (('le', '+Inf'),), count))
+                samples.append(('_sum', labels, (), total))
+                samples.append(('_count', labels, (), count))
+        return samples
+
+
+class Gauge:
+    """
+    self.callback: function() -> value, or {label values: value} if the gauge has labels
+    a monotonic gauge (e.g. a count kept by the module) is exposed as a counter
+    """
+
+    def __init__(self, name, description, label_names, callback, monotonic):
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.callback = callback
+        self.type_name = 'counter' if monotonic else 'gauge'
+
+    def collect(self):
+        values = self.callback()
+        if len(self.label_names) == 0:
+            return [('', (), (), values)]
+        return [('', labels, (), value) for labels, value in values.items()]
+
+
+def counter(name, description, label_names=()):
+    return register(Counter(PREFIX + name, description, label_names))
+
+
+def histogram(name, description, label_names=(), buckets=LATENCY_BUCKETS):
+    return register(Histogram(PREFIX + name, description, label_names, buckets))
+
+
+def gauge(name, description, callback, label_names=(), monotonic=False):
+    """
+    :param callback: function() -> value, or {label values: value} if the gauge has labels
+    :param monotonic: whether the value only increases, exposed as a counter
+    """
+    return register(Gauge(PREFIX + name, description, label_names, callback, monotonic))
+
+
+def register(metric):
+    with METRIC_DICT_LOCK:
+        METRIC_DICT[metric.name] = metric
+    return metric
+
+
+def render():
+    """
+    :return: all metrics in the Prometheus text format
+    """
+    with METRIC_DICT_LOCK:
+        metrics = list(METRIC_DICT.values())
+    lines = []
+    for metric in metrics:
+        try:
+            samples = metric.collect()
+        except Exception as e:  # a gauge of a module not initialized yet
+            LOGGER.debug('failed to collect %s: %s', metric.name, e)
+            continue
+        lines.append('# HELP ' + metric.name + ' ' + metric.description)
+        lines.append('# TYPE ' + metric.name + ' ' + metric.type_name)
+        for suffix, labels, extra_labels, value in samples:
+            label_pairs = list(zip(metric.label_names, labels)) + list(extra_labels)
+            label_text = ','.join(name + '="' + escape(str(label)) + '"' for name, label in label_pairs)
+            if len(label_text) > 0:
+                label_text = '{' + label_text + '}'
+            lines.append(metric.name + suffix + label_text + ' ' + format_value(value))
+    return '\n'.join(lines) + '\n'
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def escape(label):
+    return label.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return None
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        LOGGER.debug(format, *args)
+
+
+class Observatory(Thread):
+    def __init__(self, port):
+        Thread.__init__(self, daemon=True)
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), MetricsHandler)
+
+    def run(self):
+        LOGGER.info('metrics are served on port %d', self.server.server_address[1])
+        self.server.serve_forever()
+
+
+def observatory_init(port):
+    """
+    initialize the observatory
+    :param port: the localhost metrics port, 0 to disable
+    :return: None
+    """
+    if port == 0:
+        return None
+    observatory = Observatory(port)
+    observatory.start()
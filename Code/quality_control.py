@@ -0,0 +1,89 @@
+"""
+quality_control provides the block digest functions
+
+every block message carries the digest of the block content (blake2b, DIGEST_SIZE
+bytes), computed by the sender and checked by the receiver on receipt, hashed as the
+segments of the block are written (reference -> download_manager.HASHER_DICT)
+a block that fails the check is requested again, preferably from another peer, the other blocks are kept
+
+the sender caches the digests per file version, so a block is only hashed
+once per version however many peers request it
+"""
+import hashlib
+from threading import Lock
+
+DIGEST_SIZE = 16
+
+"""
+digest cache
+
+* DIGEST_CACHE format:
+{file_name: (version, {block_num: digest})}
+version: size and mtime in ns of the file (reference -> file_center.FileReader), digests of older versions
+are dropped
+"""
+DIGEST_CACHE = {}
+DIGEST_CACHE_LOCK = Lock()
+
+
+def digest(block):
+    """
+    :param block: the block content
+    :return: the digest of the block content
+    """
+    return hashlib.blake2b(block, digest_size=DIGEST_SIZE).digest()
+
+
+def verify(block, block_digest):
+    """
+    :param block: the block content
+    :param block_digest: the expected digest, None if unknown
+    :return: whether the block content matches the digest (True if the digest is unknown)
+    """
+    if block_digest is None:
+        return True
+    return digest(block) == block_digest
+
+
+def file_hasher():
+    """
+    :return: an incremental hash of a whole file, fed as it is streamed (reference -> moving_van)
+    """
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def block_hasher():
+    """
+    :return: an incremental digest of a block, fed as its segments are received, equal to digest of the whole block
+    """
+    return hashlib.blake2b(digest_size=DIGEST_SIZE)
+
+
+def get_digest(file_name, version, block_num, block):
+    """
+    get the digest of a block from the cache, or compute and cache it
+    :param version: the version of the file the block is read from
+    :param block: the block content
+    :return: the digest of the block content
+    """
+    with DIGEST_CACHE_LOCK:
+        cached = DIGEST_CACHE.get(file_name)
+        if cached is not None and cached[0] == version and block_num in cached[1]:
+            return cached[1][block_num]
+    block_digest = digest(block)
+    with DIGEST_CACHE_LOCK:
+        cached = DIGEST_CACHE.get(file_name)
+        if cached is None or cached[0] != version:
+            cached = (version, {})
+            DIGEST_CACHE[file_name] = cached
+        cached[1][block_num] = block_digest
+    return block_digest
+
+
+def forget(file_name):
+    """
+    drop the cached digests of a file, e.g. when the file is modified
+    :return: None
+    """
+    with DIGEST_CACHE_LOCK:
+        DIGEST_CACHE.pop(file_name, None)
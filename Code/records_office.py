@@ -0,0 +1,192 @@
+"""
+records_office provides the block transfer tracing
+
+a traced block segment records a span for each stage it goes through, on the
+sender and on the receiver, keyed by (peer, file, block, offset):
+
+sender (reference -> service_desk, connection_hub.Outbox):
+read - the block is read from disk (once per block, shared by its segments)
+encode - the segment message is packed and compressed, waiting for a codec worker included
+outbox - the segment waits in the outbox, from served to sent (encode included)
+encrypt - the segment is encrypted, record by record while sending (total time)
+send - the segment is written to the socket, rate limiting included
+
+receiver (reference -> connection_hub.Inbox, download_manager):
+receive - from the message header to the last byte of the message, decrypt included
+decrypt - the message is decrypted, record by record while receiving (total time)
+decode - the message waits for and goes through decompression
+dispatch - the segment waits in the download manager queue
+write - the segment is appended to the block in temp
+verify - the complete block is checked against its digest
+
+sampling: a block is traced if crc32(file_name#block_num) falls within the
+sample rate, so both hosts trace the same blocks without coordination, and
+the blocks not traced only cost the sampling check
+
+spans are written to the trace file by the recorder thread, off the transfer path:
+jsonl - one span per line:
+{"ts": start (seconds since epoch), "dur": seconds, "stage", "side", "peer", "file", "block", "offset", ...}
+chrome - Chrome trace event format (chrome://tracing, ui.perfetto.dev), one track per (peer, file, block)
+"""
+import json
+import os
+import time
+import zlib
+from queue import Queue
+from threading import Thread
+import switchboard
+
+SIDE_SEND = 'send'
+SIDE_RECEIVE = 'receive'
+
+FORMAT_JSONL = 'jsonl'
+FORMAT_CHROME = 'chrome'
+FORMATS = [FORMAT_JSONL, FORMAT_CHROME]
+
+# config
+SAMPLE_RATE = 0.01  # share of the blocks traced
+FLUSH_INTERVAL = 1  # seconds between two flushes of the trace file
+
+RECORDER = None
+
+
+class Trace:
+    """
+    the spans of one block segment on one side
+    self.mark_time: time of the last stage handover, e.g. when the segment is queued
+    """
+
+    def __init__(self, side, peer_ip, file_name, block_num, offset):
+        self.side = side
+        self.peer_ip = peer_ip
+        self.file_name = file_name
+        self.block_num = block_num
+        self.offset = offset
+        self.mark_time = time.time()
+
+    def span(self, stage, start, end, **args):
+        """
+        record a stage of the segment
+        :param start: time.time() at the start of the stage
+        :param end: time.time() at the end of the stage
+        :param args: details of the stage, e.g. codec
+        :return: None
+        """
+        RECORDER.send((self, stage, start, end, args))
+
+    def mark(self):
+        self.mark_time = time.time()
+
+
+class Recorder(Thread):
+    """
+    message_queue format: (trace, stage, start, end, args)
+    """
+
+    def __init__(self, trace_path, trace_format):
+        Thread.__init__(self, daemon=True)
+        self.message_queue = Queue(0)
+        self.trace_file = open(trace_path, 'w')
+        self.trace_format = trace_format
+        self.tracks = {}  # chrome: {(peer_ip, file_name, block_num): track id}
+        self.prev_time = time.time()
+
+    def send(self, message):
+        self.message_queue.put(message)
+
+    def run(self):
+        if self.trace_format == FORMAT_CHROME:
+            # the closing bracket is optional in the Chrome trace format: the file is valid at any time
+            self.trace_file.write('[\n')
+            self.write_event({'name': 'process_name', 'ph': 'M', 'pid': os.getpid(),
+                              'args': {'name': 'TwoDrive ' + str(os.getpid())}})
+        while True:
+            trace, stage, start, end, args = self.message_queue.get()
+            self.message_queue.task_done()
+            if self.trace_format == FORMAT_CHROME:
+                self.write_chrome(trace, stage, start, end, args)
+            else:
+                self.write_jsonl(trace, stage, start, end, args)
+            if self.message_queue.empty() or time.time() - self.prev_time > FLUSH_INTERVAL:
+                self.prev_time = time.time()
+                self.trace_file.flush()
+
+    def write_jsonl(self, trace, stage, start, end, args):
+        span = {'ts': start, 'dur': end - start, 'stage': stage, 'side': trace.side, 'peer': trace.peer_ip,
+                'file': trace.file_name, 'block': trace.block_num, 'offset': trace.offset}
+        span.update(args)
+        self.trace_file.write(json.dumps(span) + '\n')
+
+    def write_chrome(self, trace, stage, start, end, args):
+        track = (trace.peer_ip, trace.file_name, trace.block_num)
+        if track not in self.tracks:
+            self.tracks[track] = len(self.tracks) + 1
+            self.write_event({'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(), 'tid': self.tracks[track],
+                              'args': {'name': trace.peer_ip + ' ' + trace.file_name + ' #' + str(trace.block_num)}})
+        args = dict(args, side=trace.side, offset=trace.offset)
+        self.write_event({'name': stage, 'cat': trace.side, 'ph': 'X', 'pid': os.getpid(), 'tid': self.tracks[track],
+                          'ts': int(start * 1000000), 'dur': int((end - start) * 1000000), 'args': args})
+
+    def write_event(self, event):
+        self.trace_file.write(json.dumps(event) + ',\n')
+
+
+def is_enabled():
+    return RECORDER is not None and SAMPLE_RATE > 0
+
+
+def is_sampled(file_name, block_num):
+    """
+    :return: whether the block is traced, the same on every host
+    """
+    if not is_enabled():
+        return False
+    return zlib.crc32((file_name + '#' + str(block_num)).encode()) < SAMPLE_RATE * 4294967296
+
+
+def start(side, peer_ip, file_name, block_num, offset):
+    """
+    :param side: SIDE_SEND / SIDE_RECEIVE
+    :return: the Trace of the segment, None if the block is not traced
+    """
+    if not is_sampled(file_name, block_num):
+        return None
+    return Trace(side, peer_ip, file_name, block_num, offset)
+
+
+def set_sample_rate(sample_rate):
+    global SAMPLE_RATE
+
+    if sample_rate < 0 or sample_rate > 1:
+        raise ValueError('sample rate must be between 0 and 1')
+    SAMPLE_RATE = sample_rate
+
+
+def trace_command(argument):
+    if RECORDER is None:
+        raise ValueError('tracing disabled, start with --trace-file')
+    if len(argument) > 0:
+        try:
+            set_sample_rate(float(argument))
+        except ValueError as e:
+            raise ValueError('usage: trace [sample rate 0..1]: ' + str(e))
+    return str(SAMPLE_RATE)
+
+
+def records_office_init(trace_path, trace_format, sample_rate):
+    """
+    initialize the records office
+    :param trace_path: the trace file, None to disable tracing
+    :param trace_format: FORMAT_JSONL / FORMAT_CHROME
+    :param sample_rate: share of the blocks traced, 0..1
+    :return: None
+    """
+    global RECORDER
+
+    set_sample_rate(sample_rate)
+    # runtime control (reference -> switchboard)
+    switchboard.register('trace', trace_command, 'trace [sample rate 0..1]')
+    if trace_path is None:
+        return None
+    RECORDER = Recorder(trace_path, trace_format)
+    RECORDER.start()
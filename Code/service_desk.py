@@ -0,0 +1,316 @@
+"""
+service_desk provides the block serving scheduler
+
+block requests from all peers are kept in per-peer queues and served in
+deficit round-robin order, so that a peer requesting a huge file cannot
+starve the other peers
+
+each round, a peer is credited QUANTUM * weight bytes of deficit and is
+served while its deficit is positive, the size of each served block is
+charged after reading (the deficit may go negative and is carried over)
+
+blocks of files that are still downloading are served as well once downloaded
+(reference -> download_manager)
+
+a block is served from the requested offset on, in segments (reference -> file_center.SEGMENT_SIZE),
+so that a peer resumes an interrupted block instead of receiving it again
+
+served segments are compressed with the codec chosen for the peer and kept in
+the warehouse, so a block requested by several peers is read and compressed once
+
+the segments to serve are acquired from the memory budget before the block is
+read (reference -> treasury), while the budget is exhausted requests wait for the next round
+
+the read and encode stages of the traced blocks are recorded (reference -> records_office)
+"""
+import logging
+import time
+from collections import deque
+from queue import Queue, Empty
+from threading import Thread
+import file_center, download_manager, connection_hub, compression_station, assembly_line, warehouse, treasury, \
+    observatory, records_office
+
+# config
+QUANTUM = 20971520  # 20MB (one full block), bytes credited to a peer of weight 1 per round
+DEFAULT_WEIGHT = 1
+OUTBOX_BUSY = 5  # outbox queue size over which a peer is skipped for the round
+
+"""
+peer weights
+
+* PEER_WEIGHTS format:
+{peer_ip: weight}
+peers not in PEER_WEIGHTS have DEFAULT_WEIGHT
+"""
+PEER_WEIGHTS = {}
+
+SERVICE_DESK = None
+
+LOGGER = logging.getLogger(__name__)
+
+# metrics (reference -> observatory)
+BLOCKS_SERVED = observatory.counter('blocks_served_total', 'block requests served', ('peer',))
+SERVED_BYTES = observatory.counter('served_bytes_total', 'bytes of the block segments served, before encoding',
+                                   ('peer',))
+
+
+class ServiceDesk(Thread):
+    """
+    self.message_queue: (peer_ip, block_num, offset, file_name, outbox_thread)
+
+    self.peer_queues: {peer_ip: deque([(block_num, offset, file_name, outbox_thread), ...])}
+    self.deficits: {peer_ip: deficit}
+    self.active: deque([peer_ip, ...]) - peers with pending requests, in round-robin order
+    """
+
+    def __init__(self):
+        Thread.__init__(self)
+        self.message_queue = Queue(0)
+        self.peer_queues = {}
+        self.deficits = {}
+        self.active = deque()
+
+    def send(self, message):
+        """
+        for other threads: send a block request to the service desk
+        :param message: (peer_ip, block_num, offset, file_name, outbox_thread)
+        :return: None
+        """
+        self.message_queue.put(message)
+
+    def run(self):
+        while True:
+            # wait for requests if there is nothing to serve
+            self.collect(wait=len(self.active) == 0)
+            if len(self.active) == 0:
+                continue
+            # serve one peer per iteration, then rotate
+            served = False
+            for _ in range(len(self.active)):
+                peer_ip = self.active[0]
+                self.active.rotate(-1)
+                if self.serve(peer_ip):
+                    served = True
+                    break
+            # every active peer is busy or blocked: wait for a while
+            if not served:
+                self.collect(wait=True, timeout=0.05)
+
+    def collect(self, wait=False, timeout=None):
+        """
+        move requests from message_queue to the per-peer queues
+        :param wait: whether to wait for the first request
+        :param timeout: maximum waiting time, None for no limit
+        :return: None
+        """
+        try:
+            message = self.message_queue.get(block=wait, timeout=timeout)
+        except Empty:
+            return None
+        while True:
+            self.message_queue.task_done()
+            peer_ip, block_num, offset, file_name, outbox_thread = message
+            if peer_ip not in self.peer_queues:
+                self.peer_queues[peer_ip] = deque()
+                self.deficits[peer_ip] = 0
+            if len(self.peer_queues[peer_ip]) == 0:
+                self.active.append(peer_ip)
+            self.peer_queues[peer_ip].append((block_num, offset, file_name, outbox_thread))
+            try:
+                message = self.message_queue.get(block=False)
+            except Empty:
+                return None
+
+    def serve(self, peer_ip):
+        """
+        credit the peer with its quantum and serve its requests while the deficit lasts
+        :param peer_ip: the peer to serve
+        :return: whether any progress is made (a block served or a request dropped)
+        """
+        peer_queue = self.peer_queues[peer_ip]
+        progress = False
+        credited = False
+        while len(peer_queue) > 0:
+            block_num, offset, file_name, outbox_thread = peer_queue[0]
+            # if outbox is not connected, drop task (the peer requests again)
+            if not outbox_thread.is_connected():
+                peer_queue.popleft()
+                progress = True
+                continue
+            # if outbox too busy, wait for the next round
+            if outbox_thread.queue_size() > OUTBOX_BUSY:
+                break
+            reader = get_reader(file_name, block_num)
+            if reader is None:
+                LOGGER.debug('no such block: %s %d', file_name, block_num)
+                peer_queue.popleft()
+                progress = True
+                continue
+            # if reader is blocked (file updating), wait for the next round
+            if reader.get_block_status() > 0:
+                break
+            # credit once per round
+            if not credited:
+                if self.deficits[peer_ip] <= 0:
+                    self.deficits[peer_ip] += QUANTUM * get_weight(peer_ip)
+                    progress = True
+                credited = True
+            if self.deficits[peer_ip] <= 0:
+                break
+            # acquire the memory of the segments to serve, if exhausted, wait for the next round
+            try:
+                reserved = max(reader.get_block_size(block_num) - offset, 0)
+            except (KeyError, FileNotFoundError) as e:
+                LOGGER.warning('failed to read block: %s %d %s', file_name, block_num, e)
+                peer_queue.popleft()
+                progress = True
+                continue
+            if not treasury.TREASURY.acquire(reserved, treasury.ACCOUNT_SEND, timeout=0):
+                break
+            # read, encode and send the required block from the offset on
+            peer_queue.popleft()
+            try:
+                segments, served_size = self.fetch(reader, file_name, block_num, offset, outbox_thread)
+            except (KeyError, FileNotFoundError) as e:
+                LOGGER.warning('failed to read block: %s %d %s', file_name, block_num, e)
+                treasury.TREASURY.release(reserved, treasury.ACCOUNT_SEND)
+                progress = True
+                continue
+            # the memory of each segment is released by the outbox once sent
+            treasury.TREASURY.resize(reserved, served_size, treasury.ACCOUNT_SEND)
+            for future, segment_size, trace in segments:
+                package = (connection_hub.MESSAGE_BLOCK, (future, segment_size, trace))
+                outbox_thread.send(package)
+            self.deficits[peer_ip] -= max(served_size, 1)
+            BLOCKS_SERVED.inc(1, (peer_ip,))
+            SERVED_BYTES.inc(served_size, (peer_ip,))
+            progress = True
+
+        # no pending requests: leave the round-robin and reset the deficit
+        if len(peer_queue) == 0:
+            self.active.remove(peer_ip)
+            self.deficits[peer_ip] = 0
+        return progress
+
+    def fetch(self, reader, file_name, block_num, offset, outbox_thread):
+        """
+        get the encoded segments of the block from the offset on from the warehouse,
+        or read the block and encode them
+        at least one segment is returned, so that a peer that has received the whole block gets its end
+        :return: ([(future of the encoded segment message, segment size, trace), ...], bytes served)
+                 trace: reference -> records_office, None if the block is not traced
+        """
+        version = reader.get_version()
+        codec_selector = outbox_thread.codec_selector
+        codecs = codec_selector.codecs + [compression_station.CODEC_RAW]
+        block_size = reader.get_block_size(block_num)
+        block = None
+        read_time = None
+        read_end_time = None
+        segments = []
+        served_size = 0
+        segment_offset = offset
+        while True:
+            trace = records_office.start(records_office.SIDE_SEND, outbox_thread.peer_ip, file_name, block_num,
+                                         segment_offset)
+            cached = warehouse.WAREHOUSE.get(file_name, version, block_num, segment_offset, codecs)
+            if cached is not None:
+                future, segment_size = cached
+            else:
+                if block is None:
+                    read_time = time.time()
+                    block = reader.read(block_num)
+                    block_size = len(block)
+                    read_end_time = time.time()
+                if trace is not None:
+                    trace.span('read', read_time, read_end_time)
+                future = self.encode(reader, file_name, version, block_num, segment_offset, block, codec_selector,
+                                     trace)
+                segment_size = max(min(len(block) - segment_offset, file_center.SEGMENT_SIZE), 0)
+            segments.append((future, segment_size, trace))
+            served_size += segment_size
+            segment_offset += file_center.SEGMENT_SIZE
+            if segment_offset >= block_size:
+                break
+        return segments, served_size
+
+    def encode(self, reader, file_name, version, block_num, offset, block, codec_selector, trace=None):
+        """
+        encode the segment of the block starting at offset and keep it in the warehouse
+        :param trace: the trace of the segment (reference -> records_office), None if not traced
+        :return: future of the encoded segment message
+        """
+        encode_time = time.time()
+        _, message = reader.message_pack(block_num, offset, block)
+        codec = codec_selector.choose(message)
+        future = assembly_line.submit_encode(message, codec)
+
+        def record(done_future):
+            # update the codec statistics of the peer once encoded
+            if done_future.exception() is None:
+                _, compressed_size, seconds = done_future.result()
+                codec_selector.record(codec, len(message), compressed_size, seconds)
+                if trace is not None:
+                    trace.span('encode', encode_time, time.time(), codec=codec, size=len(message),
+                               compressed_size=compressed_size, compression_seconds=seconds)
+
+        future.add_done_callback(record)
+        segment_size = max(min(len(block) - offset, file_center.SEGMENT_SIZE), 0)
+        warehouse.WAREHOUSE.put(file_name, version, block_num, offset, codec, future, segment_size)
+        return future
+
+
+def get_reader(file_name, block_num):
+    """
+    :return: the FileReader of a local file, the BlockReader of a new download with the block
+             downloaded (reference -> download_manager), None if the block is not available
+    """
+    reader = file_center.get_reader(file_name)
+    if reader is None:
+        return download_manager.get_block_reader(file_name, block_num)
+    return reader
+
+
+def get_weight(peer_ip):
+    return PEER_WEIGHTS.get(peer_ip, DEFAULT_WEIGHT)
+
+
+def set_weight(peer_ip, weight):
+    """
+    set the serving weight of a peer, takes effect from the next round
+    :param peer_ip: the ip of the peer
+    :param weight: the weight, > 0
+    :return: None
+    """
+    if weight <= 0:
+        raise ValueError('weight must be positive')
+    PEER_WEIGHTS[peer_ip] = weight
+
+
+def service_desk_init(peer_weights):
+    """
+    initialize the service desk
+    :param peer_weights: {peer_ip: weight}
+    :return: None
+    """
+    global SERVICE_DESK
+
+    for peer_ip in peer_weights:
+        set_weight(peer_ip, peer_weights[peer_ip])
+
+    # start the service desk
+    SERVICE_DESK = ServiceDesk()
+    SERVICE_DESK.start()
+
+    # metrics: block requests waiting to be served
+    observatory.gauge('service_queue_requests', 'block requests waiting to be served', get_queue_sizes, ('peer',))
+
+
+def get_queue_sizes():
+    """
+    :return: {(peer_ip,): number of requests waiting}, requests not collected yet are under the peer ''
+    """
+    queue_sizes = {(peer_ip,): len(peer_queue) for peer_ip, peer_queue in list(SERVICE_DESK.peer_queues.items())}
+    queue_sizes[('',)] = SERVICE_DESK.message_queue.qsize()
+    return queue_sizes
@@ -0,0 +1,112 @@
+"""
+switchboard provides the local control interface
+
+line based text protocol on a localhost TCP port, one command per line:
+<command> [argument]
+reply, one line per command:
+ok [result]
+error <reason>
+
+e.g. echo 'promote videos/big.mkv' | nc 127.0.0.1 23457
+
+commands are registered by the other modules at initialization (reference -> register)
+"""
+import logging
+import socket
+from threading import Thread
+
+# config
+CONTROL_PORT = 23457
+
+"""
+command dictionary
+
+* COMMAND_DICT format:
+{command: (handler, usage)}
+handler: function(argument) -> result, raises ValueError if the argument is incorrect
+"""
+COMMAND_DICT = {}
+COMMAND_DICT_HANDLER = 0
+COMMAND_DICT_USAGE = 1
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Switchboard(Thread):
+    def __init__(self, port):
+        Thread.__init__(self)
+        self.port = port
+
+    def run(self):
+        switchboard_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        switchboard_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        switchboard_socket.bind(('127.0.0.1', self.port))
+        switchboard_socket.listen(1)
+        LOGGER.info('switchboard is up on port %d', self.port)
+
+        while True:
+            operator_socket, _ = switchboard_socket.accept()
+            Operator(operator_socket).start()
+
+
+class Operator(Thread):
+    """
+    serves the commands of one control connection
+    """
+
+    def __init__(self, operator_socket):
+        Thread.__init__(self)
+        self.operator_socket = operator_socket
+
+    def run(self):
+        try:
+            with self.operator_socket, self.operator_socket.makefile('rw') as stream:
+                for line in stream:
+                    stream.write(execute(line.strip()) + '\n')
+                    stream.flush()
+        except (ConnectionError, socket.error) as e:
+            LOGGER.info('connection lost: %s', e)
+
+
+def execute(line):
+    """
+    :param line: the command line
+    :return: the reply
+    """
+    command, _, argument = line.partition(' ')
+    if command == 'help' or command not in COMMAND_DICT:
+        usages = [COMMAND_DICT[name][COMMAND_DICT_USAGE] for name in sorted(COMMAND_DICT)]
+        if command == 'help':
+            return 'ok ' + '; '.join(usages)
+        return 'error no such command: ' + command + ', commands: ' + '; '.join(usages)
+    try:
+        result = COMMAND_DICT[command][COMMAND_DICT_HANDLER](argument.strip())
+    except ValueError as e:
+        return 'error ' + str(e)
+    LOGGER.info('%s', line)
+    if result is None or result == '':
+        return 'ok'
+    return 'ok ' + str(result)
+
+
+def register(command, handler, usage):
+    """
+    register a control command
+    :param command: the command name
+    :param handler: function(argument) -> result, raises ValueError if the argument is incorrect
+    :param usage: the usage shown by help
+    :return: None
+    """
+    COMMAND_DICT[command] = (handler, usage)
+
+
+def switchboard_init(port):
+    """
+    initialize the switchboard
+    :param port: the localhost control port, 0 to disable
+    :return: None
+    """
+    if port == 0:
+        return None
+    switchboard = Switchboard(port)
+    switchboard.start()
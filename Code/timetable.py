@@ -0,0 +1,200 @@
+"""
+timetable provides the download scheduling policies
+
+the blocks of new downloads are requested in the order of the timetable
+(reference -> download_manager.request_blocks), the files first in the order
+take the request slots of the peers first, so a huge file does not hold back
+the small files discovered after it
+
+each download has a key (reference -> get_key), the smaller the earlier, files of equal keys in discovery order;
+the key of a download is computed again once its blocks change, and the key of every download once the
+policy, the pins or the promoted files change (reference -> download_manager.reorder)
+
+policies:
+fifo - files in the order they are discovered
+smallest - files with the fewest blocks left first
+recent - most recently modified files first
+round-robin - one block of each file in turn, the files share the request slots
+
+whatever the policy, pinned paths come first by priority (PIN_LIST), and
+promoted files come before everything, most recently promoted first
+
+the timetable is read and changed on the download manager thread only: the commands hand their change over
+(reference -> download_manager.schedule), the command reply is the timetable once the change is applied
+"""
+import fnmatch
+import file_center, download_manager, switchboard
+
+POLICY_FIFO = 'fifo'
+POLICY_SMALLEST = 'smallest'
+POLICY_RECENT = 'recent'
+POLICY_ROUND_ROBIN = 'round-robin'
+POLICIES = [POLICY_FIFO, POLICY_SMALLEST, POLICY_RECENT, POLICY_ROUND_ROBIN]
+
+# config
+POLICY = POLICY_SMALLEST
+DEFAULT_PRIORITY = 0
+
+"""
+pin list
+
+* PIN_LIST format:
+[(pattern, priority)]
+pattern: fnmatch pattern of file names, e.g. 'config/*', the first matching pattern applies
+priority: files of higher priority are requested first, files not pinned have DEFAULT_PRIORITY
+"""
+PIN_LIST = []
+
+# promoted file names, most recently promoted first
+PROMOTED_LIST = []
+
+
+def get_key(file_name, file_info, block_info):
+    """
+    :param block_info: (reference -> download_manager)
+    :return: (promoted rank, -pin priority, policy key), the smaller the earlier
+    """
+    return get_class(file_name) + (get_policy_key(file_info, block_info),)
+
+
+def get_class(file_name):
+    """
+    :return: (promoted rank, -pin priority), the smaller the earlier
+    """
+    try:
+        promoted_rank = PROMOTED_LIST.index(file_name)
+    except ValueError:
+        promoted_rank = len(PROMOTED_LIST)
+    return promoted_rank, -get_priority(file_name)
+
+
+def get_policy_key(file_info, block_info):
+    if POLICY == POLICY_SMALLEST:
+        # blocks left to download
+        return sum(1 for block_status in block_info if block_status != download_manager.BLOCK_DOWNLOADED)
+    if POLICY == POLICY_RECENT:
+        return -file_info[file_center.FILE_INFO_LAST_MODIFIED]
+    if POLICY == POLICY_ROUND_ROBIN:
+        # the blocks in flight count as turns taken: one block of each file in turn
+        return block_info.count(download_manager.BLOCK_DOWNLOADING)
+    return 0
+
+
+def get_priority(file_name):
+    for pattern, priority in PIN_LIST:
+        if fnmatch.fnmatch(file_name, pattern):
+            return priority
+    return DEFAULT_PRIORITY
+
+
+def set_policy(policy):
+    """
+    on the download manager thread, or before it starts (reference -> download_manager.schedule)
+    :return: None
+    """
+    global POLICY
+
+    if policy not in POLICIES:
+        raise ValueError('no such policy: ' + policy)
+    POLICY = policy
+
+
+def pin(pattern, priority):
+    """
+    pin the files matching the pattern to the priority, replaces an earlier pin of the pattern
+    on the download manager thread, or before it starts (reference -> download_manager.schedule)
+    :return: None
+    """
+    global PIN_LIST
+
+    PIN_LIST = get_pins(pattern, priority)
+
+
+def unpin(pattern):
+    """
+    on the download manager thread, or before it starts (reference -> download_manager.schedule)
+    :return: None
+    """
+    global PIN_LIST
+
+    PIN_LIST = get_pins(pattern)
+
+
+def get_pins(pattern, priority=None):
+    """
+    :param priority: the priority the pattern is pinned to, None: the pattern is unpinned
+    :return: the pin list with the pin of the pattern replaced
+    """
+    pins = [pinned for pinned in PIN_LIST if pinned[0] != pattern]
+    if priority is not None:
+        pins.append((pattern, priority))
+    return pins
+
+
+def promote(file_name):
+    """
+    request the blocks of the file before those of any other file, from the next request on
+    on the download manager thread (reference -> download_manager.schedule)
+    :return: None
+    """
+    global PROMOTED_LIST
+
+    PROMOTED_LIST = [file_name] + [promoted for promoted in PROMOTED_LIST if promoted != file_name]
+
+
+def forget(file_name):
+    """
+    the download of the file is complete
+    :return: None
+    """
+    if file_name in PROMOTED_LIST:
+        PROMOTED_LIST.remove(file_name)
+
+
+def promote_command(argument):
+    if len(argument) == 0:
+        raise ValueError('file name missing')
+    download_manager.schedule(lambda: promote(argument))
+    return argument
+
+
+def schedule_command(argument):
+    if len(argument) == 0:
+        return POLICY
+    if argument not in POLICIES:
+        raise ValueError('no such policy: ' + argument)
+    download_manager.schedule(lambda: set_policy(argument))
+    return argument
+
+
+def pin_command(argument):
+    try:
+        priority, pattern = argument.split(' ', 1)
+        priority = int(priority)
+    except ValueError:
+        raise ValueError('usage: pin <priority> <pattern>')
+    download_manager.schedule(lambda: pin(pattern, priority))
+    return str(get_pins(pattern, priority))
+
+
+def unpin_command(argument):
+    download_manager.schedule(lambda: unpin(argument))
+    return str(get_pins(argument))
+
+
+def timetable_init(policy, pins):
+    """
+    initialize the timetable
+    :param policy: the scheduling policy, one of POLICIES
+    :param pins: [(pattern, priority)]
+    :return: None
+    """
+    set_policy(policy)
+    for pattern, priority in pins:
+        pin(pattern, priority)
+
+    # runtime control (reference -> switchboard)
+    switchboard.register('promote', promote_command, 'promote <file_name>')
+    switchboard.register('schedule', schedule_command, 'schedule [' + ' | '.join(POLICIES) + ']')
+    switchboard.register('pin', pin_command, 'pin <priority> <pattern>')
+    switchboard.register('unpin', unpin_command, 'unpin <pattern>')
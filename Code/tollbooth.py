@@ -0,0 +1,277 @@
+"""
+tollbooth provides the bandwidth limits
+
+the bulk messages, block segments and streams (reference -> connection_hub.BULK_MESSAGES), are rate limited
+by token buckets, per peer and globally, for upload (reference -> connection_hub.Outbox) and download
+(reference -> connection_hub.Inbox), a transfer takes its size from both the bucket of the peer and the global
+bucket
+control messages (every other message type) are exempt, and are sent before the queued bulk messages,
+so requests and file updates are not held back by bulk traffic
+
+rates are in bytes per second, 0 for no limit
+the global limits follow the time-of-day schedule (SCHEDULE_LIST) when a window
+of the schedule is active, and the default limits otherwise
+limits and schedule can be changed at runtime (reference -> switchboard)
+"""
+import time
+from threading import Condition, Lock
+import switchboard, observatory
+
+DIRECTION_UPLOAD = 0
+DIRECTION_DOWNLOAD = 1
+DIRECTION_NAMES = {'up': DIRECTION_UPLOAD, 'down': DIRECTION_DOWNLOAD}
+
+# config
+BURST_TIME = 0.25  # seconds of traffic a bucket holds when idle
+CHUNK_SIZE = 65536  # bytes sent between two token checks
+SCHEDULE_CHECK_INTERVAL = 10  # seconds between two checks of the schedule
+
+# default global limits: [upload rate, download rate]
+DEFAULT_LIMITS = [0, 0]
+
+"""
+schedule list
+
+* SCHEDULE_LIST format:
+[(start, end, upload_rate, download_rate)]
+start, end: minutes since midnight, local time, the window wraps around midnight if end <= start
+the first active window applies
+"""
+SCHEDULE_LIST = []
+
+"""
+bucket dictionaries
+
+* GLOBAL_BUCKETS format:
+[upload_bucket, download_bucket]
+
+* PEER_BUCKET_DICT format:
+{peer_ip: [upload_bucket, download_bucket]}
+"""
+GLOBAL_BUCKETS = []
+PEER_BUCKET_DICT = {}
+PEER_BUCKET_DICT_LOCK = Lock()
+
+schedule_check_time = 0
+# seconds transfers waited for tokens: [upload, download]
+throttled_time = [0.0, 0.0]
+
+
+class TokenBucket:
+    """
+    self.rate: bytes per second, 0 for no limit
+    self.tokens: bytes that can be transferred now, negative while in debt
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 0
+        self.prev_time = time.monotonic()
+        self.condition = Condition()
+
+    def set_rate(self, rate):
+        with self.condition:
+            self.refill()
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = min(self.tokens, self.get_burst())
+                # waiting transfers recompute their waiting time
+                self.condition.notify_all()
+
+    def consume(self, size):
+        """
+        take size bytes from the bucket, wait while the bucket is in debt
+        :return: seconds waited
+        """
+        with self.condition:
+            if self.rate <= 0:
+                return 0
+            self.refill()
+            self.tokens -= size
+            start_time = time.monotonic()
+            while self.tokens < 0 and self.rate > 0:
+                self.condition.wait(-self.tokens / self.rate)
+                self.refill()
+            return time.monotonic() - start_time
+
+    def refill(self):
+        # condition lock must be held by the caller
+        now = time.monotonic()
+        if self.rate > 0:
+            self.tokens = min(self.tokens + (now - self.prev_time) * self.rate, self.get_burst())
+        else:
+            self.tokens = 0
+        self.prev_time = now
+
+    def get_burst(self):
+        return max(self.rate * BURST_TIME, CHUNK_SIZE)
+
+
+def throttle(peer_ip, direction, size):
+    """
+    wait until size bytes of bulk messages can be transferred with the peer
+    :param direction: DIRECTION_UPLOAD / DIRECTION_DOWNLOAD
+    :return: None
+    """
+    check_schedule()
+    waited = get_peer_buckets(peer_ip)[direction].consume(size)
+    waited += GLOBAL_BUCKETS[direction].consume(size)
+    throttled_time[direction] += waited
+
+
+def get_peer_buckets(peer_ip):
+    with PEER_BUCKET_DICT_LOCK:
+        if peer_ip not in PEER_BUCKET_DICT:
+            PEER_BUCKET_DICT[peer_ip] = [TokenBucket(0), TokenBucket(0)]
+        return PEER_BUCKET_DICT[peer_ip]
+
+
+def set_limit(direction, rate, peer_ip=None):
+    """
+    :param direction: DIRECTION_UPLOAD / DIRECTION_DOWNLOAD
+    :param rate: bytes per second, 0 for no limit
+    :param peer_ip: None for the default global limit
+    :return: None
+    """
+    if peer_ip is None:
+        DEFAULT_LIMITS[direction] = rate
+        check_schedule(force=True)
+    else:
+        get_peer_buckets(peer_ip)[direction].set_rate(rate)
+
+
+def set_schedule(schedule_list):
+    global SCHEDULE_LIST
+
+    SCHEDULE_LIST = schedule_list
+    check_schedule(force=True)
+
+
+def get_limits(minute):
+    """
+    :param minute: minutes since midnight
+    :return: [upload rate, download rate] of the global buckets
+    """
+    for start, end, upload_rate, download_rate in SCHEDULE_LIST:
+        if start < end and start <= minute < end or end <= start and (minute >= start or minute < end):
+            return [upload_rate, download_rate]
+    return DEFAULT_LIMITS
+
+
+def check_schedule(force=False):
+    """
+    apply the global limits of the current time
+    :param force: check even if checked recently
+    :return: None
+    """
+    global schedule_check_time
+
+    if not force and time.monotonic() - schedule_check_time < SCHEDULE_CHECK_INTERVAL:
+        return None
+    schedule_check_time = time.monotonic()
+    local_time = time.localtime()
+    limits = get_limits(local_time.tm_hour * 60 + local_time.tm_min)
+    for direction in (DIRECTION_UPLOAD, DIRECTION_DOWNLOAD):
+        GLOBAL_BUCKETS[direction].set_rate(limits[direction])
+
+
+def parse_rate(rate):
+    """
+    :param rate: KB/s
+    :return: bytes per second
+    """
+    rate = int(rate)
+    if rate < 0:
+        raise ValueError('rate must not be negative')
+    return rate * 1024
+
+
+def parse_schedule(schedule):
+    """
+    :param schedule: HH:MM-HH:MM=upload/download,... rates in KB/s, e.g. 08:00-18:00=512/2048
+    :return: schedule list (reference -> SCHEDULE_LIST)
+    """
+    schedule_list = []
+    for window in schedule.split(','):
+        try:
+            period, rates = window.split('=')
+            start, end = [parse_minute(moment) for moment in period.split('-')]
+            upload_rate, download_rate = [parse_rate(rate) for rate in rates.split('/')]
+        except ValueError:
+            raise ValueError('schedule format incorrect in: ' + window)
+        schedule_list.append((start, end, upload_rate, download_rate))
+    return schedule_list
+
+
+def parse_minute(moment):
+    hour, minute = moment.split(':')
+    hour = int(hour)
+    minute = int(minute)
+    if hour < 0 or minute < 0 or minute > 59 or hour * 60 + minute > 1440:
+        raise ValueError('time incorrect: ' + moment)
+    return hour * 60 + minute
+
+
+def limit_command(argument):
+    try:
+        arguments = argument.split()
+        direction = DIRECTION_NAMES[arguments[0]]
+        rate = parse_rate(arguments[1])
+        peer_ip = arguments[2] if len(arguments) == 3 else None
+        if len(arguments) > 3:
+            raise ValueError
+    except (IndexError, KeyError, ValueError):
+        raise ValueError('usage: limit <up | down> <KB/s> [peer_ip]')
+    set_limit(direction, rate, peer_ip)
+    return limits_command('')
+
+
+def limit_schedule_command(argument):
+    if argument == 'off':
+        set_schedule([])
+    elif len(argument) > 0:
+        set_schedule(parse_schedule(argument))
+    return str(SCHEDULE_LIST)
+
+
+def limits_command(argument):
+    limits = ['global ' + str(GLOBAL_BUCKETS[DIRECTION_UPLOAD].rate // 1024) + '/' +
+              str(GLOBAL_BUCKETS[DIRECTION_DOWNLOAD].rate // 1024)]
+    with PEER_BUCKET_DICT_LOCK:
+        for peer_ip, buckets in PEER_BUCKET_DICT.items():
+            limits.append(peer_ip + ' ' + str(buckets[DIRECTION_UPLOAD].rate // 1024) + '/' +
+                          str(buckets[DIRECTION_DOWNLOAD].rate // 1024))
+    return 'KB/s up/down, 0: no limit: ' + ', '.join(limits)
+
+
+def tollbooth_init(limits, peer_limits, schedule_list):
+    """
+    initialize the tollbooth
+    :param limits: [upload rate, download rate] default global limits
+    :param peer_limits: {peer_ip: [upload rate, download rate]}
+    :param schedule_list: reference -> SCHEDULE_LIST
+    :return: None
+    """
+    global GLOBAL_BUCKETS, SCHEDULE_LIST
+
+    DEFAULT_LIMITS[:] = limits
+    SCHEDULE_LIST = schedule_list
+    GLOBAL_BUCKETS = [TokenBucket(0), TokenBucket(0)]
+    check_schedule(force=True)
+    for peer_ip, (upload_rate, download_rate) in peer_limits.items():
+        set_limit(DIRECTION_UPLOAD, upload_rate, peer_ip)
+        set_limit(DIRECTION_DOWNLOAD, download_rate, peer_ip)
+
+    # runtime control (reference -> switchboard)
+    switchboard.register('limit', limit_command, 'limit <up | down> <KB/s> [peer_ip]')
+    switchboard.register('limit-schedule', limit_schedule_command,
+                         'limit-schedule [HH:MM-HH:MM=<up KB/s>/<down KB/s>,... | off]')
+    switchboard.register('limits', limits_command, 'limits')
+
+    # metrics (reference -> observatory)
+    observatory.gauge('rate_limit_bytes_per_second', 'global rate limit of the bulk messages, 0: no limit',
+                      lambda: {('upload',): GLOBAL_BUCKETS[DIRECTION_UPLOAD].rate,
+                               ('download',): GLOBAL_BUCKETS[DIRECTION_DOWNLOAD].rate}, ('direction',))
+    observatory.gauge('throttled_seconds_total', 'time transfers waited for the rate limits',
+                      lambda: {('upload',): throttled_time[DIRECTION_UPLOAD],
+                               ('download',): throttled_time[DIRECTION_DOWNLOAD]}, ('direction',), monotonic=True)
@@ -0,0 +1,164 @@
+"""
+treasury provides the process-wide memory budget
+
+block data is only allocated against the budget, the size is acquired before
+the memory is allocated and released once the memory is freed:
+- service desk: before reading a block to serve, released by the outbox once each segment is sent
+- inbox: before receiving a message, released once processed (block segments: once written by the download manager)
+- codec stage: before copying a message into shared memory, released once the result is collected
+  (reference -> assembly_line), if the budget is exhausted the message is encoded / decoded inline instead
+producers wait, or skip a round, while the budget is exhausted, so memory stays
+under the cap and throughput degrades instead of the process being killed
+
+accounts:
+ACCOUNT_SEND - data to send to peers, may use at most SEND_SHARE of the budget
+ACCOUNT_RECEIVE - data received from peers
+data to send cannot take the whole budget, so received data can always be
+processed: two hosts whose budgets are full of data for each other do not wait
+for each other
+
+the encoded block cache has its own capacity (reference -> warehouse)
+"""
+import logging
+import time
+from threading import Condition
+import observatory
+
+# config
+CAPACITY = 536870912  # 512MB, total size of the block data in flight, 0 for no limit
+MIN_CAPACITY = 67108864  # 64MB, smallest budget that fits a block to serve and one to receive
+SEND_SHARE = 0.5  # share of the budget data to send may use
+REPORT_INTERVAL = 60  # seconds between two reports of the budget usage
+
+ACCOUNT_SEND = 0
+ACCOUNT_RECEIVE = 1
+
+TREASURY = None
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Treasury:
+    """
+    self.in_use: {account: bytes acquired}
+    self.peak: highest total bytes acquired
+    self.waiting: number of producers waiting for the budget
+    self.waits: number of acquisitions that waited or failed
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.in_use = {ACCOUNT_SEND: 0, ACCOUNT_RECEIVE: 0}
+        self.peak = 0
+        self.waiting = 0
+        self.waits = 0
+        self.prev_time = time.time()
+        self.condition = Condition()
+
+    def acquire(self, size, account, timeout=None):
+        """
+        acquire memory from the budget
+        :param size: bytes to acquire
+        :param account: ACCOUNT_SEND / ACCOUNT_RECEIVE
+        :param timeout: maximum waiting time, None for no limit, 0 for no waiting
+        :return: whether the memory is acquired
+        """
+        with self.condition:
+            self.report()
+            if not self.is_available(size, account):
+                self.waits += 1
+                if timeout == 0:
+                    return False
+                self.waiting += 1
+                available = self.condition.wait_for(lambda: self.is_available(size, account), timeout)
+                self.waiting -= 1
+                if not available:
+                    return False
+            self.in_use[account] += size
+            self.peak = max(self.peak, self.get_in_use())
+            return True
+
+    def release(self, size, account):
+        """
+        release memory acquired from the budget
+        :return: None
+        """
+        with self.condition:
+            self.in_use[account] -= size
+            self.condition.notify_all()
+
+    def resize(self, size, new_size, account):
+        """
+        change the size of acquired memory without waiting, e.g. once a message is decompressed
+        :return: None
+        """
+        with self.condition:
+            self.in_use[account] += new_size - size
+            self.peak = max(self.peak, self.get_in_use())
+            if new_size < size:
+                self.condition.notify_all()
+
+    def is_available(self, size, account):
+        # condition lock must be held by the caller
+        if self.capacity <= 0:
+            return True
+        in_use = self.get_in_use()
+        # a request larger than the limit is served once nothing else is in use
+        if in_use == 0:
+            return True
+        if in_use + size > self.capacity:
+            return False
+        if account == ACCOUNT_SEND and self.in_use[ACCOUNT_SEND] + size > self.capacity * SEND_SHARE:
+            return False
+        return True
+
+    def get_in_use(self):
+        return self.in_use[ACCOUNT_SEND] + self.in_use[ACCOUNT_RECEIVE]
+
+    def get_gauges(self):
+        """
+        :return: {gauge_name: value} of the budget usage
+        """
+        with self.condition:
+            return {
+                'capacity': self.capacity,
+                'in_use': self.get_in_use(),
+                'send_in_use': self.in_use[ACCOUNT_SEND],
+                'receive_in_use': self.in_use[ACCOUNT_RECEIVE],
+                'peak': self.peak,
+                'waiting': self.waiting,
+                'waits': self.waits,
+            }
+
+    def report(self):
+        # condition lock must be held by the caller
+        if time.time() - self.prev_time < REPORT_INTERVAL:
+            return None
+        self.prev_time = time.time()
+        LOGGER.info('in use: %d / %d\tsend: %d\treceive: %d\tpeak: %d\twaits: %d', self.get_in_use(), self.capacity,
+                    self.in_use[ACCOUNT_SEND], self.in_use[ACCOUNT_RECEIVE], self.peak, self.waits)
+
+
+def treasury_init(capacity):
+    """
+    initialize the treasury
+    :param capacity: total size of the block data in flight, 0 for no limit
+    :return: None
+    """
+    global TREASURY
+
+    TREASURY = Treasury(capacity)
+
+    # metrics (reference -> observatory)
+    observatory.gauge('memory_budget_bytes', 'memory budget of the block data in flight, 0: no limit',
+                      lambda: TREASURY.capacity)
+    observatory.gauge('memory_in_use_bytes', 'block data in flight by account', get_in_use_gauges, ('account',))
+    observatory.gauge('memory_peak_bytes', 'highest block data in flight', lambda: TREASURY.peak)
+    observatory.gauge('memory_waiting', 'producers waiting for the memory budget', lambda: TREASURY.waiting)
+    observatory.gauge('memory_waits_total', 'acquisitions that waited or failed', lambda: TREASURY.waits,
+                      monotonic=True)
+
+
+def get_in_use_gauges():
+    gauges = TREASURY.get_gauges()
+    return {('send',): gauges['send_in_use'], ('receive',): gauges['receive_in_use']}
@@ -0,0 +1,152 @@
+"""
+warehouse provides the in-memory cache of encoded blocks
+
+when several peers request the same block within a short time, the block is
+read from disk and compressed once, every peer is served the cached
+wire-ready block segment messages (encryption is per connection, reference -> encryption_bureau)
+
+entries are futures of the encoded segments (reference -> assembly_line.submit_encode),
+so a block that is still being encoded is shared as well
+the cache is bounded by the total size of the encoded blocks, least recently used
+entries are evicted first, entries of a file are evicted when the file changes
+"""
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+import observatory
+
+# config
+CAPACITY = 268435456  # 256MB, maximum total size of the cached encoded blocks
+REPORT_INTERVAL = 60  # seconds between two reports of hit rate and memory use
+
+"""
+cache dictionary
+
+* WAREHOUSE.entries format:
+OrderedDict({(file_name, version, block_num, offset, codec): [future, raw_size, encoded_size]}),
+least recently used first
+version: version of the file (reference -> file_center.FileReader)
+offset: offset of the segment in the block (reference -> file_center.SEGMENT_SIZE)
+raw_size: size of the segment
+encoded_size: 0 while the segment is being encoded
+"""
+ENTRY_FUTURE = 0
+ENTRY_RAW_SIZE = 1
+ENTRY_ENCODED_SIZE = 2
+
+WAREHOUSE = None
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Warehouse:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.file_keys = {}  # {file_name: set of keys}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.prev_time = time.time()
+        self.lock = Lock()
+
+    def get(self, file_name, version, block_num, offset, codecs):
+        """
+        :param codecs: codecs accepted by the requesting peer
+        :return: (future, raw_size) of a cached encoded segment, None if not cached
+        """
+        with self.lock:
+            for codec in codecs:
+                key = (file_name, version, block_num, offset, codec)
+                if key in self.entries:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    entry = self.entries[key]
+                    self.report()
+                    return entry[ENTRY_FUTURE], entry[ENTRY_RAW_SIZE]
+            self.misses += 1
+            self.report()
+            return None
+
+    def put(self, file_name, version, block_num, offset, codec, future, raw_size):
+        """
+        cache the future of an encoded segment, the size is accounted once encoded
+        :return: None
+        """
+        if self.capacity <= 0:
+            return None
+        key = (file_name, version, block_num, offset, codec)
+        with self.lock:
+            self.remove(key)
+            self.entries[key] = [future, raw_size, 0]
+            if file_name not in self.file_keys:
+                self.file_keys[file_name] = set()
+            self.file_keys[file_name].add(key)
+        future.add_done_callback(lambda done_future: self.encoded(key, done_future))
+
+    def encoded(self, key, future):
+        with self.lock:
+            if key not in self.entries or self.entries[key][ENTRY_FUTURE] is not future:
+                return None
+            if future.exception() is not None:
+                self.remove(key)
+                return None
+            encoded_size = len(future.result()[0])
+            self.entries[key][ENTRY_ENCODED_SIZE] = encoded_size
+            self.size += encoded_size
+            # evict the least recently used entries
+            while self.size > self.capacity and len(self.entries) > 0:
+                self.remove(next(iter(self.entries)))
+
+    def evict_file(self, file_name):
+        """
+        evict all entries of a file, e.g. when the file is modified
+        :return: None
+        """
+        with self.lock:
+            for key in list(self.file_keys.get(file_name, ())):
+                self.remove(key)
+
+    def remove(self, key):
+        # lock must be held by the caller
+        if key not in self.entries:
+            return None
+        entry = self.entries.pop(key)
+        self.size -= entry[ENTRY_ENCODED_SIZE]
+        file_name = key[0]
+        self.file_keys[file_name].discard(key)
+        if len(self.file_keys[file_name]) == 0:
+            self.file_keys.pop(file_name)
+
+    def report(self):
+        # lock must be held by the caller
+        if time.time() - self.prev_time < REPORT_INTERVAL:
+            return None
+        self.prev_time = time.time()
+        LOGGER.info('hit rate: %.2f%%\tentries: %d\tmemory: %d / %d', self.get_hit_rate() * 100, len(self.entries),
+                    self.size, self.capacity)
+
+    def get_hit_rate(self):
+        if self.hits + self.misses == 0:
+            return 0
+        return self.hits / (self.hits + self.misses)
+
+
+def warehouse_init(capacity):
+    """
+    initialize the warehouse
+    :param capacity: maximum total size of the cached encoded segments, 0 to disable caching
+    :return: None
+    """
+    global WAREHOUSE
+
+    WAREHOUSE = Warehouse(capacity)
+
+    # metrics (reference -> observatory)
+    observatory.gauge('cache_capacity_bytes', 'capacity of the encoded block cache', lambda: WAREHOUSE.capacity)
+    observatory.gauge('cache_bytes', 'encoded segments cached', lambda: WAREHOUSE.size)
+    observatory.gauge('cache_entries', 'segments cached', lambda: len(WAREHOUSE.entries))
+    observatory.gauge('cache_hits_total', 'segments served from the cache', lambda: WAREHOUSE.hits, monotonic=True)
+    observatory.gauge('cache_misses_total', 'segments not found in the cache', lambda: WAREHOUSE.misses,
+                      monotonic=True)
@@ -0,0 +1,152 @@
+"""
+zoning_board provides the namespace sharding
+
+with --shards K, main.py is a front process that starts K shard processes (reference -> run_shards),
+each one a complete instance owning a hash partition of the share: its own file dict, readers and download
+manager (reference -> file_center, download_manager), and its own temp directory <temp_dir>/shard_<i>/
+
+shard i of a host exchanges messages with shard i of its peers only: it listens and connects on the ports
+offset by i * PORT_STRIDE (reference -> shard_port), so every connection only carries the paths the shard owns,
+peers must run the same number of shards
+
+a shard owns the files whose full path hashes to it: the path of a file is owned by shard crc32(path) % K,
+so the files of a share are split evenly whatever its layout, even under a single directory
+every shard walks the whole share, but only checks and indexes the files it owns (reference -> file_center ->
+dispatch): the directory listings are read by every shard, the stats, digests and reads are split K ways
+"""
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import zlib
+import main
+
+# config
+MAX_SHARDS = 64
+PORT_STRIDE = 10  # ports of shard i: port + i * PORT_STRIDE
+TEMP_SHARD = 'shard_%d/'
+POLL_INTERVAL = 1  # seconds between two checks of the shard processes
+
+SHARD = 0
+SHARDS = 1
+
+# peers found sending paths owned by another shard, warned once
+MISMATCHED_PEERS = set()
+
+LOGGER = logging.getLogger(__name__)
+
+
+def get_shard(file_name):
+    """
+    :param file_name: the name of the file
+    :return: the shard owning the file
+    """
+    return zlib.crc32(file_name.encode()) % SHARDS
+
+
+def owns(file_name):
+    """
+    :param file_name: the name of the file
+    :return: whether this shard owns the file
+    """
+    return SHARDS == 1 or get_shard(file_name) == SHARD
+
+
+def accepts(peer_ip, file_name):
+    """
+    checks a path announced by a peer, a peer running another number of shards sends paths owned by other shards
+    :return: whether this shard owns the file
+    """
+    if owns(file_name):
+        return True
+    if peer_ip not in MISMATCHED_PEERS:
+        MISMATCHED_PEERS.add(peer_ip)
+        LOGGER.warning('%s announced a path of shard %d, peers must run %d shards', peer_ip, get_shard(file_name),
+                       SHARDS)
+    return False
+
+
+def shard_port(port):
+    """
+    :param port: port of an unsharded instance, 0: disabled
+    :return: port of this shard
+    """
+    if port == 0:
+        return 0
+    return port + SHARD * PORT_STRIDE
+
+
+def shard_path(path):
+    """
+    :param path: output file of an unsharded instance (trace, capture), None: disabled
+    :return: output file of this shard, e.g. trace.shard1.jsonl
+    """
+    if path is None or SHARDS == 1:
+        return path
+    root, extension = os.path.splitext(path)
+    return root + '.shard%d' % SHARD + extension
+
+
+def share(amount):
+    """
+    the shards split the budgets and rate limits of the host evenly
+    :param amount: budget or rate limit of the host, 0: disabled / no limit
+    :return: the share of this shard
+    """
+    if amount == 0 or SHARDS == 1:
+        return amount
+    return max(amount // SHARDS, 1)
+
+
+def run_shards(shards):
+    """
+    front process: start a shard process per partition, with the arguments of the front process,
+    and stop them all once one of them exits
+    :param shards: number of shards
+    :return: exit status of the first shard process to exit
+    """
+    processes = []
+    for shard in range(shards):
+        processes.append(subprocess.Popen([sys.executable] + sys.argv + ['--shard', str(shard)]))
+        LOGGER.info('shard started: %d pid %d', shard, processes[-1].pid)
+
+    # stop the shards on termination
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    status = 0
+    try:
+        while True:
+            time.sleep(POLL_INTERVAL)
+            exited = [shard for shard in range(shards) if processes[shard].poll() is not None]
+            if len(exited) > 0:
+                status = processes[exited[0]].returncode
+                LOGGER.error('shard exited: %d status %d, stopping', exited[0], status)
+                break
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            process.wait()
+    return status
+
+
+def zoning_board_init(shard, shards):
+    """
+    initialize the zoning board of a shard process
+    :param shard: the shard of this process, None: not sharded
+    :param shards: number of shards
+    :return: None
+    """
+    global SHARD, SHARDS
+
+    if shard is None:
+        return None
+    SHARD = shard
+    SHARDS = shards
+    # every shard keeps its own temp directory, the share is common
+    main.TEMP_DIR = main.TEMP_DIR + TEMP_SHARD % shard
+    LOGGER.info('shard %d of %d, temp: %s', SHARD, SHARDS, main.TEMP_DIR)
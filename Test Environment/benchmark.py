@@ -0,0 +1,465 @@
+"""
+benchmark runs several instances of main.py on one Linux box and measures the synchronization
+
+each instance is bound to its own loopback address (127.0.0.10, 127.0.0.11, ...) and
+runs in its own working directory (share/ and temp/), all instances are peers of each other
+the dataset of a scenario is seeded on the first instance, the benchmark waits until
+every instance has the same files (convergence)
+
+scenarios:
+huge - one huge file
+small - many small files
+deep - files in a deep directory tree
+modify - a file on every instance is modified on the first one (partial update)
+
+measured per scenario:
+seconds - time from the start of the instances (modify: from the modification) to convergence
+throughput - bytes delivered to the other instances per second
+cpu_seconds - user + system time of each instance, codec workers included
+peak_rss - highest resident memory of each instance, codec workers included
+
+results are written as JSON, compare the results of two revisions with --compare:
+python3 benchmark.py --output new.json --compare old.json
+
+under emulated WAN conditions (latency, bandwidth, stalls, resets), every instance
+listens behind the WAN emulation proxy (reference -> wan_proxy), with --wan scenario.json
+
+e.g.
+python3 benchmark.py --nodes 3 --scenario huge,small --output results.json -- --compression yes
+(the arguments after -- are passed to every instance)
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import wan_proxy
+
+# config
+CODE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Code')
+BASE_IP = '127.0.0.'
+BASE_HOST = 10  # the instance i is bound to 127.0.0.<BASE_HOST + i>
+POLL_INTERVAL = 0.2  # seconds between two convergence checks / resource samples
+SCENARIOS = ['huge', 'small', 'deep', 'modify']
+REGRESSION_TOLERANCE = 0.1  # relative slowdown reported as a regression by --compare
+PEER_PORT = 23456  # port the instances connect to
+WAN_LISTEN_PORT = 23556  # port the instances listen on behind the WAN emulation proxy
+
+
+class Instance:
+    """
+    one running main.py
+    self.peak_rss: highest resident memory of the process tree seen
+    self.cpu_seconds: user + system time of the process tree at the last sample
+    """
+
+    def __init__(self, node_num, work_dir, num_nodes, extra_args):
+        self.node_num = node_num
+        self.ip = get_ip(node_num)
+        self.work_dir = os.path.join(work_dir, 'node' + str(node_num))
+        self.share_dir = os.path.join(self.work_dir, 'share')
+        self.peer_ips = [get_ip(peer_num) for peer_num in range(num_nodes) if peer_num != node_num]
+        self.extra_args = extra_args
+        self.process = None
+        self.log = None
+        self.peak_rss = 0
+        self.cpu_seconds = 0
+        self.cpu_seconds_by_pid = {}  # {pid: cpu seconds} of every process of the tree seen so far
+        os.makedirs(self.share_dir, exist_ok=True)
+
+    def start(self):
+        self.log = open(os.path.join(self.work_dir, 'log'), 'w')
+        arguments = [sys.executable, os.path.join(os.path.abspath(CODE_DIR), 'main.py'), '--bind', self.ip,
+                     '--ip', ','.join(self.peer_ips), '--control-port', '0', '--metrics-port', '0']
+        self.process = subprocess.Popen(arguments + self.extra_args, cwd=self.work_dir, stdout=self.log,
+                                        stderr=subprocess.STDOUT)
+
+    def sample(self):
+        """
+        sample the memory and CPU time of the process tree
+        :return: None
+        """
+        rss = 0
+        for pid in get_process_tree(self.process.pid):
+            try:
+                rss += read_rss(pid)
+                self.cpu_seconds_by_pid[pid] = read_cpu_seconds(pid)
+            except (FileNotFoundError, ProcessLookupError, IndexError, ValueError):
+                continue
+        self.peak_rss = max(self.peak_rss, rss, read_peak_rss(self.process.pid))
+        self.cpu_seconds = sum(self.cpu_seconds_by_pid.values())
+
+    def get_file_info_dirs(self):
+        """
+        :return: the file_info directories of the instance (reference -> file_center), one per shard when sharded
+        (reference -> zoning_board)
+        """
+        return glob.glob(os.path.join(self.work_dir, 'temp', 'file_info')) + \
+            glob.glob(os.path.join(self.work_dir, 'temp', 'shard_*', 'file_info'))
+
+    def is_indexed(self, file_name):
+        return any(os.path.exists(os.path.join(file_info_dir, file_name))
+                   for file_info_dir in self.get_file_info_dirs())
+
+    def stop(self):
+        for pid in reversed(get_process_tree(self.process.pid)):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                continue
+        self.process.wait()
+        self.log.close()
+
+
+def get_ip(node_num):
+    return BASE_IP + str(BASE_HOST + node_num)
+
+
+def get_process_tree(root_pid):
+    """
+    :return: [pid] of the process and its descendants, parents first
+    """
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/' + entry + '/stat') as f:
+                # the command name may contain spaces, the fields after it are space separated
+                parent_pid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (FileNotFoundError, ProcessLookupError, IndexError, ValueError):
+            continue
+        children.setdefault(parent_pid, []).append(int(entry))
+    tree = [root_pid]
+    for pid in tree:
+        tree.extend(children.get(pid, []))
+    return tree
+
+
+def read_rss(pid):
+    with open('/proc/' + str(pid) + '/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def read_peak_rss(pid):
+    try:
+        with open('/proc/' + str(pid) + '/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return 0
+
+
+def read_cpu_seconds(pid):
+    with open('/proc/' + str(pid) + '/stat') as f:
+        fields = f.read().rsplit(')', 1)[1].split()
+    # utime, stime (fields 14, 15 of proc(5)), the children are sampled on their own
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def seed(scenario, share_dir, arguments):
+    """
+    write the dataset of the scenario
+    :return: None
+    """
+    rng = random.Random(arguments.seed)
+    if scenario == 'huge' or scenario == 'modify':
+        write_random(os.path.join(share_dir, 'huge', 'huge.bin'), arguments.huge_size * 1048576, rng)
+    elif scenario == 'small':
+        for file_num in range(arguments.small_count):
+            write_random(os.path.join(share_dir, 'small', 'd' + str(file_num % 32), 'f' + str(file_num) + '.bin'),
+                         arguments.small_size, rng)
+    elif scenario == 'deep':
+        directory = os.path.join(share_dir, 'deep')
+        for level in range(arguments.depth):
+            directory = os.path.join(directory, 'l' + str(level))
+            for file_num in range(arguments.files_per_level):
+                write_random(os.path.join(directory, 'f' + str(file_num) + '.bin'), arguments.small_size, rng)
+
+
+def write_random(path, size, rng):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            chunk_size = min(remaining, 1048576)
+            f.write(rng.randbytes(chunk_size))
+            remaining -= chunk_size
+
+
+def modify(share_dir, rng):
+    """
+    overwrite the beginning of the huge file, the mtime is moved forward so that the change is detected
+    :return: None
+    """
+    path = os.path.join(share_dir, 'huge', 'huge.bin')
+    with open(path, 'r+b') as f:
+        f.write(rng.randbytes(1048576))
+    mtime = int(time.time()) + 2
+    os.utime(path, (mtime, mtime))
+
+
+class Manifest:
+    """
+    the files of a share: {relative path: (size, digest)}, digests of unchanged files are cached
+    """
+
+    def __init__(self, share_dir):
+        self.share_dir = share_dir
+        self.digests = {}  # {relative path: (size, mtime, digest)}
+
+    def read(self):
+        files = {}
+        for directory, _, file_names in os.walk(self.share_dir):
+            for file_name in file_names:
+                path = os.path.join(directory, file_name)
+                relative_path = os.path.relpath(path, self.share_dir)
+                try:
+                    status = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                files[relative_path] = status.st_size
+        return files
+
+    def get_digest(self, relative_path):
+        path = os.path.join(self.share_dir, relative_path)
+        status = os.stat(path)
+        cached = self.digests.get(relative_path)
+        if cached is not None and cached[0] == status.st_size and cached[1] == status.st_mtime_ns:
+            return cached[2]
+        digest = hashlib.blake2b()
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(8388608)
+                if len(chunk) == 0:
+                    break
+                digest.update(chunk)
+        self.digests[relative_path] = (status.st_size, status.st_mtime_ns, digest.hexdigest())
+        return digest.hexdigest()
+
+    def matches(self, expected_files, expected):
+        """
+        :param expected_files: {relative path: size}
+        :param expected: the Manifest of the expected share
+        :return: whether the share has exactly the expected files and content
+        """
+        try:
+            if self.read() != expected_files:
+                return False
+            return all(self.get_digest(relative_path) == expected.get_digest(relative_path)
+                       for relative_path in expected_files)
+        except FileNotFoundError:  # a file is being moved into place
+            return False
+
+
+def run_scenario(scenario, arguments, extra_args):
+    """
+    :return: the results of the scenario
+    """
+    work_dir = tempfile.mkdtemp(prefix='benchmark_' + scenario + '_', dir=arguments.work)
+    wan = None
+    if arguments.wan is not None:
+        extra_args = extra_args + ['--listen-port', str(WAN_LISTEN_PORT)]
+        wan = wan_proxy.WanProxy(wan_proxy.load_scenario(arguments.wan),
+                                 [((get_ip(node_num), PEER_PORT), (get_ip(node_num), WAN_LISTEN_PORT))
+                                  for node_num in range(arguments.nodes)])
+    instances = [Instance(node_num, work_dir, arguments.nodes, extra_args) for node_num in range(arguments.nodes)]
+    rng = random.Random(arguments.seed)
+    seed(scenario, instances[0].share_dir, arguments)
+    if scenario == 'modify':
+        # every instance starts with the file, only the modification is transferred
+        for instance in instances[1:]:
+            shutil.rmtree(instance.share_dir)
+            shutil.copytree(instances[0].share_dir, instance.share_dir, copy_function=shutil.copy2)
+
+    expected = Manifest(instances[0].share_dir)
+    expected_files = expected.read()
+    dataset_size = sum(expected_files.values())
+    manifests = [Manifest(instance.share_dir) for instance in instances]
+
+    stop_sampling = threading.Event()
+
+    def sample():
+        while not stop_sampling.is_set():
+            for instance in instances:
+                instance.sample()
+            stop_sampling.wait(POLL_INTERVAL)
+
+    if wan is not None:
+        wan.start()
+    for instance in instances:
+        instance.start()
+    start_time = time.time()
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+    if scenario == 'modify':
+        # wait until every instance has indexed the file, then modify it on the first one
+        while not all(instance.is_indexed(os.path.join('huge', 'huge.bin')) for instance in instances):
+            time.sleep(POLL_INTERVAL)
+        time.sleep(arguments.settle)
+        modify(instances[0].share_dir, rng)
+        start_time = time.time()
+        expected_files = expected.read()
+        dataset_size = 1048576
+
+    converged = False
+    seconds = None
+    while time.time() - start_time < arguments.timeout:
+        if all(manifest.matches(expected_files, expected) for manifest in manifests[1:]):
+            converged = True
+            seconds = time.time() - start_time
+            break
+        time.sleep(POLL_INTERVAL)
+
+    stop_sampling.set()
+    sampler.join()
+    for instance in instances:
+        instance.sample()
+        instance.stop()
+    if wan is not None:
+        wan.stop()
+    if not arguments.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    delivered = dataset_size * (arguments.nodes - 1)
+    return {
+        'converged': converged,
+        'seconds': seconds,
+        'files': len(expected_files),
+        'dataset_bytes': dataset_size,
+        'throughput_bytes_per_second': delivered / seconds if converged and seconds > 0 else None,
+        'cpu_seconds': [round(instance.cpu_seconds, 3) for instance in instances],
+        'peak_rss_bytes': [instance.peak_rss for instance in instances],
+        'work_dir': work_dir if arguments.keep else None,
+    }
+
+
+def get_revision():
+    """
+    :return: (commit, whether the tree has uncommitted changes), (None, None) if not in a git repository
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=CODE_DIR, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--', '.'], cwd=CODE_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        return commit, len(status) > 0
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def compare(results, baseline):
+    """
+    print the change of each scenario against the baseline
+    :return: whether no scenario regressed beyond REGRESSION_TOLERANCE
+    """
+    passed = True
+    print('scenario\tbaseline s\tcurrent s\tchange')
+    for scenario, result in results['scenarios'].items():
+        baseline_result = baseline.get('scenarios', {}).get(scenario)
+        if baseline_result is None or not baseline_result['converged']:
+            print(scenario + '\t-\t' + str(result['seconds']) + '\t-')
+            continue
+        if not result['converged']:
+            print(scenario + '\t' + format(baseline_result['seconds'], '.2f') + '\tnot converged\tREGRESSION')
+            passed = False
+            continue
+        change = result['seconds'] / baseline_result['seconds'] - 1
+        regression = change > REGRESSION_TOLERANCE
+        passed = passed and not regression
+        print(scenario + '\t' + format(baseline_result['seconds'], '.2f') + '\t' + format(result['seconds'], '.2f') +
+              '\t' + format(change, '+.1%') + ('\tREGRESSION' if regression else ''))
+    return passed
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='TwoDrive loopback benchmark')
+    parser.add_argument('--nodes', action='store', default=2, type=int, help='number of instances')
+    parser.add_argument('--scenario', action='store', default=','.join(SCENARIOS), type=str,
+                        help='scenarios to run [' + ','.join(SCENARIOS) + ']')
+    parser.add_argument('--huge-size', action='store', default=256, type=int, help='size of the huge file in MB')
+    parser.add_argument('--small-count', action='store', default=1000, type=int, help='number of small files')
+    parser.add_argument('--small-size', action='store', default=4096, type=int, help='size of a small file in bytes')
+    parser.add_argument('--depth', action='store', default=16, type=int, help='depth of the deep tree')
+    parser.add_argument('--files-per-level', action='store', default=4, type=int,
+                        help='files in each directory of the deep tree')
+    parser.add_argument('--settle', action='store', default=3, type=float,
+                        help='seconds to wait before the modification, so the instances are connected')
+    parser.add_argument('--timeout', action='store', default=300, type=float, help='seconds to wait per scenario')
+    parser.add_argument('--seed', action='store', default=0, type=int, help='seed of the synthetic data')
+    parser.add_argument('--work', action='store', default=None, type=str,
+                        help='directory of the working directories of the instances, default: system temp')
+    parser.add_argument('--keep', action='store_true', help='keep the working directories and logs')
+    parser.add_argument('--output', action='store', default=None, type=str, help='JSON results file')
+    parser.add_argument('--compare', action='store', default=None, type=str,
+                        help='JSON results of a baseline revision to compare with')
+    parser.add_argument('--wan', action='store', default=None, type=str,
+                        help='WAN emulation scenario file (reference -> wan_proxy), default: plain loopback')
+    parser.add_argument('instance_args', nargs=argparse.REMAINDER,
+                        help='arguments passed to every instance, after --')
+
+    arguments = parser.parse_args()
+    scenarios = arguments.scenario.split(',')
+    for scenario in scenarios:
+        if scenario not in SCENARIOS:
+            print('scenario incorrect:', scenario)
+            exit(2)
+    if arguments.nodes < 2 or arguments.nodes > 200:
+        print('number of instances incorrect:', arguments.nodes)
+        exit(2)
+    extra_args = arguments.instance_args
+    if len(extra_args) > 0 and extra_args[0] == '--':
+        extra_args = extra_args[1:]
+    return arguments, scenarios, extra_args
+
+
+def run():
+    arguments, scenarios, extra_args = get_arguments()
+    commit, dirty = get_revision()
+    results = {
+        'revision': commit,
+        'dirty': dirty,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'nodes': arguments.nodes,
+        'instance_args': extra_args,
+        'wan': wan_proxy.load_scenario(arguments.wan) if arguments.wan is not None else None,
+        'parameters': {'huge_size_mb': arguments.huge_size, 'small_count': arguments.small_count,
+                       'small_size': arguments.small_size, 'depth': arguments.depth,
+                       'files_per_level': arguments.files_per_level, 'seed': arguments.seed},
+        'scenarios': {},
+    }
+    for scenario in scenarios:
+        print('running:', scenario, file=sys.stderr)
+        results['scenarios'][scenario] = run_scenario(scenario, arguments, extra_args)
+        print(scenario + ':', json.dumps(results['scenarios'][scenario]), file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as f:
+            baseline = json.load(f)
+        if not compare(results, baseline):
+            exit(1)
+
+
+if __name__ == '__main__':
+    run()
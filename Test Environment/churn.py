@@ -0,0 +1,552 @@
+"""
+churn builds synthetic shares and changes them at a target rate while the instances run,
+to measure how the indexing (file_center) and the synchronization scale with the number of files
+
+for each file count of the scaling curve (--scales):
+1. a share of that many files is generated (sizes from --sizes, in a tree of --depth
+   levels of --fanout directories) and copied to every instance, mtimes included, so
+   the instances only index it and exchange their file dicts
+2. the instances are started (reference -> benchmark), the indexing is complete once
+   every instance has every file in its file dict (files_indexed, reference -> observatory)
+3. the churn script runs on the first instance for --duration seconds at --rate operations
+   per second, the operations are drawn with the --mix weights:
+   create - a new file
+   append - bytes appended to a file
+   edit - bytes overwritten in place in a file
+   rename - a file moved to a new name
+   delete - a file removed
+   a file is only changed again once its previous change is synchronized and
+   its mtime is in an earlier second (mtimes are compared in seconds)
+4. the benchmark waits --settle seconds at most for the last changes
+
+measured per operation:
+detection - from the change to the first instance indexing it (temp/file_info written)
+sync - from the change to every other instance having the same content under the name
+       (rename: the new name, delete: the name gone)
+measured per instance: peak resident memory, peak thread count, CPU time
+
+an instance that exits, or an indexing that does not complete within --timeout, breaks
+the curve: the larger file counts are not run
+
+results are written as JSON, the seconds of a file count are the 95th percentile sync latency,
+compare the results of two revisions with --compare (reference -> benchmark)
+
+e.g.
+python3 churn.py --scales 1000,10000,100000,1000000 --rate 20 --duration 30 --output churn.json
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+import benchmark
+
+OPERATIONS = ['create', 'append', 'edit', 'rename', 'delete']
+
+# config
+METRICS_BASE_PORT = 23560  # the instance i serves its metrics on METRICS_BASE_PORT + i
+SHARD_PORT_STRIDE = 10  # shard j of a sharded instance on port + j * SHARD_PORT_STRIDE (reference -> zoning_board)
+MAX_SIZE = 67108864  # 64MB, largest synthetic file
+CHANGE_SIZE = 4096  # bytes appended / overwritten by an operation
+STABLE_TIME = 2  # seconds since the last change before a file is changed again
+
+
+class Operation:
+    """
+    a change made on the first instance
+    self.digest: (size, digest) of the content expected on the other instances, None if deleted
+    """
+
+    def __init__(self, operation, file_name, old_name, info_mtime, digest):
+        self.operation = operation
+        self.file_name = file_name
+        self.old_name = old_name
+        self.info_mtime = info_mtime  # mtime of the file info before the change, None if not indexed
+        self.digest = digest
+        self.time = time.time()
+        self.detected = None
+        self.synced = None
+
+
+class Workload:
+    """
+    the files of the first instance and the churn applied to them
+    self.files: {file_name: time of the last change}
+    self.pending: [Operation] not synchronized yet
+    """
+
+    def __init__(self, instances, arguments, rng):
+        self.instances = instances
+        self.share_dir = instances[0].share_dir
+        self.arguments = arguments
+        self.rng = rng
+        self.sizes = parse_sizes(arguments.sizes)
+        self.mix = parse_mix(arguments.mix)
+        self.files = {}
+        self.file_num = 0
+        self.pending = []
+        self.done = []
+        self.lock = threading.Lock()
+
+    def generate(self, count):
+        """
+        write count files to the share of the first instance
+        :return: bytes written
+        """
+        total_size = 0
+        for _ in range(count):
+            file_name = self.new_name()
+            size = self.draw_size()
+            benchmark.write_random(os.path.join(self.share_dir, file_name), size, self.rng)
+            self.files[file_name] = 0
+            total_size += size
+        return total_size
+
+    def new_name(self):
+        directories = ['d' + str(self.rng.randrange(self.arguments.fanout)) for _ in range(self.arguments.depth)]
+        self.file_num += 1
+        return '/'.join(directories + ['f' + str(self.file_num) + '.bin'])
+
+    def draw_size(self):
+        distribution, parameters = self.sizes
+        if distribution == 'fixed':
+            size = parameters[0]
+        elif distribution == 'uniform':
+            size = self.rng.randint(parameters[0], parameters[1])
+        else:  # lognormal: median, sigma
+            size = int(parameters[0] * math.exp(parameters[1] * self.rng.gauss(0, 1)))
+        return max(0, min(size, MAX_SIZE))
+
+    def apply(self):
+        """
+        apply one operation of the mix to the share of the first instance
+        :return: None
+        """
+        operation = self.rng.choices(OPERATIONS, weights=[self.mix[name] for name in OPERATIONS])[0]
+        if operation != 'create':
+            with self.lock:
+                busy = {pending.file_name for pending in self.pending} | \
+                    {pending.old_name for pending in self.pending}
+            stable_time = time.time() - STABLE_TIME
+            # a sample of the files, so that picking a target does not scan a million files
+            candidates = [file_name for file_name in self.rng.sample(list(self.files), min(64, len(self.files)))
+                          if file_name not in busy and self.files[file_name] < stable_time]
+            if len(candidates) == 0:
+                operation = 'create'
+            else:
+                file_name = self.rng.choice(candidates)
+        if operation == 'create':
+            file_name = self.new_name()
+        path = os.path.join(self.share_dir, file_name)
+        info_mtime = get_info_mtime(self.instances[0], file_name)
+        old_name = None
+        if operation == 'create':
+            benchmark.write_random(path, self.draw_size(), self.rng)
+        elif operation == 'append':
+            with open(path, 'ab') as f:
+                f.write(self.rng.randbytes(CHANGE_SIZE))
+        elif operation == 'edit':
+            with open(path, 'r+b') as f:
+                f.seek(self.rng.randrange(max(os.path.getsize(path) - CHANGE_SIZE, 0) + 1))
+                f.write(self.rng.randbytes(CHANGE_SIZE))
+        elif operation == 'rename':
+            old_name = file_name
+            file_name = self.new_name()
+            os.makedirs(os.path.dirname(os.path.join(self.share_dir, file_name)), exist_ok=True)
+            os.rename(path, os.path.join(self.share_dir, file_name))
+            del self.files[old_name]
+            info_mtime = None
+        elif operation == 'delete':
+            os.remove(path)
+            del self.files[file_name]
+        digest = get_digest(os.path.join(self.share_dir, file_name)) if operation != 'delete' else None
+        if operation != 'delete':
+            self.files[file_name] = time.time()
+        with self.lock:
+            self.pending.append(Operation(operation, file_name, old_name, info_mtime, digest))
+
+    def check(self):
+        """
+        check the pending operations for detection and synchronization
+        :return: None
+        """
+        with self.lock:
+            pending = list(self.pending)
+        now = time.time()
+        for operation in pending:
+            if operation.detected is None and is_detected(self.instances[0], operation):
+                operation.detected = now
+            if is_synced(self.instances[1:], operation):
+                operation.synced = now
+                with self.lock:
+                    self.pending.remove(operation)
+                    self.done.append(operation)
+
+    def get_results(self):
+        """
+        :return: {operation: {count, detected, synced, detection / sync latency percentiles}}
+        """
+        results = {}
+        with self.lock:
+            operations = self.done + self.pending
+        for name in OPERATIONS:
+            selected = [operation for operation in operations if operation.operation == name]
+            if len(selected) == 0:
+                continue
+            detection = [operation.detected - operation.time for operation in selected
+                         if operation.detected is not None]
+            sync = [operation.synced - operation.time for operation in selected if operation.synced is not None]
+            results[name] = {'count': len(selected), 'detected': len(detection), 'synced': len(sync),
+                             'detection_seconds': get_percentiles(detection), 'sync_seconds': get_percentiles(sync)}
+        return results
+
+
+def get_info_mtime(instance, file_name):
+    for file_info_dir in instance.get_file_info_dirs():
+        try:
+            return os.stat(os.path.join(file_info_dir, file_name)).st_mtime_ns
+        except OSError:
+            continue
+    return None
+
+
+def is_detected(instance, operation):
+    """
+    the file info of the file is written after the change (delete: never, deletions are not indexed)
+    """
+    if operation.operation == 'delete':
+        return False
+    info_mtime = get_info_mtime(instance, operation.file_name)
+    return info_mtime is not None and info_mtime != operation.info_mtime
+
+
+def is_synced(instances, operation):
+    for instance in instances:
+        path = os.path.join(instance.share_dir, operation.file_name)
+        if operation.digest is None:
+            if os.path.exists(path):
+                return False
+            continue
+        try:
+            if os.path.getsize(path) != operation.digest[0] or get_digest(path) != operation.digest:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def get_digest(path):
+    with open(path, 'rb') as f:
+        return os.fstat(f.fileno()).st_size, hashlib.blake2b(f.read()).hexdigest()
+
+
+def get_percentiles(values):
+    if len(values) == 0:
+        return None
+    values = sorted(values)
+    return {'p50': round(values[len(values) // 2], 3), 'p95': round(values[min(len(values) * 95 // 100,
+                                                                               len(values) - 1)], 3),
+            'max': round(values[-1], 3)}
+
+
+def get_shards(extra_args):
+    """
+    :return: number of shard processes of an instance (reference -> zoning_board)
+    """
+    for i in range(len(extra_args)):
+        if extra_args[i] == '--shards' and i + 1 < len(extra_args):
+            return int(extra_args[i + 1])
+        if extra_args[i].startswith('--shards='):
+            return int(extra_args[i].split('=', 1)[1])
+    return 1
+
+
+def get_files_indexed(instance, shards):
+    """
+    :return: files in the file dicts of the instance (reference -> observatory), None if not available
+    """
+    files_indexed = 0
+    for shard in range(shards):
+        port = METRICS_BASE_PORT + instance.node_num + shard * SHARD_PORT_STRIDE
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:' + str(port) + '/metrics', timeout=5) as response:
+                lines = [line for line in response.read().decode().splitlines()
+                         if line.startswith('twodrive_files_indexed ')]
+        except OSError:
+            return None
+        if len(lines) == 0:
+            return None
+        files_indexed += int(float(lines[0].split()[1]))
+    return files_indexed
+
+
+def read_threads(pid):
+    with open('/proc/' + str(pid) + '/status') as f:
+        for line in f:
+            if line.startswith('Threads:'):
+                return int(line.split()[1])
+    return 0
+
+
+class Sampler(threading.Thread):
+    """
+    samples the memory, CPU time and threads of the instances
+    self.peak_threads: [highest thread count of the process tree of each instance]
+    """
+
+    def __init__(self, instances):
+        threading.Thread.__init__(self, daemon=True)
+        self.instances = instances
+        self.peak_threads = [0 for _ in instances]
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(benchmark.POLL_INTERVAL):
+            self.sample()
+
+    def sample(self):
+        for instance_num in range(len(self.instances)):
+            instance = self.instances[instance_num]
+            instance.sample()
+            threads = 0
+            for pid in benchmark.get_process_tree(instance.process.pid):
+                try:
+                    threads += read_threads(pid)
+                except (FileNotFoundError, ProcessLookupError):
+                    continue
+            self.peak_threads[instance_num] = max(self.peak_threads[instance_num], threads)
+
+
+def get_tree_size(directory):
+    size = 0
+    for directory_path, _, file_names in os.walk(directory):
+        for file_name in file_names:
+            try:
+                size += os.path.getsize(os.path.join(directory_path, file_name))
+            except OSError:
+                continue
+    return size
+
+
+def run_scale(count, arguments, extra_args):
+    """
+    :return: the results of the file count
+    """
+    work_dir = tempfile.mkdtemp(prefix='churn_' + str(count) + '_', dir=arguments.work)
+    instances = [benchmark.Instance(node_num, work_dir, arguments.nodes, extra_args)
+                 for node_num in range(arguments.nodes)]
+    for instance in instances:
+        instance.extra_args = extra_args + ['--metrics-port', str(METRICS_BASE_PORT + instance.node_num)]
+    shards = get_shards(extra_args)
+    workload = Workload(instances, arguments, random.Random(arguments.seed))
+    print('generating', count, 'files', file=sys.stderr)
+    dataset_size = workload.generate(count)
+    # every instance starts with the same files: only the indexing and the file dicts
+    for instance in instances[1:]:
+        shutil.rmtree(instance.share_dir)
+        shutil.copytree(instances[0].share_dir, instance.share_dir, copy_function=shutil.copy2)
+
+    sampler = Sampler(instances)
+    result = {'files': count, 'dataset_bytes': dataset_size, 'broken': None, 'converged': False, 'seconds': None}
+    for instance in instances:
+        instance.start()
+    start_time = time.time()
+    sampler.start()
+    try:
+        # indexing
+        while True:
+            if any(instance.process.poll() is not None for instance in instances):
+                result['broken'] = 'instance exited while indexing'
+                break
+            if time.time() - start_time > arguments.timeout:
+                result['broken'] = 'indexing not complete within ' + str(arguments.timeout) + 's'
+                break
+            if all(get_files_indexed(instance, shards) == count for instance in instances):
+                result['index_seconds'] = time.time() - start_time
+                break
+            time.sleep(benchmark.POLL_INTERVAL)
+
+        # churn
+        if result['broken'] is None:
+            print('indexed in', round(result['index_seconds'], 3), 's, churning', file=sys.stderr)
+            # the mtimes of the last indexed second are not changed again in the same second
+            time.sleep(STABLE_TIME)
+            churn_start_time = time.time()
+            operation_num = 0
+            while time.time() - churn_start_time < arguments.duration:
+                due_time = churn_start_time + operation_num / arguments.rate
+                if time.time() < due_time:
+                    workload.check()
+                    time.sleep(min(max(due_time - time.time(), 0), benchmark.POLL_INTERVAL))
+                    continue
+                workload.apply()
+                operation_num += 1
+            result['operations_per_second'] = operation_num / (time.time() - churn_start_time)
+            settle_start_time = time.time()
+            while time.time() - settle_start_time < arguments.settle:
+                workload.check()
+                # deletions are not synchronized: do not wait for them
+                if all(operation.operation == 'delete' for operation in workload.pending):
+                    break
+                if any(instance.process.poll() is not None for instance in instances):
+                    result['broken'] = 'instance exited while churning'
+                    break
+                time.sleep(benchmark.POLL_INTERVAL)
+            result['operations'] = workload.get_results()
+            sync = [operation.synced - operation.time for operation in workload.done]
+            syncable = [operation for operation in workload.done + workload.pending if operation.operation != 'delete']
+            result['converged'] = result['broken'] is None and all(operation.synced is not None
+                                                                   for operation in syncable)
+            result['seconds'] = get_percentiles(sync)['p95'] if len(sync) > 0 else None
+        result['file_info_bytes'] = sum(get_tree_size(file_info_dir)
+                                        for file_info_dir in instances[0].get_file_info_dirs())
+    finally:
+        sampler.stopped.set()
+        sampler.join()
+        sampler.sample()
+        for instance in instances:
+            instance.stop()
+        if not arguments.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    result['cpu_seconds'] = [round(instance.cpu_seconds, 3) for instance in instances]
+    result['peak_rss_bytes'] = [instance.peak_rss for instance in instances]
+    result['peak_threads'] = sampler.peak_threads
+    result['work_dir'] = work_dir if arguments.keep else None
+    return result
+
+
+def parse_sizes(sizes):
+    """
+    :param sizes: fixed:SIZE | uniform:MIN:MAX | lognormal:MEDIAN:SIGMA, sizes in bytes
+    :return: (distribution, [parameter, ...])
+    """
+    try:
+        distribution, *parameters = sizes.split(':')
+        parameters = [float(parameter) for parameter in parameters]
+        if distribution == 'fixed' and len(parameters) == 1 or \
+                distribution in ('uniform', 'lognormal') and len(parameters) == 2:
+            if distribution != 'lognormal':
+                parameters = [int(parameter) for parameter in parameters]
+            return distribution, parameters
+    except ValueError:
+        pass
+    raise ValueError('size distribution format incorrect in: ' + sizes)
+
+
+def parse_mix(mix):
+    """
+    :param mix: operation:weight,... e.g. create:4,append:2,edit:2,rename:1,delete:1
+    :return: {operation: weight}
+    """
+    weights = {name: 0 for name in OPERATIONS}
+    try:
+        for item in mix.split(','):
+            name, weight = item.split(':')
+            if name not in weights:
+                raise ValueError
+            weights[name] = float(weight)
+    except ValueError:
+        raise ValueError('operation mix format incorrect in: ' + mix)
+    if sum(weights.values()) <= 0:
+        raise ValueError('operation mix without operations: ' + mix)
+    return weights
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='TwoDrive churn and scale benchmark')
+    parser.add_argument('--nodes', action='store', default=2, type=int, help='number of instances')
+    parser.add_argument('--scales', action='store', default='1000,10000,100000,1000000', type=str,
+                        help='file counts of the scaling curve, comma separated')
+    parser.add_argument('--sizes', action='store', default='lognormal:4096:1.5', type=str,
+                        help='file size distribution in bytes [fixed:SIZE | uniform:MIN:MAX | lognormal:MEDIAN:SIGMA]')
+    parser.add_argument('--depth', action='store', default=3, type=int, help='directory levels above the files')
+    parser.add_argument('--fanout', action='store', default=16, type=int, help='directories per level')
+    parser.add_argument('--rate', action='store', default=10, type=float, help='churn operations per second')
+    parser.add_argument('--duration', action='store', default=30, type=float, help='seconds of churn')
+    parser.add_argument('--mix', action='store', default='create:4,append:2,edit:2,rename:1,delete:1', type=str,
+                        help='weights of the operations [operation:weight,...]')
+    parser.add_argument('--settle', action='store', default=60, type=float,
+                        help='seconds to wait for the last changes after the churn')
+    parser.add_argument('--timeout', action='store', default=1800, type=float,
+                        help='seconds to wait for the indexing of a file count')
+    parser.add_argument('--seed', action='store', default=0, type=int, help='seed of the synthetic data and churn')
+    parser.add_argument('--work', action='store', default=None, type=str,
+                        help='directory of the working directories of the instances, default: system temp')
+    parser.add_argument('--keep', action='store_true', help='keep the working directories and logs')
+    parser.add_argument('--output', action='store', default=None, type=str, help='JSON results file')
+    parser.add_argument('--compare', action='store', default=None, type=str,
+                        help='JSON results of a baseline revision to compare with')
+    parser.add_argument('instance_args', nargs=argparse.REMAINDER,
+                        help='arguments passed to every instance, after --')
+
+    arguments = parser.parse_args()
+    try:
+        scales = [int(count) for count in arguments.scales.split(',')]
+        parse_sizes(arguments.sizes)
+        parse_mix(arguments.mix)
+    except ValueError as e:
+        print(e)
+        exit(2)
+    if arguments.nodes < 2 or arguments.nodes > 200:
+        print('number of instances incorrect:', arguments.nodes)
+        exit(2)
+    if arguments.rate <= 0 or arguments.depth < 0 or arguments.fanout < 1:
+        print('rate, depth or fanout incorrect')
+        exit(2)
+    extra_args = arguments.instance_args
+    if len(extra_args) > 0 and extra_args[0] == '--':
+        extra_args = extra_args[1:]
+    return arguments, scales, extra_args
+
+
+def run():
+    arguments, scales, extra_args = get_arguments()
+    commit, dirty = benchmark.get_revision()
+    results = {
+        'revision': commit,
+        'dirty': dirty,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'nodes': arguments.nodes,
+        'instance_args': extra_args,
+        'parameters': {'sizes': arguments.sizes, 'depth': arguments.depth, 'fanout': arguments.fanout,
+                       'rate': arguments.rate, 'duration': arguments.duration, 'mix': arguments.mix,
+                       'seed': arguments.seed},
+        'scenarios': {},
+    }
+    for count in scales:
+        print('running:', count, 'files', file=sys.stderr)
+        result = run_scale(count, arguments, extra_args)
+        results['scenarios']['files-' + str(count)] = result
+        print(str(count) + ':', json.dumps(result), file=sys.stderr)
+        if result['broken'] is not None:
+            print('broken at', count, 'files:', result['broken'], file=sys.stderr)
+            break
+
+    output = json.dumps(results, indent=2)
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as f:
+            baseline = json.load(f)
+        if not benchmark.compare(results, baseline):
+            exit(1)
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,445 @@
+"""
+replay feeds a captured session (reference -> Code/black_box) into one instance of main.py,
+to benchmark the receiver side (decode, scheduling, disk writes) on real traffic shapes
+
+the instance runs in its own working directory, bound to 127.0.0.10, the replayer
+takes the place of its peer on 127.0.0.11:
+- the control messages received in the capture (file dict, file added / modified,
+  partial file, compression) are sent in the captured order
+- the block requests of the instance are answered with the block segments received
+  in the capture, the instance schedules its downloads itself
+- the captured block requests (the instance serving its peer) are not replayed
+the captured encryption is replaced by no encryption: the capture is not encrypted
+
+speed:
+recorded - each message is sent no earlier than at its captured time since the start of the session
+max - each message is sent as soon as possible
+
+the replay is complete once every file whose blocks are all in the capture is in the
+share of the instance, with the captured size
+
+results are written as JSON, compare the results of two revisions with --compare:
+python3 replay.py capture.bin --output new.json --compare old.json
+
+e.g.
+python3 main.py --capture-file capture.bin  (on the host to reproduce, then)
+python3 replay.py capture.bin --summary
+python3 replay.py capture.bin --speed max --output results.json -- --compression yes
+(the arguments after -- are passed to the instance)
+"""
+import argparse
+import bisect
+import heapq
+import json
+import os
+import pickle
+import platform
+import shutil
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import benchmark
+
+sys.path.insert(0, os.path.abspath(benchmark.CODE_DIR))
+import black_box, compression_station, quality_control  # noqa: E402
+
+# message types (reference -> connection_hub)
+MESSAGE_ENCRYPTION = 0
+MESSAGE_FILE_DICT = 1
+MESSAGE_FILE_MODIFIED = 2
+MESSAGE_FILE_ADDED = 3
+MESSAGE_BLOCK_REQUEST = 4
+MESSAGE_BLOCK = 5
+MESSAGE_COMPRESSION = 6
+MESSAGE_PARTIAL_FILE = 7
+MESSAGE_NAMES = {0: 'encryption', 1: 'file_dict', 2: 'file_modified', 3: 'file_added', 4: 'block_request',
+                 5: 'block', 6: 'compression', 7: 'partial_file', 8: 'heartbeat', 9: 'stream_request',
+                 10: 'stream'}
+ENCRYPTION_NO_ENCRYPTION = 0
+FILE_INFO_NUM_BLOCKS = 2  # reference -> file_center
+
+SPEED_RECORDED = 'recorded'
+SPEED_MAX = 'max'
+SPEEDS = [SPEED_RECORDED, SPEED_MAX]
+
+# config
+PORT = 23456
+NODE_NUM = 0  # the instance is bound to benchmark.get_ip(NODE_NUM)
+REPLAYER_NUM = 1  # the replayer is bound to benchmark.get_ip(REPLAYER_NUM)
+CONTROL_TYPES = [MESSAGE_FILE_DICT, MESSAGE_FILE_MODIFIED, MESSAGE_FILE_ADDED, MESSAGE_COMPRESSION,
+                 MESSAGE_PARTIAL_FILE]
+
+
+class Session:
+    """
+    the received messages of a capture
+    self.control: [(time, message_type, message)] in captured order
+    self.segments: {(file_name, block_num, offset): [(time, message)]} in captured order
+    self.offsets: {(file_name, block_num): [offset]} sorted
+    self.block_sizes: {(file_name, block_num): block_size}
+    self.file_infos: {file_name: file_info} the latest captured (reference -> file_center)
+    """
+
+    def __init__(self, capture_path, peer_ip=None):
+        self.control = []
+        self.segments = {}
+        self.offsets = {}
+        self.segment_sizes = {}  # {(file_name, block_num, offset): segment size}
+        self.block_sizes = {}
+        self.file_infos = {}
+        self.start_time = None
+        for record_time, direction, record_peer_ip, message_type, _, payload_kind, payload in \
+                black_box.read(capture_path):
+            if direction != black_box.DIRECTION_IN or peer_ip is not None and record_peer_ip != peer_ip:
+                continue
+            if message_type not in CONTROL_TYPES and message_type != MESSAGE_BLOCK:
+                continue
+            if payload_kind != black_box.PAYLOAD_FULL:
+                raise ValueError('the capture has no payloads (--capture-payload no), only --summary is available')
+            if self.start_time is None:
+                self.start_time = record_time
+            if message_type == MESSAGE_BLOCK:
+                self.add_segment(record_time, payload)
+            else:
+                self.add_control(record_time, message_type, payload)
+
+    def add_segment(self, record_time, message):
+        # block segment (reference -> connection_hub), decoded to be indexed, sent as captured
+        decoded = compression_station.decompress(message[1:], message[0])
+        block_num, offset, block_size, file_name_size = struct.unpack('!QQQQ', decoded[:32])
+        file_name = decoded[32:32+file_name_size].decode()
+        segment_size = len(decoded) - 32 - file_name_size - quality_control.DIGEST_SIZE
+        if (file_name, block_num, offset) not in self.segments:
+            self.segments[(file_name, block_num, offset)] = []
+            bisect.insort(self.offsets.setdefault((file_name, block_num), []), offset)
+        self.segments[(file_name, block_num, offset)].append((record_time, message))
+        self.segment_sizes[(file_name, block_num, offset)] = segment_size
+        self.block_sizes[(file_name, block_num)] = block_size
+
+    def add_control(self, record_time, message_type, message):
+        self.control.append((record_time, message_type, message))
+        if message_type == MESSAGE_FILE_DICT:
+            self.file_infos.update(pickle.loads(message))
+        elif message_type in (MESSAGE_FILE_MODIFIED, MESSAGE_FILE_ADDED, MESSAGE_PARTIAL_FILE):
+            file_name_size = struct.unpack('!Q', message[:8])[0]
+            file_name = message[8:8+file_name_size].decode()
+            if message_type == MESSAGE_PARTIAL_FILE:
+                file_info_size = struct.unpack('!Q', message[8+file_name_size:16+file_name_size])[0]
+                file_info = pickle.loads(message[16+file_name_size:16+file_name_size+file_info_size])
+            else:
+                file_info = pickle.loads(message[8+file_name_size:])
+            self.file_infos[file_name] = file_info
+
+    def get_offsets(self, file_name, block_num):
+        return self.offsets.get((file_name, block_num), [])
+
+    def is_block_complete(self, file_name, block_num):
+        if (file_name, block_num) not in self.block_sizes:
+            return False
+        size = 0
+        for offset in self.get_offsets(file_name, block_num):
+            if offset != size:
+                return False
+            size += self.segment_sizes[(file_name, block_num, offset)]
+        return size == self.block_sizes[(file_name, block_num)]
+
+    def get_expected(self):
+        """
+        :return: {file_name: size} of the files whose blocks are all in the capture
+        """
+        expected = {}
+        for file_name, file_info in self.file_infos.items():
+            num_blocks = file_info[FILE_INFO_NUM_BLOCKS]
+            if num_blocks > 0 and all(self.is_block_complete(file_name, block_num) for block_num in range(num_blocks)):
+                expected[file_name] = sum(self.block_sizes[(file_name, block_num)] for block_num in range(num_blocks))
+        return expected
+
+
+class Feeder(threading.Thread):
+    """
+    sends the messages to the inbox of the instance when they are due
+    self.heap: [(due time, sequence number, message_type, message)]
+    """
+
+    def __init__(self, inbox_socket):
+        threading.Thread.__init__(self, daemon=True)
+        self.inbox_socket = inbox_socket
+        self.heap = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.sent = 0
+
+    def send(self, due_time, message_type, message):
+        with self.condition:
+            heapq.heappush(self.heap, (due_time, self.sequence, message_type, message))
+            self.sequence += 1
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while len(self.heap) == 0 or self.heap[0][0] > time.time():
+                    self.condition.wait(self.heap[0][0] - time.time() if len(self.heap) > 0 else None)
+                _, _, message_type, message = heapq.heappop(self.heap)
+            try:
+                self.inbox_socket.sendall(struct.pack('!QI', len(message), message_type) + message)
+            except OSError as e:  # the instance stopped
+                print('replay connection lost:', e, file=sys.stderr)
+                return None
+            self.sent += 1
+
+
+class Replayer(threading.Thread):
+    """
+    accepts the outbox of the instance and answers its block requests
+    """
+
+    def __init__(self, session, speed, ip):
+        threading.Thread.__init__(self, daemon=True)
+        self.session = session
+        self.speed = speed
+        self.start_time = None
+        self.feeder = None
+        self.requests = 0
+        self.requests_unserved = 0
+        self.served = {}  # {(file_name, block_num, offset): number of times served}
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind((ip, PORT))
+        self.listen_socket.listen(1)
+
+    def start_session(self, inbox_socket):
+        """
+        start sending the session to the inbox of the instance
+        :return: None
+        """
+        self.start_time = time.time()
+        self.feeder = Feeder(inbox_socket)
+        self.feeder.start()
+        self.feeder.send(self.start_time, MESSAGE_ENCRYPTION, struct.pack('!I', ENCRYPTION_NO_ENCRYPTION))
+        for record_time, message_type, message in self.session.control:
+            self.feeder.send(self.get_due_time(record_time), message_type, message)
+
+    def get_due_time(self, record_time):
+        if self.speed == SPEED_MAX:
+            return self.start_time
+        return self.start_time + record_time - self.session.start_time
+
+    def run(self):
+        while True:
+            outbox_socket, _ = self.listen_socket.accept()
+            try:
+                while True:
+                    message_size, message_type = struct.unpack('!QI', receive(outbox_socket, 12))
+                    message = receive(outbox_socket, message_size)
+                    if message_type == MESSAGE_BLOCK_REQUEST:
+                        block_num, offset = struct.unpack('!QQ', message[:16])
+                        self.serve(message[16:].decode(), block_num, offset)
+            except (OSError, struct.error):  # the outbox reconnects
+                outbox_socket.close()
+
+    def serve(self, file_name, block_num, offset):
+        """
+        answer a block request with the captured segments of the block from the offset on
+        :return: None
+        """
+        self.requests += 1
+        offsets = [segment_offset for segment_offset in self.session.get_offsets(file_name, block_num)
+                   if segment_offset >= offset]
+        if len(offsets) == 0 or offsets[0] != offset:
+            self.requests_unserved += 1
+            return None
+        for segment_offset in offsets:
+            key = (file_name, block_num, segment_offset)
+            versions = self.session.segments[key]
+            # the versions of a segment (e.g. a modified file) are served in captured order, the last one again
+            served = self.served.get(key, 0)
+            record_time, message = versions[min(served, len(versions) - 1)]
+            self.served[key] = served + 1
+            self.feeder.send(max(time.time(), self.get_due_time(record_time)), MESSAGE_BLOCK, message)
+
+
+def receive(receive_socket, size):
+    data = bytearray()
+    while len(data) < size:
+        received = receive_socket.recv(min(size - len(data), 524288))
+        if len(received) == 0:
+            raise ConnectionError('connection closed')
+        data += received
+    return bytes(data)
+
+
+def connect(ip, target, timeout):
+    """
+    connect from ip to target, retry until the instance is up
+    :return: the socket
+    """
+    deadline = time.time() + timeout
+    while True:
+        connect_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connect_socket.bind((ip, 0))
+        try:
+            connect_socket.connect(target)
+            return connect_socket
+        except OSError:
+            connect_socket.close()
+            if time.time() > deadline:
+                raise
+            time.sleep(benchmark.POLL_INTERVAL)
+
+
+def is_complete(share_dir, expected):
+    for file_name, size in expected.items():
+        try:
+            if os.path.getsize(os.path.join(share_dir, file_name)) != size:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def summary(capture_path):
+    """
+    print the messages of the capture by direction and type
+    :return: None
+    """
+    counts = {}
+    first_time = None
+    last_time = None
+    for record_time, direction, peer_ip, message_type, message_size, _, _ in black_box.read(capture_path):
+        first_time = record_time if first_time is None else first_time
+        last_time = record_time
+        key = (peer_ip, black_box.DIRECTION_NAMES[direction], MESSAGE_NAMES.get(message_type, str(message_type)))
+        count, size = counts.get(key, (0, 0))
+        counts[key] = (count + 1, size + message_size)
+    print('duration: %.3fs' % (last_time - first_time if first_time is not None else 0))
+    print('peer\tdirection\ttype\tmessages\tbytes')
+    for (peer_ip, direction, type_name), (count, size) in sorted(counts.items()):
+        print(peer_ip + '\t' + direction + '\t' + type_name + '\t' + str(count) + '\t' + str(size))
+
+
+def replay(arguments, extra_args):
+    """
+    :return: the results of the replay
+    """
+    session = Session(arguments.capture, arguments.peer)
+    expected = session.get_expected()
+    work_dir = tempfile.mkdtemp(prefix='replay_', dir=arguments.work)
+    # the replayer only answers block requests: the instance is not to ask for a stream (reference -> Code/moving_van)
+    instance = benchmark.Instance(NODE_NUM, work_dir, 2, ['--stream-min-files', '0'] + extra_args)
+    if arguments.share is not None:
+        shutil.rmtree(instance.share_dir)
+        shutil.copytree(arguments.share, instance.share_dir, copy_function=shutil.copy2)
+    replayer = Replayer(session, arguments.speed, benchmark.get_ip(REPLAYER_NUM))
+    replayer.start()
+    instance.start()
+    converged = False
+    seconds = None
+    try:
+        inbox_socket = connect(benchmark.get_ip(REPLAYER_NUM), (instance.ip, PORT), arguments.timeout)
+        replayer.start_session(inbox_socket)
+        while time.time() - replayer.start_time < arguments.timeout:
+            instance.sample()
+            if is_complete(instance.share_dir, expected):
+                converged = True
+                seconds = time.time() - replayer.start_time
+                break
+            time.sleep(benchmark.POLL_INTERVAL)
+    finally:
+        instance.sample()
+        instance.stop()
+        if not arguments.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    dataset_size = sum(expected.values())
+    return {
+        'converged': converged,
+        'seconds': seconds,
+        'files': len(expected),
+        'dataset_bytes': dataset_size,
+        'throughput_bytes_per_second': dataset_size / seconds if converged and seconds > 0 else None,
+        'messages_sent': replayer.feeder.sent if replayer.feeder is not None else 0,
+        'requests': replayer.requests,
+        'requests_unserved': replayer.requests_unserved,
+        'cpu_seconds': [round(instance.cpu_seconds, 3)],
+        'peak_rss_bytes': [instance.peak_rss],
+        'work_dir': work_dir if arguments.keep else None,
+    }
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='TwoDrive capture replay')
+    parser.add_argument('capture', action='store', type=str, help='capture file (main.py --capture-file)')
+    parser.add_argument('--summary', action='store_true', help='print the messages of the capture and exit')
+    parser.add_argument('--speed', action='store', default=SPEED_RECORDED, type=str,
+                        help='replay speed [' + ' | '.join(SPEEDS) + ']')
+    parser.add_argument('--peer', action='store', default=None, type=str,
+                        help='replay the messages received from this peer only, default: from all peers')
+    parser.add_argument('--share', action='store', default=None, type=str,
+                        help='directory the share of the instance starts with, default: empty')
+    parser.add_argument('--timeout', action='store', default=300, type=float, help='seconds to wait')
+    parser.add_argument('--work', action='store', default=None, type=str,
+                        help='directory of the working directory of the instance, default: system temp')
+    parser.add_argument('--keep', action='store_true', help='keep the working directory and log')
+    parser.add_argument('--output', action='store', default=None, type=str, help='JSON results file')
+    parser.add_argument('--compare', action='store', default=None, type=str,
+                        help='JSON results of a baseline revision to compare with')
+    parser.epilog = 'arguments after -- are passed to the instance'
+
+    # the arguments after -- are not parsed: the capture is positional
+    argv = sys.argv[1:]
+    extra_args = []
+    if '--' in argv:
+        extra_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    arguments = parser.parse_args(argv)
+    if arguments.speed not in SPEEDS:
+        print('speed incorrect:', arguments.speed)
+        exit(2)
+    return arguments, extra_args
+
+
+def run():
+    arguments, extra_args = get_arguments()
+    if arguments.summary:
+        summary(arguments.capture)
+        return None
+    commit, dirty = benchmark.get_revision()
+    results = {
+        'revision': commit,
+        'dirty': dirty,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'capture': os.path.abspath(arguments.capture),
+        'speed': arguments.speed,
+        'peer': arguments.peer,
+        'instance_args': extra_args,
+        'scenarios': {'replay': replay(arguments, extra_args)},
+    }
+    print('replay:', json.dumps(results['scenarios']['replay']), file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if arguments.compare is not None:
+        with open(arguments.compare) as f:
+            baseline = json.load(f)
+        if not benchmark.compare(results, baseline):
+            exit(1)
+
+
+if __name__ == '__main__':
+    try:
+        run()
+    except ValueError as e:
+        print(e)
+        exit(2)
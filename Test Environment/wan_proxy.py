@@ -0,0 +1,433 @@
+"""
+wan_proxy emulates a wide area network between TwoDrive instances, in userspace (no root, no tc netem)
+
+the proxy listens on the address the peers connect to (port 23456) and forwards every
+connection to the instance behind it, which listens on another port (main.py --listen-port),
+the forwarded connection is made from the address of the connecting peer when possible
+(any 127.x.x.x address on loopback), so the instances still identify each other by address
+
+each direction of a connection goes through the link (from, to) of the scenario:
+latency - milliseconds added to every chunk
+jitter - milliseconds of random delay added to or taken from the latency, the order of the bytes is kept
+bandwidth - KB/s of the link, shared by the connections of the same direction, 0: no cap
+stall_rate - probability that a chunk stalls (a lost packet waiting for its retransmission), the
+             chunks behind it wait too (head-of-line blocking)
+stall - milliseconds of a stall
+reset_interval - mean seconds between two resets (TCP RST) of a connection, 0: never
+
+scenario file (JSON), the first matching link applies ('*' and fnmatch patterns of addresses):
+{
+  "seed": 1,
+  "links": [
+    {"from": "127.0.0.10", "to": "*", "latency": 40, "jitter": 5, "bandwidth": 1024},
+    {"from": "*", "to": "*", "latency": 40, "jitter": 5, "bandwidth": 4096, "stall_rate": 0.001, "stall": 300}
+  ],
+  "events": [
+    {"at": 30, "link": {"from": "*", "to": "127.0.0.11", "latency": 300}},
+    {"at": 60, "reset": {"from": "*", "to": "127.0.0.11"}},
+    {"at": 90, "links": [{"from": "*", "to": "*", "latency": 40}]}
+  ]
+}
+events, in seconds since the start of the proxy:
+link - add a link in front of the others (it applies first)
+links - replace all links
+reset - reset the connections of the matching links
+
+e.g.
+python3 wan_proxy.py --scenario cross_site.json --route 127.0.0.11:23456=127.0.0.11:23556
+(the benchmark starts the proxy itself: python3 benchmark.py --wan cross_site.json)
+"""
+import argparse
+import fnmatch
+import json
+import logging
+import random
+import socket
+import struct
+import sys
+import time
+from queue import Full, Queue
+from threading import Event, Lock, Thread
+
+# config
+CHUNK_SIZE = 16384  # bytes read at a time, the unit of delay and stalls
+WINDOW_SIZE = 1048576  # bytes in flight in one direction of a connection before the reader waits
+TICK = 0.1  # seconds between two checks of the events and the random resets
+
+LINK_KEYS = {'latency': 0, 'jitter': 0, 'bandwidth': 0, 'stall_rate': 0, 'stall': 0, 'reset_interval': 0}
+
+LOGGER = logging.getLogger('wan_proxy')
+
+
+class Scenario:
+    """
+    self.links: [link], link: {'from', 'to', 'latency', ...} (reference -> LINK_KEYS)
+    self.events: [event] by time, event: {'at', 'link' / 'links' / 'reset'}
+    self.link_free: {(from ip, to ip): time the bandwidth of the link is free}
+    """
+
+    def __init__(self, scenario):
+        self.seed = scenario.get('seed', 0)
+        self.links = [get_link(link) for link in scenario.get('links', [])]
+        self.events = sorted(scenario.get('events', []), key=lambda event: event['at'])
+        for event in self.events:
+            if 'link' in event:
+                event['link'] = get_link(event['link'])
+            if 'links' in event:
+                event['links'] = [get_link(link) for link in event['links']]
+        self.link_free = {}
+        self.lock = Lock()
+
+    def get_link(self, from_ip, to_ip):
+        """
+        :return: the first link matching the direction, no emulation if none
+        """
+        with self.lock:
+            for link in self.links:
+                if fnmatch.fnmatch(from_ip, link['from']) and fnmatch.fnmatch(to_ip, link['to']):
+                    return link
+        return get_link({'from': from_ip, 'to': to_ip})
+
+    def transmit(self, from_ip, to_ip, size, bandwidth):
+        """
+        take the bandwidth of the link for size bytes
+        :return: time the bytes are transmitted
+        """
+        now = time.monotonic()
+        if bandwidth <= 0:
+            return now
+        with self.lock:
+            start = max(now, self.link_free.get((from_ip, to_ip), 0))
+            self.link_free[(from_ip, to_ip)] = start + size / (bandwidth * 1024)
+            return self.link_free[(from_ip, to_ip)]
+
+    def apply(self, event):
+        with self.lock:
+            if 'link' in event:
+                self.links.insert(0, event['link'])
+            if 'links' in event:
+                self.links = event['links']
+
+
+class Pipe(Thread):
+    """
+    one direction of a connection, the reader (this thread) stamps the delivery time of each chunk,
+    the writer thread sends the chunk at that time
+    message_queue format: (delivery time, data), b'' at the end of the stream, None once closed
+    """
+
+    def __init__(self, connection, source, target, from_ip, to_ip, rng):
+        Thread.__init__(self, daemon=True)
+        self.connection = connection
+        self.source = source
+        self.target = target
+        self.from_ip = from_ip
+        self.to_ip = to_ip
+        self.rng = rng
+        self.message_queue = Queue(max(1, WINDOW_SIZE // CHUNK_SIZE))
+        self.prev_delivery = 0
+        self.forwarded = 0
+        self.writer = Thread(target=self.write, daemon=True)
+
+    def send(self, message):
+        # the writer stops when the connection is closed: do not wait for room in the queue then
+        while not self.connection.closed:
+            try:
+                self.message_queue.put(message, timeout=TICK)
+                return None
+            except Full:
+                continue
+
+    def run(self):
+        self.writer.start()
+        try:
+            while True:
+                data = self.source.recv(CHUNK_SIZE)
+                self.send((self.get_delivery(len(data)), data))
+                if len(data) == 0:
+                    break
+        except OSError:
+            self.connection.close()
+            try:
+                # wake up the writer if it waits for a chunk, otherwise it fails on the closed socket
+                self.message_queue.put_nowait((0, None))
+            except Full:
+                pass
+
+    def get_delivery(self, size):
+        link = self.connection.scenario.get_link(self.from_ip, self.to_ip)
+        delivery = self.connection.scenario.transmit(self.from_ip, self.to_ip, size, link['bandwidth'])
+        delivery += max(0, link['latency'] + self.rng.uniform(-link['jitter'], link['jitter'])) / 1000
+        if link['stall_rate'] > 0 and self.rng.random() < link['stall_rate']:
+            delivery += link['stall'] / 1000
+        # the bytes are delivered in order: a delayed chunk holds back the chunks behind it
+        self.prev_delivery = max(delivery, self.prev_delivery)
+        return self.prev_delivery
+
+    def write(self):
+        while True:
+            delivery, data = self.message_queue.get()
+            if data is None:  # connection closed
+                return None
+            delay = delivery - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                if len(data) == 0:
+                    self.target.shutdown(socket.SHUT_WR)
+                    return None
+                self.target.sendall(data)
+                self.forwarded += len(data)
+            except OSError:
+                self.connection.close()
+                return None
+
+
+class Connection:
+    """
+    a proxied connection from peer_ip to the instance behind target_ip
+    """
+
+    def __init__(self, proxy, client_socket, peer_ip):
+        self.scenario = proxy.scenario
+        self.client_socket = client_socket
+        self.peer_ip = peer_ip
+        self.target_ip = proxy.target[0]
+        self.target_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.closed = False
+        self.lock = Lock()
+        self.pipes = []
+        try:
+            # connect from the address of the peer, so the instance identifies it
+            self.target_socket.bind((peer_ip, 0))
+        except OSError as e:
+            LOGGER.warning('cannot connect from %s, the instance sees the proxy address: %s', peer_ip, e)
+        self.target_socket.connect(proxy.target)
+
+    def start(self, rng):
+        for socket_ in (self.client_socket, self.target_socket):
+            socket_.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.pipes = [Pipe(self, self.client_socket, self.target_socket, self.peer_ip, self.target_ip,
+                           random.Random(rng.random())),
+                      Pipe(self, self.target_socket, self.client_socket, self.target_ip, self.peer_ip,
+                           random.Random(rng.random()))]
+        for pipe in self.pipes:
+            pipe.start()
+
+    def matches(self, link):
+        return any(fnmatch.fnmatch(pipe.from_ip, link['from']) and fnmatch.fnmatch(pipe.to_ip, link['to'])
+                   for pipe in self.pipes)
+
+    def reset(self):
+        """
+        reset the connection (TCP RST) on both sides
+        :return: None
+        """
+        LOGGER.info('reset: %s -> %s', self.peer_ip, self.target_ip)
+        self.close(reset=True)
+
+    def close(self, reset=False):
+        """
+        :param reset: reset (TCP RST) instead of closing (TCP FIN)
+        :return: None
+        """
+        with self.lock:
+            if self.closed:
+                return None
+            self.closed = True
+        for socket_ in (self.client_socket, self.target_socket):
+            try:
+                if reset:
+                    socket_.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack('ii', 1, 0))
+                # wake up the pipe blocked in recv, close alone does not
+                socket_.shutdown(socket.SHUT_RD if reset else socket.SHUT_RDWR)
+            except OSError:
+                pass
+            socket_.close()
+        LOGGER.info('closed: %s -> %s, %s bytes forwarded', self.peer_ip, self.target_ip,
+                    '/'.join(str(pipe.forwarded) for pipe in self.pipes))
+
+
+class Proxy(Thread):
+    """
+    accepts the connections to listen and forwards them to target
+    """
+
+    def __init__(self, scenario, listen, target, rng):
+        Thread.__init__(self, daemon=True)
+        self.scenario = scenario
+        self.listen = listen
+        self.target = target
+        self.rng = rng
+        self.connections = []
+        self.lock = Lock()
+        self.listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen_socket.bind(listen)
+        self.stopped = False
+
+    def run(self):
+        # listen once the instance is up: the peers connecting before are refused, as without the proxy,
+        # instead of being accepted and dropped
+        while not self.stopped:
+            try:
+                socket.create_connection(self.target, timeout=1).close()
+                break
+            except OSError:
+                time.sleep(TICK)
+        if self.stopped:
+            return None
+        self.listen_socket.listen(16)
+        LOGGER.info('proxy %s:%d -> %s:%d', *self.listen, *self.target)
+        while True:
+            try:
+                client_socket, addr = self.listen_socket.accept()
+            except OSError:  # stopped
+                return None
+            try:
+                connection = Connection(self, client_socket, addr[0])
+            except OSError as e:  # the instance is not up: the peer retries
+                LOGGER.debug('failed to connect to %s:%d: %s', *self.target, e)
+                client_socket.close()
+                continue
+            with self.lock:
+                self.connections = [connection_ for connection_ in self.connections if not connection_.closed]
+                self.connections.append(connection)
+            connection.start(random.Random(self.rng.random()))
+
+    def get_connections(self):
+        with self.lock:
+            return [connection for connection in self.connections if not connection.closed]
+
+    def stop(self):
+        self.stopped = True
+        try:
+            # wake up the accept, close alone does not
+            self.listen_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listen_socket.close()
+        for connection in self.get_connections():
+            connection.close()
+
+
+class WanProxy(Thread):
+    """
+    the proxies of all routes and the scenario clock (events and random resets)
+    """
+
+    def __init__(self, scenario, routes):
+        """
+        :param scenario: the scenario (reference -> the scenario file)
+        :param routes: [((listen ip, port), (target ip, port))]
+        """
+        Thread.__init__(self, daemon=True)
+        self.scenario = Scenario(scenario)
+        self.rng = random.Random(self.scenario.seed)
+        self.proxies = [Proxy(self.scenario, listen, target, random.Random(self.rng.random()))
+                        for listen, target in routes]
+        self.stopped = Event()
+
+    def run(self):
+        for proxy in self.proxies:
+            proxy.start()
+        start_time = time.monotonic()
+        events = list(self.scenario.events)
+        while not self.stopped.wait(TICK):
+            now = time.monotonic() - start_time
+            while len(events) > 0 and events[0]['at'] <= now:
+                event = events.pop(0)
+                LOGGER.info('event at %.1fs: %s', now, event)
+                self.scenario.apply(event)
+                if 'reset' in event:
+                    reset_link = get_link(event['reset'])
+                    for connection in self.get_connections():
+                        if connection.matches(reset_link):
+                            connection.reset()
+            # random resets: a connection is reset with probability TICK / reset_interval per tick
+            for connection in self.get_connections():
+                reset_interval = max(self.scenario.get_link(pipe.from_ip, pipe.to_ip)['reset_interval']
+                                     for pipe in connection.pipes)
+                if reset_interval > 0 and self.rng.random() < TICK / reset_interval:
+                    connection.reset()
+
+    def get_connections(self):
+        return [connection for proxy in self.proxies for connection in proxy.get_connections()]
+
+    def stop(self):
+        self.stopped.set()
+        for proxy in self.proxies:
+            proxy.stop()
+
+
+def get_link(link):
+    """
+    :return: the link with the defaults of the missing keys
+    """
+    unknown = set(link) - set(LINK_KEYS) - {'from', 'to'}
+    if len(unknown) > 0:
+        raise ValueError('unknown link keys: ' + ', '.join(sorted(unknown)))
+    result = dict(LINK_KEYS, **{'from': '*', 'to': '*'})
+    result.update(link)
+    return result
+
+
+def load_scenario(path):
+    with open(path) as scenario_file:
+        return json.load(scenario_file)
+
+
+def parse_address(address):
+    """
+    :param address: ip:port
+    :return: (ip, port)
+    """
+    ip, port = address.rsplit(':', 1)
+    socket.inet_aton(ip)
+    return ip, int(port)
+
+
+def parse_route(route):
+    """
+    :param route: listen ip:port=target ip:port
+    :return: ((listen ip, port), (target ip, port))
+    """
+    try:
+        listen, target = route.split('=')
+        return parse_address(listen), parse_address(target)
+    except (ValueError, OSError):
+        raise ValueError('route format incorrect in: ' + route)
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description='TwoDrive WAN emulation proxy')
+    parser.add_argument('--scenario', action='store', required=True, type=str, help='scenario file (JSON)')
+    parser.add_argument('--route', action='append', required=True, type=str,
+                        help='listen ip:port=target ip:port, repeated for each instance')
+    parser.add_argument('--log-level', action='store', default='info', type=str, help='log level')
+    arguments = parser.parse_args()
+    try:
+        routes = [parse_route(route) for route in arguments.route]
+        scenario = load_scenario(arguments.scenario)
+        Scenario(scenario)
+    except (ValueError, OSError) as e:
+        print(e)
+        exit(2)
+    return scenario, routes, arguments.log_level
+
+
+def run():
+    scenario, routes, log_level = get_arguments()
+    logging.basicConfig(level=log_level.upper(), format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+                        stream=sys.stderr)
+    wan_proxy = WanProxy(scenario, routes)
+    wan_proxy.start()
+    try:
+        while wan_proxy.is_alive():
+            wan_proxy.join(1)
+    except KeyboardInterrupt:
+        wan_proxy.stop()
+
+
+if __name__ == '__main__':
+    run()